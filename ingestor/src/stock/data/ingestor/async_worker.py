@@ -0,0 +1,586 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import Counter, deque, namedtuple
+from . import clients, marketstack, metrics, serialization, worker
+from .dedupe import EOD_KEY, remove_dupes
+from .delta import (
+    HASHES_FILE_NAME,
+    DeltaWriter,
+    get_hashes_path,
+    get_resumed_hashes,
+    load_hashes_async,
+    save_hashes_async,
+)
+from .marketstack import DEFAULT_PARAMS
+from .messages import decode_message, get_file_name_preffix, get_shard_file_name
+from .records import parse_eod_records
+from .spool import open_spool, remove_spool
+from .writers import DEFAULT_OUTPUT_FORMAT, EOD_FILE_NAME, get_output_writer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FETCH_CONCURRENCY = int(os.getenv("EOD_INGESTOR_ASYNC_FETCH_CONCURRENCY", "16"))
+SAVE_CONCURRENCY = int(os.getenv("EOD_INGESTOR_ASYNC_SAVE_CONCURRENCY", "4"))
+MESSAGE_CONCURRENCY = int(os.getenv("EOD_INGESTOR_ASYNC_MESSAGE_CONCURRENCY", "8"))
+CHUNK_QUEUE_SIZE = int(os.getenv("EOD_INGESTOR_ASYNC_CHUNK_QUEUE_SIZE", "4"))
+
+queue_client = None
+
+# Semaphores bounding each stage across every message in flight
+Stages = namedtuple("Stages", ["fetch", "save"])
+
+
+def get_stages():
+    return Stages(
+        asyncio.Semaphore(FETCH_CONCURRENCY), asyncio.Semaphore(SAVE_CONCURRENCY)
+    )
+
+
+def configure_eod_ingestor_worker_auth(storage_name, queue_name):
+    """Get the async client of the EOD Ingestor queue"""
+    logger.info("Getting auth for the async EOD Ingestor")
+    global queue_client
+    queue_client = clients.get_async_queue_client(storage_name, queue_name)
+
+
+async def get_page(stages, endpoint, offset, extra_params, stats, spool=None):
+    """Get a page from Marketstack API, replaying it from the spool if it is there"""
+    if spool is not None:
+        page = spool.get_page(endpoint, offset, extra_params)
+        if page is not None:
+            return page
+    async with stages.fetch:
+        page = await marketstack.get_async(endpoint, {"offset": offset, **extra_params})
+    stats[endpoint] += 1
+    metrics.increment("marketstack_pages_total")
+    if spool is not None:
+        spool.add_page(endpoint, offset, extra_params, page)
+    return page
+
+
+async def get_request_with_offsets(stages, job, stats, spool=None):
+    """Get every page of a paginated request, fanning out once its total is known"""
+    endpoint, initial_offset, extra_params = job
+    first_page = await get_page(
+        stages, endpoint, initial_offset, extra_params, stats, spool
+    )
+    limit = {**DEFAULT_PARAMS, **extra_params}["limit"]
+    async with asyncio.TaskGroup() as group:
+        pages = [
+            group.create_task(
+                get_page(stages, endpoint, offset, extra_params, stats, spool)
+            )
+            for offset in worker.get_page_offsets(first_page, initial_offset, limit)
+        ]
+    data = list(first_page["data"]["eod"])
+    for page in pages:
+        data.extend(page.result()["data"]["eod"])
+    return data
+
+
+async def put_eod_chunks(stages, chunks, jobs, stats=None, spool=None, summary=None):
+    """Fetch paginated requests, putting each one's EOD records on a queue
+
+    Chunks are put in job order and ``None`` follows the last one. At most
+    CHUNK_QUEUE_SIZE requests are fetched ahead of the queue, so with a
+    bounded ``chunks`` only a few chunks are held in memory at once. Only the
+    fetch stage's semaphore limits how many requests are in flight.
+    """
+    stats = stats if stats is not None else Counter()
+    summary = summary if summary is not None else Counter()
+    pending = deque()
+
+    async def put_next():
+        with metrics.timer("fetch", summary):
+            data = await pending.popleft()
+        eod_chunk = remove_dupes(parse_eod_records(data), EOD_KEY)
+        summary["rows"] += len(eod_chunk)
+        metrics.increment("rows_fetched_total", len(eod_chunk))
+        await chunks.put(eod_chunk)
+
+    async with asyncio.TaskGroup() as group:
+        for job in jobs:
+            pending.append(
+                group.create_task(get_request_with_offsets(stages, job, stats, spool))
+            )
+            if len(pending) >= CHUNK_QUEUE_SIZE:
+                await put_next()
+        while pending:
+            await put_next()
+    await chunks.put(None)
+
+
+async def iter_chunk_files(writer, chunks):
+    """Write the EOD chunks taken from a queue, yielding files as they are complete"""
+    while True:
+        eod_chunk = await chunks.get()
+        if eod_chunk is None:
+            break
+        for output_file in writer.write(eod_chunk):
+            yield output_file
+    for output_file in writer.close():
+        yield output_file
+
+
+async def iter_files(files):
+    """Iterate over files asynchronously"""
+    for output_file in files:
+        yield output_file
+
+
+async def upload_file(file_system_client, file_name, file_content):
+    """Upload a file in a single request, replacing any existing file"""
+    file_client = file_system_client.get_file_client(file_name)
+    await file_client.upload_data(file_content, overwrite=True)
+    return len(file_content)
+
+
+async def upload_files(stages, file_system_client, files, spool=None):
+    """Upload files as they are produced, retrying the ones that fail
+
+    ``files`` is an async iterable that is only read while the save stage has
+    a free slot, so files wait in it rather than in memory. Returns what
+    worker.upload_files does.
+    """
+    from azure.core.exceptions import AzureError
+
+    succeeded = []
+    errors = {}
+
+    async def upload_one(file_name, file_content, failed):
+        try:
+            upload = {
+                "file_name": file_name,
+                "bytes": await upload_file(file_system_client, file_name, file_content),
+            }
+        except AzureError as e:
+            logger.warning(f"Error uploading {file_name}: {e}")
+            errors[file_name] = str(e)
+            failed.append((file_name, file_content))
+        else:
+            succeeded.append(upload)
+            errors.pop(file_name, None)
+            if spool is not None:
+                spool.add_upload(upload)
+
+    pending = files
+    failed = []
+    for attempt in range(worker.UPLOAD_RETRIES + 1):
+        if attempt > 0:
+            logger.info("Retrying upload of %s files", len(failed))
+            await asyncio.sleep(worker.UPLOAD_RETRY_DELAY * 2 ** (attempt - 1))
+            pending, failed = iter_files(failed), []
+        async with asyncio.TaskGroup() as group:
+            async for file_name, file_content in pending:
+                upload = spool.get_upload(file_name) if spool is not None else None
+                if upload is not None:
+                    succeeded.append(upload)
+                    continue
+                await stages.save.acquire()
+                task = group.create_task(upload_one(file_name, file_content, failed))
+                # Released even if the task is cancelled before it starts
+                task.add_done_callback(lambda _: stages.save.release())
+        if not failed:
+            break
+
+    return {"succeeded": succeeded, "failed": worker.get_failed_uploads(failed, errors)}
+
+
+async def save_eod(
+    stages,
+    file_name_preffix,
+    chunks,
+    file_system,
+    eod_ingestor_datastore_name,
+    output_format=None,
+    file_name=EOD_FILE_NAME,
+    summary=None,
+    spool=None,
+    hashes_file_name=None,
+    previous_files=(),
+):
+    """Save the EOD chunks put on a queue for an exchange, as worker.save_eod does
+
+    Files are uploaded as the writer completes them: a per-symbol layout
+    uploads while chunks are still being fetched, and a consolidated file is
+    compressed as its chunks arrive.
+    """
+    logger.info("Saving EOD data for an exchange")
+    file_system_client = clients.get_async_file_system_client(
+        eod_ingestor_datastore_name, file_system
+    )
+    output_format = output_format or DEFAULT_OUTPUT_FORMAT
+    writer = get_output_writer(file_name_preffix, output_format, file_name)
+    hashes = {}
+    skipped = []
+    hashes_file_name = get_hashes_path(file_name_preffix, hashes_file_name)
+    with metrics.timer("save_eod", summary):
+        if hashes_file_name is not None:
+            previous = await load_hashes_async(file_system_client, hashes_file_name)
+            hashes.update(
+                get_resumed_hashes(
+                    previous, output_format, file_name_preffix, previous_files
+                )
+            )
+            writer = DeltaWriter(
+                writer,
+                file_name_preffix,
+                output_format,
+                file_name,
+                previous,
+                hashes,
+                skipped,
+            )
+        uploads = await upload_files(
+            stages, file_system_client, iter_chunk_files(writer, chunks), spool
+        )
+        uploads["skipped"] = skipped
+        if hashes_file_name is not None and not uploads["failed"]:
+            await save_hashes_async(
+                file_system_client,
+                hashes_file_name,
+                output_format,
+                hashes,
+                worker.get_saved_files(uploads, previous_files),
+            )
+    worker.count_uploads(uploads, summary)
+    return uploads
+
+
+async def get_eod_ingestor_worker_status(
+    file_name_preffix, file_system, eod_ingestor_datastore_name, status_file_name
+):
+    """Get the EOD Ingestor Worker status left by an earlier run, if any"""
+    from azure.core.exceptions import ResourceNotFoundError
+
+    file_system_client = clients.get_async_file_system_client(
+        eod_ingestor_datastore_name, file_system
+    )
+    file_client = file_system_client.get_file_client(
+        f"{file_name_preffix}/{status_file_name}.json"
+    )
+    try:
+        download = await file_client.download_file()
+        return serialization.loads(await download.readall())
+    except ResourceNotFoundError:
+        return None
+
+
+async def log_eod_ingestor_worker_status(
+    success_file_contents,
+    file_name_preffix,
+    file_system,
+    eod_ingestor_datastore_name,
+    status_file_name,
+):
+    """Log EOD Ingestor Worker status"""
+    logger.info("Logging EOD Ingestor Worker status")
+    file_system_client = clients.get_async_file_system_client(
+        eod_ingestor_datastore_name, file_system
+    )
+    await upload_file(
+        file_system_client,
+        f"{file_name_preffix}/{status_file_name}.json",
+        success_file_contents,
+    )
+
+
+async def get_message_tickers(message):
+    """Get a message's tickers, reading them from the datastore if they were spilled"""
+    if "tickers_path" not in message:
+        return message["tickers"]
+    logger.info("Reading tickers from %s", message["tickers_path"])
+    file_system_client = clients.get_async_file_system_client(
+        message["eod_datastore_name"], message["eod_datastore_container"]
+    )
+    file_client = file_system_client.get_file_client(message["tickers_path"])
+    download = await file_client.download_file()
+    return (await download.readall()).decode()
+
+
+async def receive_messages(max_messages):
+    """Receive up to max_messages messages from the queue"""
+    with metrics.timer("queue_receive"):
+        return [
+            msg
+            async for msg in queue_client.receive_messages(
+                messages_per_page=max_messages,
+                max_messages=max_messages,
+                visibility_timeout=worker.VISIBILITY_TIMEOUT,
+            )
+        ]
+
+
+async def delete_message(msg, status="success"):
+    """Delete a message from the queue once it has been dealt with"""
+    with metrics.timer("queue_delete"):
+        await queue_client.delete_message(msg)
+    metrics.increment("messages_processed_total", status=status)
+
+
+@contextlib.asynccontextmanager
+async def keep_message_visible(msg, visibility_timeout=None):
+    """Keep renewing a message's visibility timeout from a task"""
+    from azure.core.exceptions import AzureError
+
+    visibility_timeout = visibility_timeout or worker.VISIBILITY_TIMEOUT
+
+    async def renew():
+        while True:
+            await asyncio.sleep(visibility_timeout / 2)
+            try:
+                updated = await queue_client.update_message(
+                    msg, visibility_timeout=visibility_timeout
+                )
+                msg.pop_receipt = updated.pop_receipt
+                msg.next_visible_on = updated.next_visible_on
+            except AzureError as e:
+                logger.warning(f"Error renewing visibility of message {msg.id}: {e}")
+
+    task = asyncio.create_task(renew())
+    try:
+        yield msg
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+async def save_partitions(stages, message, chunks, summary, spool):
+    """Save the EOD chunks of a date range, one partition per date
+
+    Each partition's rows are handed to its own save_eod through a bounded
+    queue as the chunks arrive. Returns the uploads of every partition.
+    """
+    partitions = {}
+    async with asyncio.TaskGroup() as group:
+        while True:
+            eod_chunk = await chunks.get()
+            if eod_chunk is None:
+                break
+            partition_chunks = worker.partition_eod_by_date(message, eod_chunk)
+            for file_name_preffix, eod_data in partition_chunks.items():
+                if file_name_preffix not in partitions:
+                    partition_queue = asyncio.Queue(CHUNK_QUEUE_SIZE)
+                    save = group.create_task(
+                        save_eod(
+                            stages,
+                            file_name_preffix,
+                            partition_queue,
+                            message["eod_datastore_container"],
+                            message["eod_datastore_name"],
+                            message.get("output_format", DEFAULT_OUTPUT_FORMAT),
+                            get_shard_file_name(EOD_FILE_NAME, message),
+                            summary,
+                            spool,
+                            get_shard_file_name(HASHES_FILE_NAME, message),
+                        )
+                    )
+                    partitions[file_name_preffix] = (partition_queue, save)
+                await partitions[file_name_preffix][0].put(eod_data)
+        logger.info("Saving %s partitions", len(partitions))
+        for partition_queue, _ in partitions.values():
+            await partition_queue.put(None)
+    return {
+        file_name_preffix: save.result()
+        for file_name_preffix, (_, save) in partitions.items()
+    }
+
+
+async def process_backfill_message(stages, msg, message):
+    """Ingest the EOD data for a date range, as the worker does"""
+    started = time.perf_counter()
+    file_system = message["eod_datastore_container"]
+    status_file_name = get_shard_file_name("EODSTATUS", message)
+    output_format = message.get("output_format", DEFAULT_OUTPUT_FORMAT)
+    requests = Counter()
+    summary = Counter()
+    async with keep_message_visible(msg):
+        with open_spool(msg.id) as spool:
+            jobs = worker.get_backfill_jobs(
+                (await get_message_tickers(message)).split(","),
+                message["exchange_mic"],
+                message["date_from"],
+                message["date_to"],
+            )
+            chunks = asyncio.Queue(CHUNK_QUEUE_SIZE)
+            async with asyncio.TaskGroup() as group:
+                group.create_task(
+                    put_eod_chunks(stages, chunks, jobs, requests, spool, summary)
+                )
+                partition_uploads = await save_partitions(
+                    stages, message, chunks, summary, spool
+                )
+            worker.finish_summary(summary, requests, spool, started)
+            status_files = worker.get_status_files(
+                message, output_format, partition_uploads, requests, summary
+            )
+            for file_name_preffix, status_file_contents in status_files.items():
+                await log_eod_ingestor_worker_status(
+                    status_file_contents,
+                    file_name_preffix,
+                    file_system,
+                    message["eod_datastore_name"],
+                    status_file_name,
+                )
+    if worker.should_delete_message(partition_uploads):
+        await delete_message(msg)
+        remove_spool(msg.id)
+
+
+async def process_message(stages, msg):
+    """Ingest the EOD data requested by a queue message, as the worker does
+
+    The fetch and save stages run side by side, joined by a bounded queue of
+    EOD chunks.
+    """
+    started = time.perf_counter()
+    message = decode_message(msg.content)
+    if message.get("type") == "EOD_BACKFILL":
+        return await process_backfill_message(stages, msg, message)
+    file_system = message["eod_datastore_container"]
+    file_name_preffix = get_file_name_preffix(message)
+    status_file_name = get_shard_file_name("EODSTATUS", message)
+    output_format = message.get("output_format", DEFAULT_OUTPUT_FORMAT)
+    status = None
+    if not message.get("force"):
+        status = await get_eod_ingestor_worker_status(
+            file_name_preffix,
+            file_system,
+            message["eod_datastore_name"],
+            status_file_name,
+        )
+    if worker.is_ingested(status):
+        logger.info("%s was already ingested, skipping", file_name_preffix)
+        await delete_message(msg, status="skipped")
+        return
+
+    async with keep_message_visible(msg):
+        with open_spool(msg.id) as spool:
+            tickers, previous_files = worker.get_resume_plan(
+                (await get_message_tickers(message)).split(","),
+                file_name_preffix,
+                output_format,
+                status,
+            )
+            requests = Counter()
+            summary = Counter()
+            jobs = []
+            if tickers:
+                jobs = worker.get_exchange_jobs(
+                    tickers, message["exchange_mic"], message["date"]
+                )
+            chunks = asyncio.Queue(CHUNK_QUEUE_SIZE)
+            async with asyncio.TaskGroup() as group:
+                group.create_task(
+                    put_eod_chunks(stages, chunks, jobs, requests, spool, summary)
+                )
+                uploads = await save_eod(
+                    stages,
+                    file_name_preffix,
+                    chunks,
+                    file_system,
+                    message["eod_datastore_name"],
+                    output_format,
+                    get_shard_file_name(EOD_FILE_NAME, message),
+                    summary,
+                    spool,
+                    get_shard_file_name(HASHES_FILE_NAME, message),
+                    previous_files,
+                )
+            partition_uploads = {file_name_preffix: uploads}
+            worker.finish_summary(summary, requests, spool, started, tickers)
+            status_files = worker.get_status_files(
+                message,
+                output_format,
+                partition_uploads,
+                requests,
+                summary,
+                previous_files,
+            )
+            await log_eod_ingestor_worker_status(
+                status_files[file_name_preffix],
+                file_name_preffix,
+                file_system,
+                message["eod_datastore_name"],
+                status_file_name,
+            )
+    if worker.should_delete_message(partition_uploads):
+        await delete_message(msg)
+        remove_spool(msg.id)
+
+
+async def process_message_safely(stages, msg):
+    """Process a message, leaving it on the queue if anything goes wrong"""
+    try:
+        await process_message(stages, msg)
+    except Exception as e:
+        logger.exception(f"Error processing message {msg.id}: {e}")
+        metrics.increment("messages_processed_total", status="error")
+    finally:
+        metrics.write_textfile()
+
+
+async def run(daemon=True, storage_name=None, queue_name=None, shutdown=None):
+    """Receive and process messages concurrently on one event loop
+
+    Up to MESSAGE_CONCURRENCY messages are in flight at once, sharing the
+    fetch and save stages. A daemon keeps polling, backing off while the
+    queue is empty, until the ``shutdown`` event is set; otherwise the loop
+    stops once the queue is empty. ``shutdown`` defaults to worker.shutdown,
+    but worker.main passes its own: run as a script, the worker is a
+    different module from the one imported here. Queue, Data Lake and
+    Marketstack requests use the async clients, which are closed before the
+    loop ends.
+    """
+    from azure.core.exceptions import AzureError
+
+    logger.info("Running the async EOD Ingestor")
+    configure_eod_ingestor_worker_auth(storage_name, queue_name)
+    shutdown = shutdown if shutdown is not None else worker.shutdown
+    stages = get_stages()
+    idle_delay = 0
+    in_flight = set()
+    try:
+        async with asyncio.TaskGroup() as group:
+            while not shutdown.is_set():
+                free_slots = MESSAGE_CONCURRENCY - len(in_flight)
+                if free_slots == 0:
+                    await asyncio.wait(
+                        in_flight, timeout=1, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    continue
+                try:
+                    messages = await receive_messages(
+                        min(free_slots, worker.RECEIVE_BATCH_SIZE)
+                    )
+                except AzureError as e:
+                    logger.warning(f"Error receiving messages: {e}")
+                    messages = []
+                if not messages:
+                    if not daemon:
+                        if not in_flight:
+                            break
+                        await asyncio.wait(
+                            in_flight, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        continue
+                    idle_delay = min(
+                        max(worker.IDLE_BACKOFF_MIN, idle_delay * 2),
+                        worker.IDLE_BACKOFF_MAX,
+                    )
+                    await asyncio.to_thread(shutdown.wait, idle_delay)
+                    continue
+                idle_delay = 0
+                for msg in messages:
+                    task = group.create_task(process_message_safely(stages, msg))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+            logger.info("Waiting for %s messages in flight", len(in_flight))
+    finally:
+        await marketstack.close_async_session()
+        await clients.close_async_clients()
@@ -0,0 +1,235 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from . import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TOKEN_REFRESH_MARGIN = int(os.getenv("AZURE_TOKEN_REFRESH_MARGIN", "600"))
+
+# The Azure SDKs are imported when the first client is created rather than at
+# import time; they account for most of a cold start.
+
+client_cache_stats = Counter()
+_clients = {}
+_credential = None
+_async_credential = None
+_lock = threading.RLock()
+
+
+class RefreshingCredential:
+    """Wrap a credential so its tokens are cached and renewed ahead of expiry"""
+
+    def __init__(self, credential, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self._credential = credential
+        self._refresh_margin = refresh_margin
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        if kwargs.get("claims"):
+            return self._credential.get_token(*scopes, **kwargs)
+        key = (scopes, kwargs.get("tenant_id"))
+        with self._lock:
+            token = self._tokens.get(key)
+            if self._needs_refresh(token):
+                logger.info("Requesting Azure token for %s", ", ".join(scopes))
+                client_cache_stats["token_requests"] += 1
+                with metrics.timer("token_request"):
+                    token = self._credential.get_token(*scopes, **kwargs)
+                self._tokens[key] = token
+            return token
+
+    def _needs_refresh(self, token):
+        return token is None or token.expires_on - time.time() < self._refresh_margin
+
+    def close(self):
+        self._credential.close()
+
+
+class AsyncRefreshingCredential(RefreshingCredential):
+    """RefreshingCredential for the async Azure clients"""
+
+    def __init__(self, credential, refresh_margin=TOKEN_REFRESH_MARGIN):
+        import asyncio
+
+        super().__init__(credential, refresh_margin)
+        self._lock = asyncio.Lock()
+
+    async def get_token(self, *scopes, **kwargs):
+        if kwargs.get("claims"):
+            return await self._credential.get_token(*scopes, **kwargs)
+        key = (scopes, kwargs.get("tenant_id"))
+        async with self._lock:
+            token = self._tokens.get(key)
+            if self._needs_refresh(token):
+                logger.info("Requesting Azure token for %s", ", ".join(scopes))
+                client_cache_stats["token_requests"] += 1
+                with metrics.timer("token_request"):
+                    token = await self._credential.get_token(*scopes, **kwargs)
+                self._tokens[key] = token
+            return token
+
+    async def close(self):
+        await self._credential.close()
+
+
+def get_credential():
+    """Get the process wide Azure credential"""
+    global _credential
+    with _lock:
+        if _credential is None:
+            from azure.identity import DefaultAzureCredential
+
+            logger.info("Creating Azure credential")
+            client_cache_stats["credentials"] += 1
+            with metrics.timer("credential_create"):
+                _credential = RefreshingCredential(DefaultAzureCredential())
+    return _credential
+
+
+def get_async_credential():
+    """Get the process wide Azure credential of the async clients"""
+    global _async_credential
+    with _lock:
+        if _async_credential is None:
+            from azure.identity.aio import DefaultAzureCredential
+
+            logger.info("Creating async Azure credential")
+            client_cache_stats["credentials"] += 1
+            with metrics.timer("credential_create"):
+                _async_credential = AsyncRefreshingCredential(DefaultAzureCredential())
+    return _async_credential
+
+
+def get_cached_client(key, create_client):
+    """Get a client from the process wide cache, creating it on a miss"""
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client_cache_stats["misses"] += 1
+            client = _clients[key] = create_client()
+        else:
+            client_cache_stats["hits"] += 1
+    return client
+
+
+def get_datalake_service_client(storage_name):
+    """Get the Data Lake service client for a storage account"""
+
+    def create_client():
+        from azure.storage.filedatalake import DataLakeServiceClient
+
+        return DataLakeServiceClient(
+            account_url="{}://{}.dfs.core.windows.net".format("https", storage_name),
+            credential=get_credential(),
+        )
+
+    return get_cached_client(("dfs", storage_name, None), create_client)
+
+
+def get_file_system_client(storage_name, file_system):
+    """Get the Data Lake file system client for a storage account container"""
+    return get_cached_client(
+        ("dfs", storage_name, file_system),
+        lambda: get_datalake_service_client(storage_name).get_file_system_client(
+            file_system
+        ),
+    )
+
+
+def get_queue_client(storage_name, queue_name):
+    """Get the queue client for a storage account queue"""
+
+    def create_client():
+        from azure.storage.queue import (
+            QueueClient,
+            BinaryBase64EncodePolicy,
+            BinaryBase64DecodePolicy,
+        )
+
+        return QueueClient(
+            account_url="{}://{}.queue.core.windows.net".format("https", storage_name),
+            credential=get_credential(),
+            queue_name=queue_name,
+            message_encode_policy=BinaryBase64EncodePolicy(),
+            message_decode_policy=BinaryBase64DecodePolicy(),
+        )
+
+    return get_cached_client(("queue", storage_name, queue_name), create_client)
+
+
+def get_async_datalake_service_client(storage_name):
+    """Get the async Data Lake service client for a storage account"""
+
+    def create_client():
+        from azure.storage.filedatalake.aio import DataLakeServiceClient
+
+        return DataLakeServiceClient(
+            account_url="{}://{}.dfs.core.windows.net".format("https", storage_name),
+            credential=get_async_credential(),
+        )
+
+    return get_cached_client(("async-dfs", storage_name, None), create_client)
+
+
+def get_async_file_system_client(storage_name, file_system):
+    """Get the async Data Lake file system client for a storage account container"""
+    return get_cached_client(
+        ("async-dfs", storage_name, file_system),
+        lambda: get_async_datalake_service_client(storage_name).get_file_system_client(
+            file_system
+        ),
+    )
+
+
+def get_async_queue_client(storage_name, queue_name):
+    """Get the async queue client for a storage account queue"""
+
+    def create_client():
+        from azure.storage.queue import (
+            BinaryBase64EncodePolicy,
+            BinaryBase64DecodePolicy,
+        )
+        from azure.storage.queue.aio import QueueClient
+
+        return QueueClient(
+            account_url="{}://{}.queue.core.windows.net".format("https", storage_name),
+            credential=get_async_credential(),
+            queue_name=queue_name,
+            message_encode_policy=BinaryBase64EncodePolicy(),
+            message_decode_policy=BinaryBase64DecodePolicy(),
+        )
+
+    return get_cached_client(("async-queue", storage_name, queue_name), create_client)
+
+
+async def close_async_clients():
+    """Close the async clients and credential
+
+    Their connections belong to the event loop that opened them, so they are
+    closed and dropped from the cache before that loop ends.
+    """
+    global _async_credential
+    with _lock:
+        keys = [key for key in _clients if key[0].startswith("async-")]
+        async_clients = [_clients.pop(key) for key in keys]
+        credential, _async_credential = _async_credential, None
+    for client in async_clients:
+        await client.close()
+    if credential is not None:
+        await credential.close()
+
+
+def log_client_cache_stats():
+    """Log how often clients and tokens were created versus reused"""
+    logger.info(
+        "Client cache: %s hits, %s misses, %s credentials, %s token requests",
+        client_cache_stats["hits"],
+        client_cache_stats["misses"],
+        client_cache_stats["credentials"],
+        client_cache_stats["token_requests"],
+    )
@@ -1,70 +1,308 @@
-import base64
 import datetime
+import functools
 import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytz
 import logging
 import os
-from azure.identity import DefaultAzureCredential
-from azure.storage.queue import (
-    QueueClient,
-    BinaryBase64EncodePolicy,
-    BinaryBase64DecodePolicy,
-)
+from sqlalchemy import select
 from stock.data.model.database import SessionLocal
 from stock.data.model.crud import (
     get_eod_ingestor_data_store,
     get_exchanges,
-    get_ticker_by_exchange,
-    get_timezone,
 )
+from stock.data.model.models import ExchangeModel, TickerModel, TimezoneModel
+from . import metrics
+from .clients import get_file_system_client, get_queue_client, log_client_cache_stats
+from .costs import (
+    get_default_seconds_per_ticker,
+    get_exchange_cost,
+    get_shard_counts,
+)
+from .messages import MAX_MESSAGE_BYTES, encode_message
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SHARD_SIZE = int(os.getenv("EOD_CONTROLLER_SHARD_SIZE", "500"))
+SEND_CONCURRENCY = int(os.getenv("EOD_CONTROLLER_SEND_CONCURRENCY", "8"))
+MANIFEST_PATH = os.getenv("EOD_CONTROLLER_MANIFEST")
+MANIFEST_RETENTION_DAYS = int(os.getenv("EOD_CONTROLLER_MANIFEST_RETENTION_DAYS", "7"))
+BACKFILL_WINDOW_DAYS = int(os.getenv("EOD_CONTROLLER_BACKFILL_WINDOW_DAYS", "92"))
+
 
 def configure_eod_ingestor_controller_auth(storages_name, queue_name):
     """Get auth for EOD Ingestor Controller"""
     logger.info("Getting auth for EOD Ingestor Controller")
     global queue_service_client
-    default_credential = DefaultAzureCredential()
-    queue_service_client = QueueClient(
-        account_url="{}://{}.queue.core.windows.net".format("https", storages_name),
-        credential=default_credential,
-        queue_name=queue_name,
-        message_encode_policy=BinaryBase64EncodePolicy(),
-        message_decode_policy=BinaryBase64DecodePolicy(),
-    )
+    queue_service_client = get_queue_client(storages_name, queue_name)
 
 
 def add_message_to_queue(message):
     """Add message to queue"""
     logger.info("Adding message to queue")
-    queue_service_client.send_message(base64.b64encode(json.dumps(message).encode()))
+    queue_service_client.send_message(encode_message(message))
+
+
+def send_messages(messages, max_workers=None):
+    """Add messages to the queue concurrently"""
+    with metrics.timer("queue_send"), ThreadPoolExecutor(
+        max_workers=max_workers or SEND_CONCURRENCY
+    ) as executor:
+        list(executor.map(add_message_to_queue, messages))
+    metrics.increment("messages_sent_total", len(messages))
+
+
+def shard_tickers(tickers, shard_size=None, shard_count=None):
+    """Split tickers into the fewest shards of at most shard_size, evenly sized
+
+    A shard_count overrides the shard size.
+    """
+    shard_size = shard_size or SHARD_SIZE
+    shard_count = shard_count or max(1, math.ceil(len(tickers) / shard_size))
+    base_size, remainder = divmod(len(tickers), shard_count)
+    shards = []
+    start = 0
+    for shard in range(shard_count):
+        end = start + base_size + (1 if shard < remainder else 0)
+        shards.append(tickers[start:end])
+        start = end
+    return shards
+
+
+def spill_tickers(message):
+    """Move a message's tickers to a file in the datastore and reference it"""
+    file_name = "jobs/{}/{}/tickers-{}.txt".format(
+        message["date"], message["exchange_mic"], message["shard"]
+    )
+    logger.info("Spilling tickers to %s", file_name)
+    file_system_client = get_file_system_client(
+        message["eod_datastore_name"], message["eod_datastore_container"]
+    )
+    file_system_client.get_file_client(file_name).upload_data(
+        message.pop("tickers").encode(), overwrite=True
+    )
+    message["tickers_path"] = file_name
+    return message
+
+
+def create_shard_messages(message, tickers, shard_count=None, seconds_per_ticker=None):
+    """Create one message per ticker shard of an exchange
+
+    Shards carry their estimated_seconds when the exchange's cost is known.
+    """
+    shards = shard_tickers(tickers, shard_count=shard_count)
+    messages = []
+    for shard, shard_tickers_list in enumerate(shards):
+        shard_message = {
+            **message,
+            "shard": shard,
+            "shard_count": len(shards),
+            "tickers": ",".join(shard_tickers_list),
+        }
+        if seconds_per_ticker:
+            shard_message["estimated_seconds"] = round(
+                len(shard_tickers_list) * seconds_per_ticker, 3
+            )
+        if len(encode_message(shard_message)) > MAX_MESSAGE_BYTES:
+            shard_message = spill_tickers(shard_message)
+        messages.append(shard_message)
+    return messages
+
+
+def load_manifest(path=None):
+    """Load the (exchange mic, date) pairs already enqueued by this controller"""
+    path = path or MANIFEST_PATH
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest, path=None):
+    """Save the manifest, dropping entries older than the retention period"""
+    path = path or MANIFEST_PATH
+    if not path:
+        return
+    oldest = (
+        datetime.date.today() - datetime.timedelta(days=MANIFEST_RETENTION_DAYS)
+    ).strftime("%Y-%m-%d")
+    manifest = {key: date for key, date in manifest.items() if date >= oldest}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(f"{path}.tmp", path)
+
+
+def get_manifest_key(message):
+    """Get the manifest key of an exchange-date"""
+    return f'{message["exchange_mic"]}/{message["date"]}'
+
+
+def get_exchange_costs(messages, manifest, max_workers=None):
+    """Estimate the seconds per ticker of exchanges from their earlier runs
+
+    The dates this controller enqueued for an exchange are looked up first.
+    Exchanges without history get None.
+    """
+
+    def get_cost(message):
+        enqueued_dates = [
+            date
+            for key, date in manifest.items()
+            if key.startswith(f'{message["exchange_mic"]}/')
+        ]
+        return get_exchange_cost(message, enqueued_dates)
+
+    with metrics.timer("controller_costs"), ThreadPoolExecutor(
+        max_workers=max_workers or SEND_CONCURRENCY
+    ) as executor:
+        return list(executor.map(get_cost, messages))
+
+
+def create_cost_shard_messages(jobs, manifest):
+    """Shard exchanges into shards of about equal estimated cost
+
+    Returns the shard messages most expensive first, so the longest shards
+    start first and the slowest replica finishes as early as possible.
+    """
+    costs = get_exchange_costs([message for message, _ in jobs], manifest)
+    shard_counts = get_shard_counts(
+        [len(tickers) for _, tickers in jobs], costs, SHARD_SIZE
+    )
+    default = get_default_seconds_per_ticker(costs)
+    messages = []
+    for (message, tickers), cost, shard_count in zip(jobs, costs, shard_counts):
+        messages.extend(
+            create_shard_messages(message, tickers, shard_count, cost or default)
+        )
+    return sorted(
+        messages, key=lambda message: message.get("estimated_seconds", 0), reverse=True
+    )
+
+
+def get_exchange_tickers(db, exchanges):
+    """Get the timezone abbreviation and ticker symbols of exchanges in one query
+
+    Returns a dict of exchange id to ``(timezone abbr, [ticker, ...])``.
+    Exchanges without tickers are left out.
+    """
+    exchange_ids = [exchange.id for exchange in exchanges]
+    rows = db.execute(
+        select(TickerModel.exchange_id, TimezoneModel.abbr, TickerModel.ticker)
+        .join(ExchangeModel, TickerModel.exchange_id == ExchangeModel.id)
+        .join(TimezoneModel, ExchangeModel.timezone_id == TimezoneModel.id)
+        .where(TickerModel.exchange_id.in_(exchange_ids))
+        .order_by(TickerModel.exchange_id, TickerModel.id)
+    )
+    exchange_tickers = {}
+    for exchange_id, abbr, ticker in rows:
+        exchange_tickers.setdefault(exchange_id, (abbr, []))[1].append(ticker)
+    return exchange_tickers
+
+
+@functools.lru_cache(maxsize=None)
+def get_pytz_timezone(abbr):
+    """Get a pytz timezone, memoized by abbreviation"""
+    return pytz.timezone(abbr)
+
+
+def get_job_message(exchange, eod_datastore, date, type="EOD"):
+    """Get the job message for an exchange, without its tickers"""
+    return {
+        "exchange": exchange.name,
+        "exchange_mic": exchange.mic,
+        "date": date,
+        "type": type,
+        "eod_datastore_id": os.getenv("EOD_DATASTORE_ID"),
+        "eod_datastore_name": eod_datastore.name,
+        "eod_datastore_container": eod_datastore.container,
+        "partition_by_date": "true",
+        "output_format": os.getenv("EOD_OUTPUT_FORMAT", "json"),
+    }
+
+
+def get_backfill_windows(date_from, date_to, window_days=None):
+    """Split an inclusive date range into windows of at most window_days days"""
+    window = datetime.timedelta(days=(window_days or BACKFILL_WINDOW_DAYS) - 1)
+    start = datetime.date.fromisoformat(date_from)
+    end = datetime.date.fromisoformat(date_to)
+    windows = []
+    while start <= end:
+        stop = min(start + window, end)
+        windows.append((start.isoformat(), stop.isoformat()))
+        start = stop + datetime.timedelta(days=1)
+    return windows
 
 
 def create_job_messages(db, exchanges):
     logger.info("Creating job messages")
-    eod_datastore = get_eod_ingestor_data_store(db, os.getenv("EOD_DATASTORE_ID"))
+    db_started = time.perf_counter()
+    with metrics.timer("controller_db"):
+        eod_datastore = get_eod_ingestor_data_store(db, os.getenv("EOD_DATASTORE_ID"))
+        exchange_tickers = get_exchange_tickers(db, exchanges)
+    db_time = time.perf_counter() - db_started
+
+    manifest = load_manifest()
+    enqueued = {}
+    jobs = []
     for exchange in exchanges:
-        tickers = get_ticker_by_exchange(db, exchange.id)
-        if len(tickers) == 0:
+        if exchange.id not in exchange_tickers:
             continue
+        abbr, tickers = exchange_tickers[exchange.id]
         logger.info("Processing exchange: {}".format(exchange.name))
-        message = {
-            "exchange": exchange.name,
-            "exchange_mic": exchange.mic,
-            "date": datetime.datetime.now(
-                pytz.timezone(get_timezone(db, exchange.timezone_id).abbr)
-            ).strftime("%Y-%m-%d"),
-            "type": "EOD",
-            "eod_datastore_id": os.getenv("EOD_DATASTORE_ID"),
-            "eod_datastore_name": eod_datastore.name,
-            "eod_datastore_container": eod_datastore.container,
-            "partition_by_date": "true",
-            "tickers": ",".join([ticker.ticker for ticker in tickers]),
-        }
-        add_message_to_queue(message)
+        message = get_job_message(
+            exchange,
+            eod_datastore,
+            datetime.datetime.now(get_pytz_timezone(abbr)).strftime("%Y-%m-%d"),
+        )
+        if get_manifest_key(message) in manifest:
+            logger.info("Already enqueued %s, skipping", get_manifest_key(message))
+            continue
+        enqueued[get_manifest_key(message)] = message["date"]
+        jobs.append((message, tickers))
+
+    messages = create_cost_shard_messages(jobs, manifest)
+    logger.info("Sending %s job messages", len(messages))
+    queue_started = time.perf_counter()
+    send_messages(messages)
+    save_manifest({**manifest, **enqueued})
+    logger.info(
+        "Created job messages for %s exchanges: db %.3fs, queue %.3fs",
+        len(exchange_tickers),
+        db_time,
+        time.perf_counter() - queue_started,
+    )
+
+
+def create_backfill_messages(db, exchanges, date_from, date_to):
+    """Create job messages that backfill a date range for every exchange
+
+    Each message covers BACKFILL_WINDOW_DAYS of a shard's tickers; the worker
+    fetches the whole window with date_from/date_to and splits the rows into
+    daily partitions.
+    """
+    logger.info("Creating backfill messages from %s to %s", date_from, date_to)
+    eod_datastore = get_eod_ingestor_data_store(db, os.getenv("EOD_DATASTORE_ID"))
+    exchange_tickers = get_exchange_tickers(db, exchanges)
+    messages = []
+    for exchange in exchanges:
+        if exchange.id not in exchange_tickers:
+            continue
+        _, tickers = exchange_tickers[exchange.id]
+        for window_from, window_to in get_backfill_windows(date_from, date_to):
+            message = get_job_message(
+                exchange, eod_datastore, window_to, type="EOD_BACKFILL"
+            )
+            message["date_from"] = window_from
+            message["date_to"] = window_to
+            messages.extend(create_shard_messages(message, tickers))
+
+    logger.info("Sending %s backfill messages", len(messages))
+    send_messages(messages)
 
 
 def main():
@@ -75,8 +313,19 @@ def main():
         os.getenv("EOD_INGESTOR_STROAGE_NAME"),
         os.getenv("EOD_INGESTOR_STROAGE_QUEUE"),
     )
-    create_job_messages(db, exchanges)
+    if os.getenv("EOD_BACKFILL_FROM"):
+        create_backfill_messages(
+            db,
+            exchanges,
+            os.getenv("EOD_BACKFILL_FROM"),
+            os.getenv("EOD_BACKFILL_TO", datetime.date.today().isoformat()),
+        )
+    else:
+        create_job_messages(db, exchanges)
+    log_client_cache_stats()
+    metrics.write_textfile()
     logger.info("EOD Ingestor Controller finished")
-    
+
+
 if __name__ == "__main__":
     main()
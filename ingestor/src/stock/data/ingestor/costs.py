@@ -0,0 +1,131 @@
+import datetime
+import logging
+import math
+import os
+import posixpath
+import statistics
+from . import serialization
+from .clients import get_file_system_client
+from .messages import get_file_name_preffix
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COST_LOOKBACK_DAYS = int(os.getenv("EOD_CONTROLLER_COST_LOOKBACK_DAYS", "5"))
+
+
+def get_status_costs(file_system_client, file_name_preffix):
+    """Get the seconds and tickers recorded by the status files of a partition
+
+    Status files whose summary does not count tickers are skipped.
+    """
+    from azure.core.exceptions import ResourceNotFoundError
+
+    try:
+        paths = [
+            path.name
+            for path in file_system_client.get_paths(
+                path=file_name_preffix, recursive=False
+            )
+            if posixpath.basename(path.name).startswith("EODSTATUS")
+        ]
+    except ResourceNotFoundError:
+        return 0.0, 0
+    seconds = 0.0
+    tickers = 0
+    for path in paths:
+        file_client = file_system_client.get_file_client(path)
+        status = serialization.loads(file_client.download_file().readall())
+        summary = status.get("summary") or {}
+        # Older status files only counted rows, which are not comparable
+        if "tickers" not in summary:
+            continue
+        seconds += summary.get("total_seconds", 0)
+        tickers += summary["tickers"]
+    return seconds, tickers
+
+
+def get_history_dates(message, enqueued_dates=(), lookback_days=None):
+    """Get the earlier dates to look for an exchange's costs, newest first
+
+    Dates the controller enqueued are used when it keeps a manifest; otherwise
+    the preceding calendar days are tried.
+    """
+    lookback_days = lookback_days or COST_LOOKBACK_DAYS
+    dates = sorted(
+        (date for date in enqueued_dates if date < message["date"]), reverse=True
+    )
+    if not dates:
+        day = datetime.date.fromisoformat(message["date"])
+        dates = [
+            (day - datetime.timedelta(days=days)).isoformat()
+            for days in range(1, lookback_days + 1)
+        ]
+    return dates[:lookback_days]
+
+
+def get_seconds_per_ticker(file_system_client, message, dates):
+    """Get an exchange's seconds per ticker from its newest run with costs"""
+    for date in dates:
+        file_name_preffix = get_file_name_preffix({**message, "date": date})
+        seconds, tickers = get_status_costs(file_system_client, file_name_preffix)
+        if seconds and tickers:
+            return seconds / tickers
+    return None
+
+
+def get_exchange_cost(message, enqueued_dates=()):
+    """Get an exchange's seconds per ticker from the status files of its datastore
+
+    An exchange whose status files cannot be listed or read gets None, like
+    one without history, so it cannot hold up the other exchanges' jobs.
+    """
+    from azure.core.exceptions import AzureError
+
+    try:
+        file_system_client = get_file_system_client(
+            message["eod_datastore_name"], message["eod_datastore_container"]
+        )
+        return get_seconds_per_ticker(
+            file_system_client, message, get_history_dates(message, enqueued_dates)
+        )
+    except (AzureError, ValueError) as e:
+        logger.warning(
+            "Error reading the costs of %s, using the default: %s",
+            message["exchange_mic"],
+            e,
+        )
+        return None
+
+
+def get_default_seconds_per_ticker(costs):
+    """Get the cost to assume for exchanges without history"""
+    known = [cost for cost in costs if cost]
+    return statistics.median(known) if known else None
+
+
+def get_shard_count(ticker_count, seconds_per_ticker, target_seconds):
+    """Get how many shards split an exchange into pieces of about target_seconds"""
+    if not ticker_count:
+        return 1
+    shard_count = math.ceil(ticker_count * seconds_per_ticker / target_seconds)
+    return min(ticker_count, max(1, shard_count))
+
+
+def get_shard_counts(ticker_counts, costs, shard_size):
+    """Get shard counts that give every exchange's shards about the same cost
+
+    The target cost of a shard is what shard_size tickers take at the median
+    seconds per ticker, which exchanges without history are assumed to take.
+    Without any history, exchanges are split into shards of shard_size.
+    """
+    default = get_default_seconds_per_ticker(costs)
+    shard_counts = []
+    for ticker_count, cost in zip(ticker_counts, costs):
+        if default is None:
+            shard_counts.append(max(1, math.ceil(ticker_count / shard_size)))
+        else:
+            shard_counts.append(
+                get_shard_count(ticker_count, cost or default, shard_size * default)
+            )
+    return shard_counts
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import logging
+from collections import Counter
+from . import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EOD_KEY = ("symbol", "date", "exchange")
+TICKER_KEY = ("symbol",)
+EXCHANGE_KEY = ("mic",)
+CURRENCY_KEY = ("code",)
+TIMEZONE_KEY = ("timezone",)
+
+
+def get_content_hash(record):
+    """Get a digest of the full content of a record"""
+    if not isinstance(record, dict):
+        record = record.to_dict()
+    content = json.dumps(record, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+def get_record_key(record, key_fields=None):
+    """Get the natural key of a record, falling back to its content hash
+
+    Records may be dicts or objects with the key fields as attributes.
+    """
+    if key_fields:
+        if isinstance(record, dict):
+            key = tuple(record.get(field) for field in key_fields)
+        else:
+            key = tuple(getattr(record, field, None) for field in key_fields)
+        if not any(value is None or isinstance(value, (dict, list)) for value in key):
+            return key
+    return get_content_hash(record)
+
+
+def unique_records(records, key_fields=None, stats=None):
+    """Yield records whose key has not been seen yet, in first-seen order
+
+    Records are keyed on ``key_fields``; records missing any of them, or every
+    record when no key fields are given, are keyed on a hash of their content.
+    ``stats`` is an optional Counter updated with ``rows`` and ``duplicates``.
+    """
+    stats = stats if stats is not None else Counter()
+    seen = set()
+    for record in records:
+        stats["rows"] += 1
+        key = get_record_key(record, key_fields)
+        if key in seen:
+            stats["duplicates"] += 1
+            continue
+        seen.add(key)
+        yield record
+
+
+def remove_dupes(data, key_fields=None):
+    """Remove duplicate records, keeping the first one seen"""
+    stats = Counter()
+    with metrics.timer("dedupe"):
+        new_d = list(unique_records(data, key_fields, stats))
+    metrics.increment("dedupe_duplicates_total", stats["duplicates"])
+    if stats["duplicates"]:
+        logger.info(
+            "Dropped %s duplicates out of %s rows", stats["duplicates"], stats["rows"]
+        )
+    return new_d
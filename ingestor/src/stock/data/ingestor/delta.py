@@ -0,0 +1,203 @@
+import logging
+import os
+from . import metrics, serialization
+from .dedupe import get_content_hash
+from .records import as_eod_records
+from .writers import (
+    PER_SYMBOL_FORMATS,
+    get_output_writer,
+    get_symbol_file_name,
+    iter_output_files,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+HASHES_FILE_NAME = "EODHASHES"
+SKIP_UNCHANGED = os.getenv("EOD_INGESTOR_SKIP_UNCHANGED", "true").lower() == "true"
+
+
+def get_hashes_path(file_name_preffix, hashes_file_name):
+    """Get the path of a partition's hash manifest, if unchanged files are skipped"""
+    if hashes_file_name is None or not SKIP_UNCHANGED:
+        return None
+    return f"{file_name_preffix}/{hashes_file_name}.json"
+
+
+def load_hashes(file_system_client, file_name):
+    """Load the hash manifest a partition was last written with, if any"""
+    from azure.core.exceptions import ResourceNotFoundError
+
+    file_client = file_system_client.get_file_client(file_name)
+    try:
+        return serialization.loads(file_client.download_file().readall())
+    except ResourceNotFoundError:
+        return None
+
+
+async def load_hashes_async(file_system_client, file_name):
+    """Load a partition's hash manifest with an async file system client"""
+    from azure.core.exceptions import ResourceNotFoundError
+
+    file_client = file_system_client.get_file_client(file_name)
+    try:
+        download = await file_client.download_file()
+        return serialization.loads(await download.readall())
+    except ResourceNotFoundError:
+        return None
+
+
+def get_hashes_file_contents(output_format, hashes, files):
+    """Get the hash manifest of every symbol's record and the files holding them"""
+    return serialization.dumps(
+        {
+            "output_format": output_format,
+            "symbols": hashes,
+            "files": {file["file_name"]: file["bytes"] for file in files},
+        }
+    )
+
+
+def save_hashes(file_system_client, file_name, output_format, hashes, files):
+    """Save the hash of every symbol's record and the files holding them"""
+    file_client = file_system_client.get_file_client(file_name)
+    file_client.upload_data(
+        get_hashes_file_contents(output_format, hashes, files), overwrite=True
+    )
+
+
+async def save_hashes_async(
+    file_system_client, file_name, output_format, hashes, files
+):
+    """Save a partition's hash manifest with an async file system client"""
+    file_client = file_system_client.get_file_client(file_name)
+    await file_client.upload_data(
+        get_hashes_file_contents(output_format, hashes, files), overwrite=True
+    )
+
+
+def get_resumed_hashes(previous, output_format, file_name_preffix, previous_files):
+    """Get the previous manifest's hashes of the symbols an earlier run saved
+
+    A resumed run only fetches the symbols that are still missing, so the
+    manifest it saves keeps the entries of the files saved before it.
+    """
+    if not previous_files or previous is None:
+        return {}
+    if previous.get("output_format") != output_format:
+        return {}
+    saved = {file["file_name"] for file in previous_files}
+    return {
+        symbol: content_hash
+        for symbol, content_hash in previous["symbols"].items()
+        if get_symbol_file_name(file_name_preffix, symbol) in saved
+    }
+
+
+class DeltaWriter:
+    """Wrap an output writer so it only writes records changed since a manifest
+
+    The hash of every record is added to ``hashes`` by symbol. Files left out
+    because their records are unchanged are appended to ``skipped`` with the
+    byte count they were stored with. A per-symbol layout only writes the
+    changed symbols; a consolidated file is written unless every record is
+    unchanged.
+    """
+
+    def __init__(
+        self,
+        writer,
+        file_name_preffix,
+        output_format,
+        file_name,
+        previous,
+        hashes,
+        skipped,
+    ):
+        if previous is None or previous.get("output_format") != output_format:
+            previous = {"symbols": {}, "files": {}}
+        self.writer = writer
+        self.file_name_preffix = file_name_preffix
+        self.per_symbol = output_format in PER_SYMBOL_FORMATS
+        self.hashes = hashes
+        self.skipped = skipped
+        self._previous_hashes = previous["symbols"]
+        self._previous_files = previous["files"]
+        self._consolidated_files = [
+            {"file_name": name, "bytes": size}
+            for name, size in self._previous_files.items()
+            if name.startswith(f"{file_name_preffix}/{file_name}.")
+        ]
+        self._records = 0
+        self._changed = False
+
+    def _hash_records(self, eod_data):
+        for eod in eod_data:
+            self.hashes[eod.symbol] = get_content_hash(eod).hex()
+            self._records += 1
+            yield eod, self._previous_hashes.get(eod.symbol) == self.hashes[eod.symbol]
+
+    def _changed_records(self, eod_data):
+        for eod, unchanged in self._hash_records(eod_data):
+            if self.per_symbol:
+                symbol_file_name = get_symbol_file_name(
+                    self.file_name_preffix, eod.symbol
+                )
+                if unchanged and symbol_file_name in self._previous_files:
+                    self.skipped.append(
+                        {
+                            "file_name": symbol_file_name,
+                            "bytes": self._previous_files[symbol_file_name],
+                        }
+                    )
+                    continue
+            elif not unchanged:
+                self._changed = True
+            yield eod
+
+    def write(self, eod_data):
+        return self.writer.write(self._changed_records(eod_data))
+
+    def close(self):
+        files = self.writer.close()
+        if (
+            not self.per_symbol
+            and self._records
+            and self._consolidated_files
+            and not self._changed
+            and self.hashes == self._previous_hashes
+        ):
+            self.skipped.extend(self._consolidated_files)
+            return []
+        return files
+
+
+def get_changed_output_files(
+    file_name_preffix, eod_data, output_format, file_name, previous, hashes, skipped
+):
+    """Get the output files whose records changed since the previous manifest
+
+    See DeltaWriter for how ``hashes`` and ``skipped`` are filled in.
+    """
+    writer = DeltaWriter(
+        get_output_writer(file_name_preffix, output_format, file_name),
+        file_name_preffix,
+        output_format,
+        file_name,
+        previous,
+        hashes,
+        skipped,
+    )
+    return iter_output_files(writer, as_eod_records(eod_data))
+
+
+def count_skipped(skipped, summary=None):
+    """Count the files and bytes that did not need to be uploaded"""
+    skipped_bytes = sum(file["bytes"] for file in skipped)
+    if skipped:
+        logger.info("Skipped %s unchanged files", len(skipped))
+    metrics.increment("files_skipped_total", len(skipped))
+    metrics.increment("skipped_bytes_total", skipped_bytes)
+    if summary is not None:
+        summary["skipped_files"] += len(skipped)
+        summary["skipped_bytes"] += skipped_bytes
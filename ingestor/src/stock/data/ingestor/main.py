@@ -1,13 +1,10 @@
-import requests
+import datetime
 import logging
 import os
+from collections import Counter
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql
 from stock.data.model.database import SessionLocal
-from stock.data.model.crud import (
-    get_city,
-    get_country,
-    get_exchange,
-    get_timezone,
-)
 from stock.data.model.models import (
     CityModel,
     CountryModel,
@@ -17,57 +14,58 @@ from stock.data.model.models import (
     TickerModel,
     TimezoneModel,
 )
+from . import marketstack
+from .dedupe import (
+    CURRENCY_KEY,
+    EOD_KEY,
+    EXCHANGE_KEY,
+    TICKER_KEY,
+    TIMEZONE_KEY,
+    remove_dupes,
+)
+from .marketstack import DEFAULT_PARAMS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-DEFAULT_PARAMS = {"access_key": os.getenv("MARKETSTACK_API_KEY"), "limit": 1000}
 MAX_PAGES = 100
-MARKETSTACK_API = "http://api.marketstack.com/v1"
+SEED_BATCH_SIZE = int(os.getenv("SEED_BATCH_SIZE", "1000"))
+SEED_MODE = os.getenv("SEED_MODE", "insert")
+SEED_DELETE_MISSING = os.getenv("SEED_DELETE_MISSING", "false").lower() == "true"
+SOFT_DELETE_COLUMNS = ("is_active", "active", "deleted_at")
 
 
-def get_requests_with_offset(endpoint, initial_offset):
+def get_requests_with_offset(endpoint, initial_offset, key_fields=None, refresh=False):
     offset = initial_offset
     data = []
+    pages = 0
     while True:
-        _data = requests.get(
-            f"{MARKETSTACK_API}/{endpoint}", params={**DEFAULT_PARAMS, "offset": offset}
-        ).json()
+        _data = marketstack.get_cached(endpoint, {"offset": offset}, refresh=refresh)
         data.extend(_data["data"])
-        if (
-            DEFAULT_PARAMS["limit"] > _data["pagination"]["count"]
-            or offset >= MAX_PAGES
-        ):
+        pages += 1
+        if DEFAULT_PARAMS["limit"] > _data["pagination"]["count"] or pages >= MAX_PAGES:
             break
-        offset += 1
-
-    return {"data": remove_dupes(data)}
-
+        offset += DEFAULT_PARAMS["limit"]
 
-def remove_dupes(data):
-    new_d = []
-    for x in data:
-        if x not in new_d:
-            new_d.append(x)
-    return new_d
+    return {"data": remove_dupes(data, key_fields)}
 
 
 def get_ext_timezones_list():
     """Get list of timezones from Marketstack API"""
     logger.info("Getting list of timezones from Marketstack API")
-    return get_requests_with_offset("timezones", 0)
+    return get_requests_with_offset("timezones", 0, TIMEZONE_KEY)
 
 
 def get_ext_currencies_list():
     """Get list of currencies from Marketstack API"""
     logger.info("Getting list of currencies from Marketstack API")
-    return get_requests_with_offset("currencies", 0)
+    return get_requests_with_offset("currencies", 0, CURRENCY_KEY)
 
 
 def get_ext_exchanges_list():
     """Get list of exchanges from Marketstack API"""
     logger.info("Getting list of exchanges from Marketstack API")
-    _exchanges = get_requests_with_offset("exchanges", 0)
+    _exchanges = get_requests_with_offset("exchanges", 0, EXCHANGE_KEY)
     exchanges = []
     for exchange in _exchanges["data"]:
         if exchange["name"] != "INDEX":
@@ -104,7 +102,7 @@ def get_ext_cities_list():
 def get_ext_tickers_list():
     """Get list of tickers from Marketstack API"""
     logger.info("Getting list of tickers from Marketstack API")
-    tickers = get_requests_with_offset("tickers", 0)
+    tickers = get_requests_with_offset("tickers", 0, TICKER_KEY)
     return {"data": tickers["data"]}
 
 
@@ -112,101 +110,335 @@ def get_ext_eod_exchange(exchange, date=None):
     """Get EOD data for an exchange from Marketstack API"""
     logger.info("Get EOD data for an exchange from Marketstack API")
     if date is not None:
-        tickers = get_requests_with_offset(f"exchange/{exchange.mic}/eod/{date}", 0)
+        tickers = get_requests_with_offset(
+            f"exchange/{exchange.mic}/eod/{date}", 0, EOD_KEY, True
+        )
     else:
-        tickers = get_requests_with_offset(f"exchange/{exchange.mic}/eod/latest", 0)
+        tickers = get_requests_with_offset(
+            f"exchange/{exchange.mic}/eod/latest", 0, EOD_KEY, True
+        )
     return {"data": tickers["data"]}
 
 
-def seed_tickers():
+def get_name_lookup(db, model):
+    """Get a name to id dictionary for a reference table, keeping the first id"""
+    lookup = {}
+    for id, name in db.execute(select(model.id, model.name).order_by(model.id)):
+        lookup.setdefault(name, id)
+    return lookup
+
+
+def get_city_lookup(db):
+    """Get a (name, country id) to id dictionary for cities"""
+    lookup = {}
+    for id, name, country_id in db.execute(
+        select(CityModel.id, CityModel.name, CityModel.country_id).order_by(
+            CityModel.id
+        )
+    ):
+        lookup.setdefault((name, country_id), id)
+    return lookup
+
+
+def bulk_insert(db, model, rows, batch_size=None):
+    """Insert rows in batches of batch_size and commit"""
+    batch_size = batch_size or SEED_BATCH_SIZE
+    for i in range(0, len(rows), batch_size):
+        db.bulk_insert_mappings(model, rows[i : i + batch_size])
+    db.commit()
+    logger.info("Inserted %s %s rows", len(rows), model.__tablename__)
+    return len(rows)
+
+
+def insert_rows(db, model, rows, batch_size=None):
+    """Insert new rows, skipping conflicting ones on Postgres
+
+    Returns how many rows were inserted.
+    """
+    batch_size = batch_size or SEED_BATCH_SIZE
+    on_postgres = db.get_bind().dialect.name == "postgresql"
+    inserted = 0
+    for i in range(0, len(rows), batch_size):
+        if on_postgres:
+            result = db.execute(
+                postgresql.insert(model)
+                .values(rows[i : i + batch_size])
+                .on_conflict_do_nothing()
+            )
+            inserted += result.rowcount
+        else:
+            db.bulk_insert_mappings(model, rows[i : i + batch_size])
+            inserted += len(rows[i : i + batch_size])
+    return inserted
+
+
+def get_soft_delete_column(model):
+    """Get the column a model's rows are soft deleted with, if it has one"""
+    for column in SOFT_DELETE_COLUMNS:
+        if hasattr(model, column):
+            return column
+    return None
+
+
+def get_soft_delete_value(column, deleted):
+    """Get the value of a soft delete column for a deleted or restored row"""
+    if column == "deleted_at":
+        return datetime.datetime.utcnow() if deleted else None
+    return not deleted
+
+
+def is_soft_deleted(column, value):
+    """Tell whether a soft delete column's value marks its row as deleted"""
+    if column == "deleted_at":
+        return value is not None
+    return value is False
+
+
+def soft_delete_rows(db, model, ids):
+    """Mark rows as deleted using the model's soft delete column"""
+    column = get_soft_delete_column(model)
+    if column is not None:
+        value = get_soft_delete_value(column, deleted=True)
+        db.execute(update(model).where(model.id.in_(ids)).values({column: value}))
+        return len(ids)
+    logger.warning(
+        "%s has no soft delete column, keeping %s missing rows",
+        model.__tablename__,
+        len(ids),
+    )
+    return 0
+
+
+def sync_rows(
+    db,
+    model,
+    rows,
+    key_fields,
+    delete_missing=None,
+    batch_size=None,
+    failed_keys=(),
+):
+    """Sync rows into a table by natural key
+
+    Rows whose key is not in the table are inserted, rows whose columns
+    differ are updated and, with ``delete_missing``, rows that were not
+    fetched are soft deleted. Soft deleted rows that are fetched again are
+    restored and counted as updated. Returns the count of each.
+
+    ``failed_keys`` are the keys of rows that were fetched but could not be
+    seeded; they are kept, as is every row when nothing was fetched at all.
+    """
+    if delete_missing is None:
+        delete_missing = SEED_DELETE_MISSING
+    if delete_missing and not rows:
+        logger.warning("No %s rows to sync, keeping existing rows", model.__tablename__)
+        delete_missing = False
+    fields = list(rows[0]) if rows else list(key_fields)
+    soft_delete_column = get_soft_delete_column(model)
+    columns = fields + ([soft_delete_column] if soft_delete_column else [])
+    existing = {}
+    for current in db.execute(
+        select(model.id, *[getattr(model, column) for column in columns])
+    ).mappings():
+        existing.setdefault(tuple(current[field] for field in key_fields), current)
+
+    counts = Counter()
+    inserts = []
+    updates = []
+    seen = set(failed_keys)
+    for row in rows:
+        key = tuple(row[field] for field in key_fields)
+        if key in seen:
+            continue
+        seen.add(key)
+        current = existing.get(key)
+        if current is None:
+            inserts.append(row)
+        elif soft_delete_column and is_soft_deleted(
+            soft_delete_column, current[soft_delete_column]
+        ):
+            restored = get_soft_delete_value(soft_delete_column, deleted=False)
+            updates.append({"id": current["id"], **row, soft_delete_column: restored})
+        elif any(current[field] != row[field] for field in fields):
+            updates.append({"id": current["id"], **row})
+        else:
+            counts["unchanged"] += 1
+
+    counts["inserted"] = insert_rows(db, model, inserts, batch_size)
+    db.bulk_update_mappings(model, updates)
+    counts["updated"] = len(updates)
+    if delete_missing:
+        missing = [
+            current["id"]
+            for key, current in existing.items()
+            if key not in seen
+            and not (
+                soft_delete_column
+                and is_soft_deleted(soft_delete_column, current[soft_delete_column])
+            )
+        ]
+        counts["deleted"] = soft_delete_rows(db, model, missing) if missing else 0
+    db.commit()
+    logger.info(
+        "Synced %s: %s inserted, %s updated, %s unchanged, %s deleted",
+        model.__tablename__,
+        counts["inserted"],
+        counts["updated"],
+        counts["unchanged"],
+        counts["deleted"],
+    )
+    return counts
+
+
+def seed_rows(db, model, rows, key_fields, batch_size=None, mode=None, failed_keys=()):
+    """Save seeded rows, either as plain inserts or as a sync by natural key
+
+    A sync keeps the rows of ``failed_keys``, which were fetched but not seeded.
+    """
+    if (mode or SEED_MODE) == "sync":
+        return sync_rows(
+            db, model, rows, key_fields, batch_size=batch_size, failed_keys=failed_keys
+        )
+    return Counter(inserted=bulk_insert(db, model, rows, batch_size))
+
+
+def log_failed_rows(kind, failed):
+    """Log the rows that could not be seeded, grouped by reason"""
+    if not failed:
+        return
+    reasons = Counter(reason for _, reason in failed)
+    logger.warning(
+        "Skipped %s %s: %s",
+        len(failed),
+        kind,
+        ", ".join(f"{count} {reason}" for reason, count in reasons.items()),
+    )
+    logger.debug("Skipped %s: %s", kind, failed)
+
+
+def seed_tickers(batch_size=None, mode=None):
     """Seed tickers in database"""
     logger.info("Seeding tickers in database")
     db = SessionLocal()
     tickers = get_ext_tickers_list()
+    exchange_ids = get_name_lookup(db, ExchangeModel)
+    rows = []
+    failed = []
     for ticker in tickers["data"]:
-        try:
-            db_ticker = TickerModel(
-                name=ticker["name"],
-                ticker=ticker["symbol"],
-                exchange_id=get_exchange(db, name=ticker["stock_exchange"]["name"]).id,
-            )
-            db.add(db_ticker)
-        except Exception as e:
-            logger.warning(f'Error seeding ticker {ticker["symbol"]}: {e}')
-    db.commit()
+        exchange_id = exchange_ids.get((ticker.get("stock_exchange") or {}).get("name"))
+        if exchange_id is None:
+            failed.append((ticker["symbol"], "unknown exchange"))
+            continue
+        rows.append(
+            {
+                "name": ticker["name"],
+                "ticker": ticker["symbol"],
+                "exchange_id": exchange_id,
+            }
+        )
+    failed_keys = [(symbol,) for symbol, _ in failed]
+    seed_rows(db, TickerModel, rows, ("ticker",), batch_size, mode, failed_keys)
+    log_failed_rows("tickers", failed)
+    return failed
 
 
-def seed_cities():
+def seed_cities(batch_size=None, mode=None):
     """Seed cities in database"""
     logger.info("Seeding cities in database")
     db = SessionLocal()
     cities = get_ext_cities_list()
+    country_ids = get_name_lookup(db, CountryModel)
+    rows = []
+    failed = []
     for city in cities["data"]:
-        db_city = CityModel(
-            name=city["name"], country_id=get_country(db, name=city["country"]).id
-        )
-        db.add(db_city)
-    db.commit()
+        if city["country"] not in country_ids:
+            failed.append((city["name"], "unknown country"))
+            continue
+        rows.append({"name": city["name"], "country_id": country_ids[city["country"]]})
+    seed_rows(db, CityModel, rows, ("name", "country_id"), batch_size, mode)
+    log_failed_rows("cities", failed)
+    return failed
 
 
-def seed_countries():
+def seed_countries(batch_size=None, mode=None):
     """Seed countries in database"""
     logger.info("Seeding countries in database")
     db = SessionLocal()
     countries = get_ext_countries_list()
-    for country in countries["data"]:
-        db_country = CountryModel(name=country["name"], code=country["code"])
-        db.add(db_country)
-    db.commit()
+    rows = [
+        {"name": country["name"], "code": country["code"]}
+        for country in countries["data"]
+    ]
+    seed_rows(db, CountryModel, rows, ("name",), batch_size, mode)
 
 
-def seed_exchanges():
+def seed_exchanges(batch_size=None, mode=None):
     """Seed exchanges in database"""
     logger.info("Seeding exchanges in database")
     db = SessionLocal()
     exchanges = get_ext_exchanges_list()
+    country_ids = get_name_lookup(db, CountryModel)
+    city_ids = get_city_lookup(db)
+    timezone_ids = get_name_lookup(db, TimezoneModel)
+    rows = []
+    failed = []
+    failed_keys = []
     for exchange in exchanges["data"]:
-        try:
-            db_exchange = ExchangeModel(
-                name=exchange["name"],
-                acronym=exchange["acronym"],
-                mic=exchange["mic"],
-                country_id=get_country(db, name=exchange["country"]).id,
-                city_id=get_city(
-                    db,
-                    name=exchange["city"],
-                    country_id=get_country(db, name=exchange["country"]).id,
-                ).id,
-                timezone_id=get_timezone(db, name=exchange["timezone"]["timezone"]).id,
-            )
-            db.add(db_exchange)
-        except Exception as e:
-            logger.warning(f'Error seeding exchange {exchange["name"]}: {e}')
-    db.commit()
+        country_id = country_ids.get(exchange["country"])
+        city_id = city_ids.get((exchange["city"], country_id))
+        timezone_id = timezone_ids.get((exchange.get("timezone") or {}).get("timezone"))
+        reason = None
+        if country_id is None:
+            reason = "unknown country"
+        elif city_id is None:
+            reason = "unknown city"
+        elif timezone_id is None:
+            reason = "unknown timezone"
+        if reason is not None:
+            failed.append((exchange["name"], reason))
+            failed_keys.append((exchange["mic"],))
+            continue
+        rows.append(
+            {
+                "name": exchange["name"],
+                "acronym": exchange["acronym"],
+                "mic": exchange["mic"],
+                "country_id": country_id,
+                "city_id": city_id,
+                "timezone_id": timezone_id,
+            }
+        )
+    seed_rows(db, ExchangeModel, rows, ("mic",), batch_size, mode, failed_keys)
+    log_failed_rows("exchanges", failed)
+    return failed
 
 
-def seed_currencies():
+def seed_currencies(batch_size=None, mode=None):
     """Seed currencies in database"""
     logger.info("Seeding currencies in database")
     db = SessionLocal()
     currencies = get_ext_currencies_list()
-    for currency in currencies["data"]:
-        db_currency = CurrencyModel(name=currency["name"], code=currency["code"])
-        db.add(db_currency)
-    db.commit()
+    rows = [
+        {"name": currency["name"], "code": currency["code"]}
+        for currency in currencies["data"]
+    ]
+    seed_rows(db, CurrencyModel, rows, ("code",), batch_size, mode)
 
 
-def seed_timezones():
+def seed_timezones(batch_size=None, mode=None):
     """Seed timezones in database"""
     logger.info("Seeding timezones in database")
     db = SessionLocal()
     timezones = get_ext_timezones_list()
-    for timezone in timezones["data"]:
-        db_timezone = TimezoneModel(
-            name=timezone["timezone"], abbr=timezone["abbr"], dst=timezone["abbr_dst"]
-        )
-        db.add(db_timezone)
-    db.commit()
+    rows = [
+        {
+            "name": timezone["timezone"],
+            "abbr": timezone["abbr"],
+            "dst": timezone["abbr_dst"],
+        }
+        for timezone in timezones["data"]
+    ]
+    seed_rows(db, TimezoneModel, rows, ("name",), batch_size, mode)
 
 
 def seed_eod_ingestor_datastore():
@@ -227,6 +459,8 @@ def seed_eod_ingestor_datastore():
 def main():
     """Main function"""
     logger.info("Starting Seeding EOD Ingestor")
+    if marketstack.CACHE_REFRESH:
+        marketstack.clear_cache()
 
     # seed_timezones()
     # seed_currencies()
@@ -236,7 +470,9 @@ def main():
     # seed_tickers()
     # seed_eod_ingestor_datastore()
 
+    marketstack.log_request_stats()
     logger.info("EOD Ingestor finished")
 
 
-main()
+if __name__ == "__main__":
+    main()
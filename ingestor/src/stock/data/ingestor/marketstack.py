@@ -0,0 +1,264 @@
+import datetime
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+import requests
+from requests.adapters import HTTPAdapter
+from . import metrics, ratelimit, serialization
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARAMS = {"access_key": os.getenv("MARKETSTACK_API_KEY"), "limit": 1000}
+MARKETSTACK_API = os.getenv("MARKETSTACK_API", "http://api.marketstack.com/v1")
+POOL_SIZE = int(os.getenv("MARKETSTACK_POOL_SIZE", "10"))
+TIMEOUT = (
+    float(os.getenv("MARKETSTACK_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("MARKETSTACK_READ_TIMEOUT", "30")),
+)
+MAX_RETRIES = int(os.getenv("MARKETSTACK_MAX_RETRIES", "5"))
+BACKOFF_FACTOR = float(os.getenv("MARKETSTACK_BACKOFF_FACTOR", "0.5"))
+BACKOFF_MAX = float(os.getenv("MARKETSTACK_BACKOFF_MAX", "60"))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+CACHE_TTL = float(os.getenv("MARKETSTACK_CACHE_TTL", "3600"))
+CACHE_DIR = os.getenv("MARKETSTACK_CACHE_DIR")
+CACHE_REFRESH = os.getenv("MARKETSTACK_CACHE_REFRESH", "false").lower() == "true"
+
+_session = None
+_session_lock = threading.Lock()
+_async_session = None
+_cache = {}
+_cache_lock = threading.Lock()
+request_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_session():
+    """Get the process wide Marketstack session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            logger.info("Creating Marketstack session with pool size %s", POOL_SIZE)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(
+                {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+            )
+            _session = session
+    return _session
+
+
+def get_async_session():
+    """Get the aiohttp session of the async worker, creating it on first use
+
+    The session belongs to the running event loop. Its connection pool is not
+    capped; the async worker's fetch stage bounds the requests in flight.
+    """
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        import aiohttp
+
+        logger.info("Creating async Marketstack session")
+        _async_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0),
+            timeout=aiohttp.ClientTimeout(connect=TIMEOUT[0], sock_read=TIMEOUT[1]),
+            headers={"Accept-Encoding": "gzip, deflate"},
+        )
+    return _async_session
+
+
+async def close_async_session():
+    """Close the aiohttp session before its event loop ends"""
+    global _async_session
+    if _async_session is not None:
+        await _async_session.close()
+        _async_session = None
+
+
+def get_retry_after(response):
+    """Get the delay in seconds requested by a Retry-After header, if any"""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+def get_backoff(attempt):
+    """Get an exponential backoff delay with full jitter for a retry attempt"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_FACTOR * 2**attempt))
+
+
+def get(endpoint, params={}):
+    """Get a Marketstack endpoint, retrying throttled and failed requests
+
+    Every attempt waits for the rate limiter and counts towards the quota.
+    """
+    url = f"{MARKETSTACK_API}/{endpoint}"
+    params = {**DEFAULT_PARAMS, **params}
+    for attempt in range(MAX_RETRIES + 1):
+        ratelimit.acquire()
+        with _stats_lock:
+            request_stats[endpoint] += 1
+        try:
+            response = get_session().get(url, params=params, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.increment("marketstack_responses_total", status="error")
+            if attempt == MAX_RETRIES:
+                raise
+            delay = get_backoff(attempt)
+            logger.warning("Marketstack request to %s failed: %s", endpoint, e)
+        else:
+            metrics.increment(
+                "marketstack_responses_total", status=str(response.status_code)
+            )
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                return serialization.loads(response.content)
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = get_backoff(attempt)
+            logger.warning(
+                "Marketstack returned %s for %s", response.status_code, endpoint
+            )
+        logger.info("Retrying in %.2fs (attempt %s)", delay, attempt + 1)
+        time.sleep(delay)
+
+
+async def get_async(endpoint, params={}):
+    """Get a Marketstack endpoint without blocking the event loop, as get does"""
+    import asyncio
+    import aiohttp
+
+    url = f"{MARKETSTACK_API}/{endpoint}"
+    params = {
+        name: value
+        for name, value in {**DEFAULT_PARAMS, **params}.items()
+        if value is not None
+    }
+    for attempt in range(MAX_RETRIES + 1):
+        await ratelimit.acquire_async()
+        with _stats_lock:
+            request_stats[endpoint] += 1
+        try:
+            async with get_async_session().get(url, params=params) as response:
+                content = await response.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            metrics.increment("marketstack_responses_total", status="error")
+            if attempt == MAX_RETRIES:
+                raise
+            delay = get_backoff(attempt)
+            logger.warning("Marketstack request to %s failed: %s", endpoint, e)
+        else:
+            metrics.increment(
+                "marketstack_responses_total", status=str(response.status)
+            )
+            if response.status not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                return serialization.loads(content)
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = get_backoff(attempt)
+            logger.warning("Marketstack returned %s for %s", response.status, endpoint)
+        logger.info("Retrying in %.2fs (attempt %s)", delay, attempt + 1)
+        await asyncio.sleep(delay)
+
+
+def get_cache_key(endpoint, params):
+    """Get the cache key of a request, leaving out the access key"""
+    items = sorted(
+        (name, str(value)) for name, value in params.items() if name != "access_key"
+    )
+    return hashlib.sha256(json.dumps([endpoint, items]).encode()).hexdigest()
+
+
+def read_cache_file(key, ttl):
+    """Read a cached response from CACHE_DIR if it is younger than ttl"""
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(path) >= ttl:
+            return None
+        with open(path, "rb") as cache_file:
+            return serialization.loads(cache_file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache_file(key, data):
+    """Write a response to CACHE_DIR, replacing the file atomically"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    with open(f"{path}.tmp", "wb") as cache_file:
+        cache_file.write(serialization.dumps(data))
+    os.replace(f"{path}.tmp", path)
+
+
+def get_cached(endpoint, params={}, ttl=None, refresh=False):
+    """Get a Marketstack endpoint through the response cache
+
+    Responses are kept in process for ``ttl`` seconds and, when
+    MARKETSTACK_CACHE_DIR is set, on disk too. ``refresh`` bypasses both and
+    replaces the cached response.
+    """
+    ttl = CACHE_TTL if ttl is None else ttl
+    key = get_cache_key(endpoint, {**DEFAULT_PARAMS, **params})
+    if not refresh:
+        with _cache_lock:
+            cached = _cache.get(key)
+        if cached is not None and time.time() - cached[0] < ttl:
+            return cached[1]
+        if CACHE_DIR:
+            data = read_cache_file(key, ttl)
+            if data is not None:
+                with _cache_lock:
+                    _cache[key] = (time.time(), data)
+                return data
+
+    data = get(endpoint, params)
+    with _cache_lock:
+        _cache[key] = (time.time(), data)
+    if CACHE_DIR:
+        write_cache_file(key, data)
+    return data
+
+
+def clear_cache():
+    """Drop every cached response, in process and on disk
+
+    Runs started with MARKETSTACK_CACHE_REFRESH clear the cache once, so the
+    lookups they derive from one endpoint still share a single fetch of it.
+    """
+    with _cache_lock:
+        _cache.clear()
+    if CACHE_DIR and os.path.isdir(CACHE_DIR):
+        for name in os.listdir(CACHE_DIR):
+            if name.endswith(".json"):
+                os.remove(os.path.join(CACHE_DIR, name))
+
+
+def log_request_stats():
+    """Log how many requests were made to each endpoint and this month's usage"""
+    with _stats_lock:
+        stats = dict(request_stats)
+    logger.info(
+        "Marketstack requests: %s total, %s this month, by endpoint %s",
+        sum(stats.values()),
+        ratelimit.get_rate_limiter().get_used(),
+        stats,
+    )
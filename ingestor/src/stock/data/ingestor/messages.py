@@ -0,0 +1,64 @@
+import base64
+import binascii
+import logging
+import zlib
+from . import serialization
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Queue messages are limited to 64 KiB once the queue client base64 encodes them
+MAX_MESSAGE_BYTES = 48 * 1024
+
+
+def encode_message(message):
+    """Encode a job message as zlib compressed JSON
+
+    The queue client's BinaryBase64EncodePolicy takes care of making the
+    payload safe for the queue, so it is not base64 encoded here.
+    """
+    return zlib.compress(serialization.dumps(message), 9)
+
+
+def decode_message(content):
+    """Decode a job message, accepting both compressed and legacy base64 payloads"""
+    try:
+        return serialization.loads(zlib.decompress(content))
+    except zlib.error:
+        pass
+    try:
+        return serialization.loads(base64.b64decode(content, validate=True))
+    except (binascii.Error, ValueError):
+        return serialization.loads(content)
+
+
+def parse_bool(value):
+    """Parse a true/false string as distutils' strtobool did"""
+    value = str(value).lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return True
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return False
+    raise ValueError(f"Invalid truth value: {value!r}")
+
+
+def get_shard_file_name(file_name, message):
+    """Get a file name that is unique to a message's shard
+
+    Backfill messages shard an exchange's tickers differently from daily ones,
+    so their files are named apart and never replace a daily shard's files.
+    Daily messages for an exchange that was not sharded keep the plain name.
+    """
+    if message.get("type") == "EOD_BACKFILL":
+        file_name = f"{file_name}-backfill"
+    if message.get("shard_count", 1) > 1:
+        return f"{file_name}-{message['shard']}"
+    return file_name
+
+
+def get_file_name_preffix(message):
+    """Get the date/mic or mic/date partition a message's files are written to"""
+    if parse_bool(message["partition_by_date"]):
+        logger.info("Partitioning by date")
+        return f'{message["date"]}/{message["exchange_mic"]}'
+    return f'{message["exchange_mic"]}/{message["date"]}'
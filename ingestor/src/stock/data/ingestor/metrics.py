@@ -0,0 +1,148 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "eod_ingestor"
+METRICS_TEXTFILE = os.getenv("EOD_METRICS_TEXTFILE")
+METRICS_PORT = int(os.getenv("EOD_METRICS_PORT", "0"))
+METRICS_OTEL = os.getenv("EOD_METRICS_OTEL", "false").lower() == "true"
+
+_counters = Counter()
+_timers = {}
+_lock = threading.Lock()
+_tracer = None
+
+
+def get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """Add to a counter"""
+    with _lock:
+        _counters[get_key(name, labels)] += value
+
+
+def observe(name, seconds, **labels):
+    """Record one duration of a timer"""
+    with _lock:
+        total, count = _timers.get(get_key(name, labels), (0.0, 0))
+        _timers[get_key(name, labels)] = (total + seconds, count + 1)
+
+
+def get_tracer():
+    """Get the OpenTelemetry tracer when EOD_METRICS_OTEL is set and installed"""
+    global _tracer
+    if METRICS_OTEL and _tracer is None:
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            logger.warning("EOD_METRICS_OTEL is set but opentelemetry is missing")
+            return None
+        _tracer = trace.get_tracer(METRICS_PREFIX)
+    return _tracer
+
+
+@contextlib.contextmanager
+def timer(name, summary=None, **labels):
+    """Time a block, adding ``{name}_seconds`` to ``summary`` if given
+
+    The block also runs in an OpenTelemetry span when tracing is enabled.
+    """
+    with contextlib.ExitStack() as stack:
+        tracer = get_tracer()
+        if tracer is not None:
+            stack.enter_context(tracer.start_as_current_span(name, attributes=labels))
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            observe(name, elapsed, **labels)
+            if summary is not None:
+                summary[f"{name}_seconds"] += elapsed
+
+
+def timed_iter(name, iterable, summary=None):
+    """Iterate, timing how long each item takes to be produced"""
+    iterator = iter(iterable)
+    while True:
+        with timer(name, summary):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render_prometheus():
+    """Render every counter and timer in the Prometheus text format"""
+    with _lock:
+        counters = sorted(_counters.items())
+        timers = sorted(_timers.items())
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        metric = f"{METRICS_PREFIX}_{name}"
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{format_labels(labels)} {value}")
+    for (name, labels), (total, count) in timers:
+        metric = f"{METRICS_PREFIX}_{name}_seconds"
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f"# TYPE {metric} summary")
+        lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+        lines.append(f"{metric}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path=None):
+    """Write the metrics for the node exporter's textfile collector, atomically"""
+    path = path or METRICS_TEXTFILE
+    if not path:
+        return
+    with open(f"{path}.tmp", "w") as metrics_file:
+        metrics_file.write(render_prometheus())
+    os.replace(f"{path}.tmp", path)
+
+
+def start_http_server(port=None):
+    """Serve the metrics over HTTP on a background thread"""
+    port = port or METRICS_PORT
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            content = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on port %s", server.server_address[1])
+    return server
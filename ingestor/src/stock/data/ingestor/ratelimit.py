@@ -0,0 +1,361 @@
+import datetime
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from . import serialization
+from .clients import get_async_file_system_client, get_file_system_client
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT = float(os.getenv("MARKETSTACK_RATE_LIMIT", "5"))
+RATE_BURST = float(os.getenv("MARKETSTACK_RATE_BURST", "10"))
+MONTHLY_QUOTA = int(os.getenv("MARKETSTACK_MONTHLY_QUOTA", "0"))
+RATE_LIMIT_DB = os.getenv("MARKETSTACK_RATE_LIMIT_DB")
+QUOTA_STORAGE_NAME = os.getenv("MARKETSTACK_QUOTA_STORAGE_NAME")
+QUOTA_FILE_SYSTEM = os.getenv("MARKETSTACK_QUOTA_FILE_SYSTEM", "eod")
+QUOTA_FILE_PREFFIX = "marketstack/QUOTA"
+QUOTA_BLOCK_SIZE = int(os.getenv("MARKETSTACK_QUOTA_BLOCK_SIZE", "50"))
+QUOTA_LEASE_RETRIES = 10
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+class QuotaExceededError(Exception):
+    """Raised when the monthly Marketstack request quota has been used up"""
+
+
+def get_month(now):
+    """Get the quota month a timestamp falls in"""
+    return datetime.datetime.fromtimestamp(now, datetime.timezone.utc).strftime("%Y-%m")
+
+
+def take_token(state, now, rate, burst, quota):
+    """Take a token from a bucket's state, returning how long to wait for it
+
+    ``state`` holds ``tokens``, ``updated``, ``month`` and ``used`` and is
+    updated in place. Tokens may go negative; the caller then waits for the
+    deficit to refill, so concurrent callers queue up behind each other.
+    """
+    month = get_month(now)
+    if state["month"] != month:
+        state["month"], state["used"] = month, 0
+    if quota and state["used"] >= quota:
+        raise QuotaExceededError(f"Monthly quota of {quota} requests used up")
+    state["used"] += 1
+    if rate <= 0:
+        return 0.0
+    elapsed = max(0.0, now - state["updated"])
+    state["tokens"] = min(burst, state["tokens"] + elapsed * rate) - 1
+    state["updated"] = now
+    return max(0.0, -state["tokens"] / rate)
+
+
+class TokenBucket:
+    """Token bucket rate limiter with a monthly quota, local to this process"""
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, quota=MONTHLY_QUOTA):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.quota = quota
+        self._state = {
+            "tokens": self.burst,
+            "updated": time.time(),
+            "month": None,
+            "used": 0,
+        }
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Reserve a request, returning the seconds to wait before making it"""
+        with self._lock:
+            return take_token(
+                self._state, time.time(), self.rate, self.burst, self.quota
+            )
+
+    async def reserve_async(self):
+        """Reserve a request from a coroutine"""
+        return self.reserve()
+
+    def get_used(self):
+        """Get the number of requests made this month"""
+        with self._lock:
+            return self._state["used"]
+
+
+class SqliteTokenBucket(TokenBucket):
+    """Token bucket rate limiter whose state is shared through a SQLite file
+
+    Every process pointing at the same file draws from the same bucket and
+    quota. SQLite's file lock serializes them, so the file must be on a file
+    system with working POSIX locks: a local disk, not an SMB share such as
+    an azurefile volume. Pods on different nodes share the quota through
+    DatastoreTokenBucket instead.
+    """
+
+    def __init__(self, path, rate=RATE_LIMIT, burst=RATE_BURST, quota=MONTHLY_QUOTA):
+        super().__init__(rate, burst, quota)
+        self.path = path
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS bucket ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), "
+                "tokens REAL, updated REAL, month TEXT, used INTEGER)"
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO bucket VALUES (0, ?, ?, NULL, 0)",
+                (self.burst, time.time()),
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def reserve(self):
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            tokens, updated, month, used = connection.execute(
+                "SELECT tokens, updated, month, used FROM bucket WHERE id = 0"
+            ).fetchone()
+            state = {"tokens": tokens, "updated": updated, "month": month, "used": used}
+            try:
+                delay = take_token(
+                    state, time.time(), self.rate, self.burst, self.quota
+                )
+            except QuotaExceededError:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute(
+                "UPDATE bucket SET tokens = ?, updated = ?, month = ?, used = ? "
+                "WHERE id = 0",
+                (state["tokens"], state["updated"], state["month"], state["used"]),
+            )
+            connection.execute("COMMIT")
+            return delay
+        finally:
+            connection.close()
+
+    async def reserve_async(self):
+        import asyncio
+
+        # SQLite's file lock blocks, so it is waited for on a thread
+        return await asyncio.to_thread(self.reserve)
+
+    def get_used(self):
+        connection = self._connect()
+        try:
+            month, used = connection.execute(
+                "SELECT month, used FROM bucket WHERE id = 0"
+            ).fetchone()
+        finally:
+            connection.close()
+        return used if month == get_month(time.time()) else 0
+
+
+def get_quota_used(content, etag):
+    """Get the count in a QUOTA file and the conditions to write it back with"""
+    from azure.core import MatchConditions
+
+    return serialization.loads(content)["used"], {
+        "overwrite": True,
+        "etag": etag,
+        "match_condition": MatchConditions.IfNotModified,
+    }
+
+
+class DatastoreTokenBucket(TokenBucket):
+    """Token bucket rate limiter whose monthly quota is counted in the datastore
+
+    The rate stays local to the process, but every process counts requests
+    in the month's QUOTA file of a Data Lake file system, so the quota holds
+    across pod restarts and scale-ups. Requests are leased from the file in
+    blocks of ``block_size`` with conditional writes, retrying when another
+    process updated it first. Requests left in a block when a process exits
+    stay counted, which errs on the side of the quota. Coroutines lease
+    through the async file system client ``get_async_file_system_client``
+    returns, when there is one.
+    """
+
+    def __init__(
+        self,
+        file_system_client,
+        rate=RATE_LIMIT,
+        burst=RATE_BURST,
+        quota=MONTHLY_QUOTA,
+        block_size=QUOTA_BLOCK_SIZE,
+        get_async_file_system_client=None,
+    ):
+        super().__init__(rate, burst, 0)
+        self.quota = quota
+        self.block_size = max(1, block_size)
+        self.file_system_client = file_system_client
+        self.get_async_file_system_client = get_async_file_system_client
+        self._month = None
+        self._leased = 0
+        self._async_lock = None
+
+    def _get_file_name(self, month):
+        return f"{QUOTA_FILE_PREFFIX}-{month}.json"
+
+    def _read_used(self, file_client):
+        """Read the month's count and the conditions to write it back with"""
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            download = file_client.download_file()
+        except ResourceNotFoundError:
+            return 0, {"overwrite": False}
+        return get_quota_used(download.readall(), download.properties.etag)
+
+    async def _read_used_async(self, file_client):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            download = await file_client.download_file()
+        except ResourceNotFoundError:
+            return 0, {"overwrite": False}
+        return get_quota_used(await download.readall(), download.properties.etag)
+
+    def _get_block(self, used):
+        if used >= self.quota:
+            raise QuotaExceededError(f"Monthly quota of {self.quota} requests used up")
+        return min(self.block_size, self.quota - used)
+
+    def _lease(self, month):
+        """Add a block of requests to the month's count and take it"""
+        from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+
+        file_client = self.file_system_client.get_file_client(
+            self._get_file_name(month)
+        )
+        for _ in range(QUOTA_LEASE_RETRIES):
+            used, conditions = self._read_used(file_client)
+            block = self._get_block(used)
+            try:
+                file_client.upload_data(
+                    serialization.dumps({"used": used + block}), **conditions
+                )
+            except (ResourceExistsError, ResourceModifiedError):
+                continue
+            logger.info("Leased %s Marketstack requests, %s used", block, used)
+            return block
+        raise RuntimeError(f"Could not lease requests from the {month} quota")
+
+    async def _lease_async(self, month):
+        from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+
+        file_client = self.get_async_file_system_client().get_file_client(
+            self._get_file_name(month)
+        )
+        for _ in range(QUOTA_LEASE_RETRIES):
+            used, conditions = await self._read_used_async(file_client)
+            block = self._get_block(used)
+            try:
+                await file_client.upload_data(
+                    serialization.dumps({"used": used + block}), **conditions
+                )
+            except (ResourceExistsError, ResourceModifiedError):
+                continue
+            logger.info("Leased %s Marketstack requests, %s used", block, used)
+            return block
+        raise RuntimeError(f"Could not lease requests from the {month} quota")
+
+    def _needs_lease(self, month):
+        if month != self._month:
+            self._month, self._leased = month, 0
+        return self._leased == 0
+
+    def _take(self, now):
+        self._leased -= 1
+        return take_token(self._state, now, self.rate, self.burst, 0)
+
+    def reserve(self):
+        with self._lock:
+            now = time.time()
+            month = get_month(now)
+            if self._needs_lease(month):
+                self._leased = self._lease(month)
+            return self._take(now)
+
+    def _get_async_lock(self):
+        import asyncio
+
+        # An asyncio lock only serves the event loop it was first used on
+        loop = asyncio.get_running_loop()
+        if self._async_lock is None or self._async_lock[0] is not loop:
+            self._async_lock = (loop, asyncio.Lock())
+        return self._async_lock[1]
+
+    async def reserve_async(self):
+        import asyncio
+
+        if self.get_async_file_system_client is None:
+            return await asyncio.to_thread(self.reserve)
+        async with self._get_async_lock():
+            now = time.time()
+            month = get_month(now)
+            if self._needs_lease(month):
+                self._leased = await self._lease_async(month)
+            with self._lock:
+                return self._take(now)
+
+    def get_used(self):
+        file_client = self.file_system_client.get_file_client(
+            self._get_file_name(get_month(time.time()))
+        )
+        used, _ = self._read_used(file_client)
+        return used
+
+
+def get_rate_limiter():
+    """Get the process wide rate limiter
+
+    The rate limit and quota are shared through RATE_LIMIT_DB if it is set.
+    Otherwise, with a MARKETSTACK_MONTHLY_QUOTA and QUOTA_STORAGE_NAME, the
+    quota is counted in that storage account's datastore.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            if RATE_LIMIT_DB:
+                logger.info("Sharing Marketstack rate limit through %s", RATE_LIMIT_DB)
+                _limiter = SqliteTokenBucket(RATE_LIMIT_DB)
+            elif MONTHLY_QUOTA and QUOTA_STORAGE_NAME:
+                logger.info(
+                    "Counting Marketstack quota in %s/%s",
+                    QUOTA_STORAGE_NAME,
+                    QUOTA_FILE_SYSTEM,
+                )
+                _limiter = DatastoreTokenBucket(
+                    get_file_system_client(QUOTA_STORAGE_NAME, QUOTA_FILE_SYSTEM),
+                    get_async_file_system_client=functools.partial(
+                        get_async_file_system_client,
+                        QUOTA_STORAGE_NAME,
+                        QUOTA_FILE_SYSTEM,
+                    ),
+                )
+            else:
+                _limiter = TokenBucket()
+    return _limiter
+
+
+def acquire():
+    """Wait until the rate limiter allows another Marketstack request"""
+    delay = get_rate_limiter().reserve()
+    if delay > 0:
+        logger.debug("Rate limited, waiting %.2fs", delay)
+        time.sleep(delay)
+
+
+async def acquire_async():
+    """Wait on the event loop until the rate limiter allows another request"""
+    import asyncio
+
+    delay = await get_rate_limiter().reserve_async()
+    if delay > 0:
+        logger.debug("Rate limited, waiting %.2fs", delay)
+        await asyncio.sleep(delay)
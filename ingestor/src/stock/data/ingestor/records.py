@@ -0,0 +1,159 @@
+import logging
+import math
+import operator
+import re
+import sys
+from dataclasses import dataclass
+from json.encoder import encode_basestring
+from . import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EOD_PRICE_FIELDS = [
+    "open",
+    "high",
+    "low",
+    "close",
+    "volume",
+    "adj_high",
+    "adj_low",
+    "adj_close",
+    "adj_open",
+    "adj_volume",
+    "split_factor",
+    "dividend",
+]
+EOD_STRING_FIELDS = ["symbol", "exchange"]
+# The order Marketstack returns EOD fields in, kept for the JSON output
+EOD_FIELDS = EOD_PRICE_FIELDS + EOD_STRING_FIELDS + ["date"]
+EOD_DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}[+-]\d{4}")
+# Formats a record as compact JSON, like orjson does; prices are validated
+# finite numbers, so their repr is already valid JSON
+EOD_JSON_TEMPLATE = (
+    "{"
+    + ",".join(f'"{field}":%r' for field in EOD_PRICE_FIELDS)
+    + ',"symbol":%s,"exchange":%s,"date":%s}'
+)
+
+
+class InvalidEodRecordError(ValueError):
+    """Raised when an EOD row from Marketstack cannot be parsed"""
+
+
+@dataclass(slots=True)
+class EodRecord:
+    """An end of day bar, without the per-row key strings of the API's dicts"""
+
+    open: float | None
+    high: float | None
+    low: float | None
+    close: float | None
+    volume: float | None
+    adj_high: float | None
+    adj_low: float | None
+    adj_close: float | None
+    adj_open: float | None
+    adj_volume: float | None
+    split_factor: float | None
+    dividend: float | None
+    symbol: str
+    exchange: str | None
+    date: str
+
+    @classmethod
+    def from_dict(cls, row):
+        """Parse and validate an EOD row from the Marketstack API"""
+        symbol = row.get("symbol")
+        if not isinstance(symbol, str) or not symbol:
+            raise InvalidEodRecordError(f"Invalid symbol: {symbol!r}")
+        date = row.get("date")
+        if not isinstance(date, str) or not EOD_DATE_PATTERN.fullmatch(date):
+            raise InvalidEodRecordError(f"Invalid date for {symbol}: {date!r}")
+        exchange = row.get("exchange")
+        if exchange is not None and not isinstance(exchange, str):
+            raise InvalidEodRecordError(f"Invalid exchange for {symbol}: {exchange!r}")
+        prices = [row.get(field) for field in EOD_PRICE_FIELDS]
+        # Rows are almost always all finite floats; check those in one go
+        if not (
+            all(price.__class__ is float for price in prices)
+            and math.isfinite(sum(prices))
+        ):
+            prices = [
+                parse_price(price, field)
+                for price, field in zip(prices, EOD_PRICE_FIELDS)
+            ]
+        return cls(
+            *prices,
+            symbol,
+            sys.intern(exchange) if exchange is not None else None,
+            sys.intern(date),
+        )
+
+    def to_tuple(self):
+        """Get the record's values in EOD_FIELDS order"""
+        return get_eod_values(self)
+
+    def to_dict(self):
+        return dict(zip(EOD_FIELDS, get_eod_values(self)))
+
+    def to_json(self):
+        """Serialize the record as compact JSON, without building its dict"""
+        prices = get_eod_prices(self)
+        if None in prices:
+            prices = tuple(JSON_NULL if price is None else price for price in prices)
+        return EOD_JSON_TEMPLATE % (
+            *prices,
+            encode_basestring(self.symbol),
+            (JSON_NULL if self.exchange is None else encode_basestring(self.exchange)),
+            encode_basestring(self.date),
+        )
+
+
+class JsonNull:
+    def __repr__(self):
+        return "null"
+
+    __str__ = __repr__
+
+
+JSON_NULL = JsonNull()
+get_eod_values = operator.attrgetter(*EOD_FIELDS)
+get_eod_prices = operator.attrgetter(*EOD_PRICE_FIELDS)
+
+
+def parse_price(value, field):
+    """Parse a numeric EOD field, which Marketstack leaves null when unknown"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if math.isfinite(value):
+            return value
+    raise InvalidEodRecordError(f"Invalid {field}: {value!r}")
+
+
+def parse_eod_records(rows):
+    """Parse EOD rows into records, dropping and counting the invalid ones"""
+    records = []
+    invalid = 0
+    for row in rows:
+        try:
+            records.append(EodRecord.from_dict(row))
+        except InvalidEodRecordError as e:
+            invalid += 1
+            logger.debug("Dropping EOD row: %s", e)
+    if invalid:
+        logger.warning("Dropped %s invalid EOD rows out of %s", invalid, len(rows))
+        metrics.increment("invalid_rows_total", invalid)
+    return records
+
+
+def as_eod_records(eod_data):
+    """Yield EOD data as records, parsing rows that are still dicts"""
+    for eod in eod_data:
+        yield EodRecord.from_dict(eod) if isinstance(eod, dict) else eod
@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+from collections import namedtuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+JSON_BACKEND = os.getenv("EOD_JSON_BACKEND")
+
+Serializer = namedtuple("Serializer", ["name", "loads", "dumps", "dumps_record"])
+
+_serializer = None
+
+
+def get_json_serializer():
+    """Get the standard library serializer"""
+    return Serializer(
+        "json",
+        json.loads,
+        lambda obj: json.dumps(obj, separators=(",", ":")).encode(),
+        lambda record: record.to_json().encode(),
+    )
+
+
+def get_orjson_serializer():
+    """Get the orjson serializer, which encodes EodRecords natively"""
+    try:
+        import orjson
+    except ImportError as e:
+        raise RuntimeError("The orjson JSON backend requires orjson") from e
+    return Serializer("orjson", orjson.loads, orjson.dumps, orjson.dumps)
+
+
+SERIALIZERS = {
+    "json": get_json_serializer,
+    "orjson": get_orjson_serializer,
+}
+
+
+def get_serializer(name=None):
+    """Get a JSON serializer by name, preferring orjson when it is installed
+
+    Every serializer decodes bytes directly and encodes to compact UTF-8 bytes.
+    """
+    name = name or JSON_BACKEND
+    if name is None:
+        try:
+            return get_orjson_serializer()
+        except RuntimeError:
+            return get_json_serializer()
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown JSON backend: {name}")
+    return SERIALIZERS[name]()
+
+
+def get_default_serializer():
+    """Get the process wide serializer, chosen on first use"""
+    global _serializer
+    if _serializer is None:
+        _serializer = get_serializer()
+        logger.info("Using the %s JSON backend", _serializer.name)
+    return _serializer
+
+
+def loads(content):
+    """Decode JSON from bytes or str"""
+    return get_default_serializer().loads(content)
+
+
+def dumps(obj):
+    """Encode an object as compact JSON bytes"""
+    return get_default_serializer().dumps(obj)
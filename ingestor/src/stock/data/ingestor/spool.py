@@ -0,0 +1,166 @@
+import contextlib
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode
+from . import metrics, serialization
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv("EOD_INGESTOR_SPOOL_DIR")
+SPOOL_RETENTION_HOURS = float(os.getenv("EOD_INGESTOR_SPOOL_RETENTION_HOURS", "48"))
+PAGES_FILE_NAME = "pages.ndjson"
+UPLOADS_FILE_NAME = "uploads.ndjson"
+
+
+def get_page_key(endpoint, offset, extra_params):
+    """Get the key a Marketstack page is spooled under"""
+    return f"{endpoint}?{urlencode(sorted({**extra_params, 'offset': offset}.items()))}"
+
+
+class AppendLog:
+    """An NDJSON file of ``{"key": ..., "value": ...}`` entries, indexed by key
+
+    Only the byte range of each entry is kept in memory; values are read back
+    from the file when asked for. A torn last line, left by a process killed
+    mid-write, is truncated away when the log is opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self._lock = threading.Lock()
+        end = 0
+        if os.path.exists(path):
+            with open(path, "rb") as log_file:
+                for line in log_file:
+                    try:
+                        key = serialization.loads(line)["key"]
+                    except (ValueError, KeyError):
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    self.index[key] = (end, len(line))
+                    end += len(line)
+            if end != os.path.getsize(path):
+                logger.warning("Truncating torn entry at the end of %s", path)
+                os.truncate(path, end)
+        self._file = open(path, "ab")
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key):
+        if key not in self.index:
+            return None
+        offset, length = self.index[key]
+        return serialization.loads(os.pread(self._fd, length, offset))["value"]
+
+    def add(self, key, value):
+        line = serialization.dumps({"key": key, "value": value}) + b"\n"
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(line)
+            self._file.flush()
+            self.index[key] = (offset, len(line))
+
+    def close(self):
+        if self._fd is not None:
+            self._file.close()
+            os.close(self._fd)
+            self._fd = None
+
+
+class Spool:
+    """The Marketstack pages fetched and files uploaded for one queue message
+
+    A worker that is stopped part way through a message leaves its spool
+    behind, so the run that picks the message up again replays those pages
+    instead of requesting them and skips the uploads that were done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.pages = AppendLog(os.path.join(path, PAGES_FILE_NAME))
+        self.uploads = AppendLog(os.path.join(path, UPLOADS_FILE_NAME))
+        self.stats = Counter()
+        if self.pages.index or self.uploads.index:
+            logger.info(
+                "Resuming from spool %s with %s pages and %s uploads",
+                path,
+                len(self.pages.index),
+                len(self.uploads.index),
+            )
+
+    def has_page(self, endpoint, offset, extra_params):
+        return get_page_key(endpoint, offset, extra_params) in self.pages
+
+    def get_page(self, endpoint, offset, extra_params):
+        page = self.pages.get(get_page_key(endpoint, offset, extra_params))
+        if page is not None:
+            self.stats["pages_replayed"] += 1
+            metrics.increment("spool_pages_replayed_total")
+        return page
+
+    def add_page(self, endpoint, offset, extra_params, page):
+        self.pages.add(get_page_key(endpoint, offset, extra_params), page)
+
+    def get_upload(self, file_name):
+        upload = self.uploads.get(file_name)
+        if upload is not None:
+            self.stats["uploads_replayed"] += 1
+            metrics.increment("spool_uploads_replayed_total")
+        return upload
+
+    def add_upload(self, upload):
+        self.uploads.add(upload["file_name"], upload)
+
+    def close(self):
+        self.pages.close()
+        self.uploads.close()
+
+
+@contextlib.contextmanager
+def open_spool(message_id, spool_dir=None):
+    """Open the spool of a queue message, or yield None when spooling is off"""
+    spool_dir = spool_dir or SPOOL_DIR
+    if not spool_dir:
+        yield None
+        return
+    spool = Spool(os.path.join(spool_dir, message_id))
+    try:
+        yield spool
+    finally:
+        spool.close()
+
+
+def remove_spool(message_id, spool_dir=None):
+    """Remove the spool of a message once it has been dealt with"""
+    spool_dir = spool_dir or SPOOL_DIR
+    if spool_dir:
+        shutil.rmtree(os.path.join(spool_dir, message_id), ignore_errors=True)
+
+
+def prune_spools(spool_dir=None, retention_hours=None):
+    """Remove spools that have not been written to for the retention period"""
+    spool_dir = spool_dir or SPOOL_DIR
+    if not spool_dir or not os.path.isdir(spool_dir):
+        return
+    retention_hours = retention_hours or SPOOL_RETENTION_HOURS
+    oldest = time.time() - retention_hours * 3600
+    for entry in os.scandir(spool_dir):
+        if not entry.is_dir():
+            continue
+        modified = max(
+            (log.stat().st_mtime for log in os.scandir(entry.path)),
+            default=entry.stat().st_mtime,
+        )
+        if modified < oldest:
+            logger.info("Removing stale spool %s", entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
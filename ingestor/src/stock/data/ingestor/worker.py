@@ -1,62 +1,152 @@
-import base64
+import contextlib
 import datetime
-from distutils.util import strtobool
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import itertools
 import json
 import math
-import requests
 import logging
 import os
-from azure.identity import DefaultAzureCredential
-from azure.storage.filedatalake import DataLakeServiceClient
-from azure.storage.queue import (
-    QueueClient,
-    BinaryBase64EncodePolicy,
-    BinaryBase64DecodePolicy,
+import queue
+import signal
+import threading
+import time
+from collections import Counter
+from . import marketstack, metrics, serialization
+from .clients import (
+    get_datalake_service_client,
+    get_file_system_client,
+    get_queue_client,
+    log_client_cache_stats,
+)
+from .dedupe import EOD_KEY, remove_dupes
+from .delta import (
+    HASHES_FILE_NAME,
+    count_skipped,
+    get_changed_output_files,
+    get_hashes_path,
+    get_resumed_hashes,
+    load_hashes,
+    save_hashes,
+)
+from .marketstack import DEFAULT_PARAMS
+from .messages import (
+    decode_message,
+    get_file_name_preffix,
+    get_shard_file_name,
+    parse_bool,
+)
+from .records import parse_eod_records
+from .spool import open_spool, prune_spools, remove_spool
+from .writers import (
+    DEFAULT_OUTPUT_FORMAT,
+    EOD_FILE_NAME,
+    PER_SYMBOL_FORMATS,
+    get_output_files,
+    get_symbol_file_name,
 )
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-DEFAULT_PARAMS = {"access_key": os.getenv("MARKETSTACK_API_KEY"), "limit": 1000}
+shutdown = threading.Event()
+
 MAX_PAGES = 100
-MARKETSTACK_API = "http://api.marketstack.com/v1"
+FETCH_CONCURRENCY = int(os.getenv("EOD_INGESTOR_FETCH_CONCURRENCY", "4"))
+SYMBOLS_PER_REQUEST = 100
+FETCH_QUEUE_DEPTH = int(os.getenv("EOD_INGESTOR_FETCH_QUEUE_DEPTH", "4"))
+VISIBILITY_TIMEOUT = int(os.getenv("EOD_INGESTOR_VISIBILITY_TIMEOUT", "300"))
+MESSAGE_CONCURRENCY = int(os.getenv("EOD_INGESTOR_MESSAGE_CONCURRENCY", "2"))
+RECEIVE_BATCH_SIZE = min(32, int(os.getenv("EOD_INGESTOR_RECEIVE_BATCH_SIZE", "4")))
+IDLE_BACKOFF_MIN = float(os.getenv("EOD_INGESTOR_IDLE_BACKOFF_MIN", "1"))
+IDLE_BACKOFF_MAX = float(os.getenv("EOD_INGESTOR_IDLE_BACKOFF_MAX", "60"))
+UPLOAD_CONCURRENCY = int(os.getenv("EOD_INGESTOR_UPLOAD_CONCURRENCY", "8"))
+UPLOAD_RETRIES = int(os.getenv("EOD_INGESTOR_UPLOAD_RETRIES", "3"))
+UPLOAD_RETRY_DELAY = float(os.getenv("EOD_INGESTOR_UPLOAD_RETRY_DELAY", "1"))
 
 
-def get_requests_with_offset(endpoint, initial_offset=1, extra_params={}):
-    offset = initial_offset
-    data = []
-    logger.info("Getting data from Marketstack API for endpoint: %s", endpoint)
-    while True:
-        _data = requests.get(
-            f"{MARKETSTACK_API}/{endpoint}",
-            params={**DEFAULT_PARAMS, "offset": offset, **extra_params},
-        ).json()
-        # if(_data.get("data") is not None):
-        #     print(_data["data"])
-        #     exit
-        data.extend(_data["data"]["eod"])
-        if (
-            _data.get("pagination") is not None
-            and _data["pagination"].get("total") is not None
-        ):
-            if offset >= MAX_PAGES or offset >= math.ceil(
-                _data["pagination"]["total"] / DEFAULT_PARAMS["limit"]
-            ):
-                break
-        else:
-            break
+def get_page(endpoint, offset, extra_params={}):
+    """Get a single page from the Marketstack API"""
+    return marketstack.get(endpoint, {"offset": offset, **extra_params})
+
+
+def get_page_offsets(first_page, initial_offset, limit):
+    """Get the offsets of the pages left after the first one, capped at MAX_PAGES"""
+    pagination = first_page.get("pagination") or {}
+    if pagination.get("total") is None:
+        return []
+    pages = math.ceil((pagination["total"] - initial_offset) / limit)
+    if pages > MAX_PAGES:
+        logger.warning("Only fetching %s of %s pages", MAX_PAGES, pages)
+        pages = MAX_PAGES
+    return [initial_offset + page * limit for page in range(1, pages)]
+
+
+def get_requests_with_offsets(jobs, max_workers=None, stats=None, spool=None):
+    """Get every page of several paginated requests with bounded concurrency
 
-        offset += 1
+    Each job is an ``(endpoint, initial_offset, extra_params)`` tuple. The first
+    page of every job is fetched first; once its ``pagination.total`` is known
+    the remaining offsets are fanned out on the same pool. Rows are returned
+    per job, in page order. ``stats`` is an optional Counter updated with the
+    number of requests made to each endpoint. Pages found in ``spool`` are
+    replayed from it instead of being requested, and the others are added.
+    """
+    stats = stats if stats is not None else Counter()
 
-    return remove_dupes(data)
+    def fetch_page(endpoint, offset, extra_params):
+        if spool is None:
+            return get_page(endpoint, offset, extra_params)
+        page = spool.get_page(endpoint, offset, extra_params)
+        if page is None:
+            page = get_page(endpoint, offset, extra_params)
+            spool.add_page(endpoint, offset, extra_params, page)
+        return page
 
+    def count_request(endpoint, offset, extra_params):
+        if spool is None or not spool.has_page(endpoint, offset, extra_params):
+            stats[endpoint] += 1
 
-def remove_dupes(data):
-    new_d = []
-    for x in data:
-        if x not in new_d:
-            new_d.append(x)
-    return new_d
+    with metrics.timer("marketstack_fetch"), ThreadPoolExecutor(
+        max_workers=max_workers or FETCH_CONCURRENCY
+    ) as executor:
+        for job in jobs:
+            count_request(*job)
+        first_pages = list(executor.map(lambda job: fetch_page(*job), jobs))
+        pending = []
+        for index, (endpoint, initial_offset, extra_params) in enumerate(jobs):
+            limit = {**DEFAULT_PARAMS, **extra_params}["limit"]
+            for offset in get_page_offsets(first_pages[index], initial_offset, limit):
+                pending.append((index, endpoint, offset, extra_params))
+                count_request(endpoint, offset, extra_params)
+        if pending:
+            logger.info("Fetching %s more pages from Marketstack API", len(pending))
+        metrics.increment("marketstack_pages_total", len(jobs) + len(pending))
+        pages = executor.map(lambda page: fetch_page(*page[1:]), pending)
+
+        data = [list(first_page["data"]["eod"]) for first_page in first_pages]
+        for (index, *_), page in zip(pending, pages):
+            data[index].extend(page["data"]["eod"])
+
+    return data
+
+
+def iter_requests_with_offsets(jobs, max_workers=None, stats=None, spool=None):
+    """Yield the rows of each paginated request in job order
+
+    Jobs are fetched a pool's worth at a time so only that many are held in
+    memory at once.
+    """
+    max_workers = max_workers or FETCH_CONCURRENCY
+    for i in range(0, len(jobs), max_workers):
+        yield from get_requests_with_offsets(
+            jobs[i : i + max_workers], max_workers, stats, spool
+        )
+
+
+def get_requests_with_offset(endpoint, initial_offset=0, extra_params={}):
+    logger.info("Getting data from Marketstack API for endpoint: %s", endpoint)
+    data = get_requests_with_offsets([(endpoint, initial_offset, extra_params)])
+    return remove_dupes(data[0], EOD_KEY)
 
 
 def chunk_list(data, chunksize):
@@ -64,58 +154,251 @@ def chunk_list(data, chunksize):
         yield data[i : i + chunksize]
 
 
-def get_ext_eod_exchange(tickers_str, exchange_mic, date=None):
-    """Get EOD data for an exchange from Marketstack API"""
+def get_exchange_jobs(tickers, exchange_mic, date=None):
+    """Get the paginated requests for a date's EOD data, 100 symbols at a time"""
+    endpoint = f"exchanges/{exchange_mic}/eod/{date or 'latest'}"
+    return [
+        (endpoint, 0, {"symbols": ",".join(ticker_chunks)})
+        for ticker_chunks in chunk_list(tickers, SYMBOLS_PER_REQUEST)
+    ]
+
+
+def iter_ext_eod_exchange(
+    tickers_str,
+    exchange_mic,
+    date=None,
+    max_workers=None,
+    stats=None,
+    parse=True,
+    spool=None,
+):
+    """Yield EOD data for an exchange from Marketstack API, one symbol chunk at a time
+
+    Rows are parsed into EodRecords unless ``parse`` is false.
+    """
     logger.info("Get EOD data for an exchange from Marketstack API")
-    logger.info("First, get the list of tickers for the exchange")
-    tickers = tickers_str.split(",")
+    jobs = get_exchange_jobs(tickers_str.split(","), exchange_mic, date)
+    for data in iter_requests_with_offsets(jobs, max_workers, stats, spool):
+        yield remove_dupes(parse_eod_records(data) if parse else data, EOD_KEY)
+
+
+def get_ext_eod_exchange(tickers_str, exchange_mic, date=None, max_workers=None):
+    """Get the raw EOD rows for an exchange from Marketstack API"""
     eod_data = []
-    logger.info("Then, get the EOD data for tickers. Max is 100")
-    for ticker_chunks in chunk_list(tickers, 100):
-        extra_params = {
-            "symbols": ",".join([ticker_chunk for ticker_chunk in ticker_chunks])
-        }
-        if date is not None:
-            eod_data.extend(
-                get_requests_with_offset(
-                    f"exchanges/{exchange_mic}/eod/{date}", 0, extra_params
-                )
-            )
-        else:
-            eod_data.extend(
-                get_requests_with_offset(
-                    f"exchanges/{exchange_mic}/eod/latest", 0, extra_params
-                )
-            )
+    for data in iter_ext_eod_exchange(
+        tickers_str, exchange_mic, date, max_workers, parse=False
+    ):
+        eod_data.extend(data)
 
     return eod_data
 
 
+def split_date_range(date_from, date_to, max_trading_days):
+    """Split an inclusive date range into ranges of at most max_trading_days weekdays"""
+    day = datetime.date.fromisoformat(date_from)
+    end = datetime.date.fromisoformat(date_to)
+    ranges = []
+    range_start, trading_days = day, 0
+    while day <= end:
+        if day.weekday() < 5:
+            if trading_days == max_trading_days:
+                ranges.append((range_start, day - datetime.timedelta(days=1)))
+                range_start, trading_days = day, 0
+            trading_days += 1
+        day += datetime.timedelta(days=1)
+    ranges.append((range_start, end))
+    return [(start.isoformat(), stop.isoformat()) for start, stop in ranges]
+
+
+def get_backfill_jobs(tickers, exchange_mic, date_from, date_to):
+    """Get the paginated requests that backfill a date range for some tickers
+
+    Each symbol chunk's range is split so that one row per symbol and trading
+    day fits in MAX_PAGES pages.
+    """
+    endpoint = f"exchanges/{exchange_mic}/eod"
+    max_rows = MAX_PAGES * DEFAULT_PARAMS["limit"]
+    jobs = []
+    for ticker_chunks in chunk_list(tickers, SYMBOLS_PER_REQUEST):
+        max_trading_days = max(1, max_rows // len(ticker_chunks))
+        for start, stop in split_date_range(date_from, date_to, max_trading_days):
+            params = {
+                "symbols": ",".join(ticker_chunks),
+                "date_from": start,
+                "date_to": stop,
+            }
+            jobs.append((endpoint, 0, params))
+    return jobs
+
+
+def iter_ext_eod_exchange_range(
+    tickers_str,
+    exchange_mic,
+    date_from,
+    date_to,
+    max_workers=None,
+    stats=None,
+    spool=None,
+):
+    """Yield EOD records for an exchange over a date range, one request at a time"""
+    logger.info(
+        "Get EOD data for %s from %s to %s from Marketstack API",
+        exchange_mic,
+        date_from,
+        date_to,
+    )
+    jobs = get_backfill_jobs(tickers_str.split(","), exchange_mic, date_from, date_to)
+    for data in iter_requests_with_offsets(jobs, max_workers, stats, spool):
+        yield remove_dupes(parse_eod_records(data), EOD_KEY)
+
+
+def prefetch(iterable, depth=None):
+    """Iterate on a background thread, buffering at most depth items ahead
+
+    This lets the consumer work on one item while the next ones are being
+    produced. Errors raised by the iterable are re-raised to the consumer.
+    """
+    items = queue.Queue(maxsize=depth or FETCH_QUEUE_DEPTH)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((None, item)):
+                    return
+        except Exception as e:
+            put((e, None))
+        put((None, done))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            error, item = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
 def configure_eod_ingestor_datastore_auth(storage_name, file_system):
     """Get auth for EOD Ingestor Datastore"""
     logger.info("Getting auth for EOD Ingestor Datastore")
     global adls_service_client
-    default_credential = DefaultAzureCredential()
-    adls_service_client = DataLakeServiceClient(
-        account_url="{}://{}.dfs.core.windows.net".format(
-            "https", storage_name, file_system
-        ),
-        credential=default_credential,
-    )
+    adls_service_client = get_datalake_service_client(storage_name)
 
 
 def configure_eod_ingestor_worker_auth(storage_name, queue_name):
     """Get auth for EOD Ingestor Controller"""
     logger.info("Getting auth for EOD Ingestor Controller")
     global queue_service_client
-    default_credential = DefaultAzureCredential()
-    queue_service_client = QueueClient(
-        account_url="{}://{}.queue.core.windows.net".format("https", storage_name),
-        credential=default_credential,
-        queue_name=queue_name,
-        message_encode_policy=BinaryBase64EncodePolicy(),
-        message_decode_policy=BinaryBase64DecodePolicy(),
-    )
+    queue_service_client = get_queue_client(storage_name, queue_name)
+
+
+def upload_file(file_system_client, file_name, file_content):
+    """Upload a file in a single request, replacing any existing file"""
+    file_client = file_system_client.get_file_client(file_name)
+    file_client.upload_data(file_content, overwrite=True)
+    return len(file_content)
+
+
+def upload_files(file_system_client, files, max_workers=None, spool=None):
+    """Upload files with bounded concurrency, retrying the ones that fail
+
+    Files are consumed lazily, with at most twice the pool size waiting to be
+    uploaded. Returns the files that were uploaded and the ones that still
+    failed after UPLOAD_RETRIES retries, each with its byte count. Files the
+    ``spool`` records as uploaded are not uploaded again.
+    """
+    from azure.core.exceptions import AzureError
+
+    max_workers = max_workers or UPLOAD_CONCURRENCY
+    succeeded = []
+    errors = {}
+    failed = []
+    in_flight = {}
+
+    def collect(futures):
+        for future in futures:
+            file_name, file_content = in_flight.pop(future)
+            try:
+                upload = {"file_name": file_name, "bytes": future.result()}
+                succeeded.append(upload)
+                errors.pop(file_name, None)
+                if spool is not None:
+                    spool.add_upload(upload)
+            except AzureError as e:
+                logger.warning(f"Error uploading {file_name}: {e}")
+                errors[file_name] = str(e)
+                failed.append((file_name, file_content))
+
+    pending = files
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for attempt in range(UPLOAD_RETRIES + 1):
+            if attempt > 0:
+                logger.info("Retrying upload of %s files", len(pending))
+                time.sleep(UPLOAD_RETRY_DELAY * 2 ** (attempt - 1))
+            failed = []
+            for file_name, file_content in pending:
+                upload = spool.get_upload(file_name) if spool is not None else None
+                if upload is not None:
+                    succeeded.append(upload)
+                    continue
+                if len(in_flight) >= 2 * max_workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(
+                    upload_file, file_system_client, file_name, file_content
+                )
+                in_flight[future] = (file_name, file_content)
+            collect(as_completed(list(in_flight)))
+            pending = failed
+            if not pending:
+                break
+
+    return {"succeeded": succeeded, "failed": get_failed_uploads(pending, errors)}
+
+
+def get_failed_uploads(files, errors):
+    """Get the uploads of files that still failed, with their last error"""
+    return [
+        {"file_name": file_name, "bytes": len(file_content), "error": errors[file_name]}
+        for file_name, file_content in files
+    ]
+
+
+def get_saved_files(uploads, previous_files=()):
+    """Get the files a partition holds once a save's uploads are done
+
+    ``previous_files`` were saved by an earlier run of a resumed partition.
+    """
+    return list(previous_files) + uploads["succeeded"] + uploads["skipped"]
+
+
+def count_uploads(uploads, summary=None):
+    """Count a save's uploaded, failed and skipped files in metrics and summary"""
+    count_skipped(uploads["skipped"], summary)
+    uploaded_bytes = sum(file["bytes"] for file in uploads["succeeded"])
+    metrics.increment("files_uploaded_total", len(uploads["succeeded"]))
+    metrics.increment("upload_bytes_total", uploaded_bytes)
+    metrics.increment("upload_failures_total", len(uploads["failed"]))
+    if summary is not None:
+        summary["bytes"] += uploaded_bytes
+        summary["files"] += len(uploads["succeeded"])
 
 
 def save_eod(
@@ -123,37 +406,466 @@ def save_eod(
     eod_data,
     file_system,
     eod_ingestor_datastore_name,
+    output_format=None,
+    file_name=EOD_FILE_NAME,
+    summary=None,
+    spool=None,
+    hashes_file_name=None,
+    previous_files=(),
 ):
-    """Save EOD data for an exchange"""
+    """Save EOD data for an exchange
+
+    ``eod_data`` may be any iterable of rows; it is consumed as files are
+    written so rows do not need to be held in memory all at once. ``summary``
+    is an optional Counter updated with the time spent and bytes uploaded.
+    Uploads are checkpointed to ``spool`` when one is given. With a
+    ``hashes_file_name``, files whose records are unchanged since the
+    partition's hash manifest was saved are skipped and listed as such. The
+    manifest keeps its entries for ``previous_files``, which an earlier run of
+    a resumed partition saved.
+    """
     logger.info("Saving EOD data for an exchange")
-    eod_ingestor_datastore = {
-        "name": eod_ingestor_datastore_name,
-    }
     configure_eod_ingestor_datastore_auth(eod_ingestor_datastore_name, file_system)
 
-    for eod in eod_data:
-        file_name = f"{file_name_preffix}/{eod['symbol']}.json"
-        file_content = json.dumps(eod)
-        file_system_client = adls_service_client.get_file_system_client(file_system)
-        file_client = file_system_client.get_file_client(file_name)
-        file_client.create_file()
-        file_client.append_data(data=file_content, offset=0, length=len(file_content))
-        file_client.flush_data(len(file_content))
+    file_system_client = get_file_system_client(
+        eod_ingestor_datastore_name, file_system
+    )
+    output_format = output_format or DEFAULT_OUTPUT_FORMAT
+    hashes = {}
+    skipped = []
+    hashes_file_name = get_hashes_path(file_name_preffix, hashes_file_name)
+    with metrics.timer("save_eod", summary):
+        if hashes_file_name is not None:
+            previous = load_hashes(file_system_client, hashes_file_name)
+            hashes.update(
+                get_resumed_hashes(
+                    previous, output_format, file_name_preffix, previous_files
+                )
+            )
+            files = get_changed_output_files(
+                file_name_preffix,
+                eod_data,
+                output_format,
+                file_name,
+                previous,
+                hashes,
+                skipped,
+            )
+        else:
+            files = get_output_files(
+                file_name_preffix, eod_data, output_format, file_name
+            )
+        uploads = upload_files(file_system_client, files, spool=spool)
+        uploads["skipped"] = skipped
+        if hashes_file_name is not None and not uploads["failed"]:
+            save_hashes(
+                file_system_client,
+                hashes_file_name,
+                output_format,
+                hashes,
+                get_saved_files(uploads, previous_files),
+            )
+    count_uploads(uploads, summary)
+    return uploads
 
 
 def log_eod_ingestor_worker_status(
-    success_file_contents, file_name_preffix, file_system
+    success_file_contents,
+    file_name_preffix,
+    file_system,
+    eod_ingestor_datastore_name=None,
+    status_file_name="EODSTATUS",
 ):
     """Log EOD Ingestor Worker status"""
     logger.info("Logging EOD Ingestor Worker status")
-    file_name = f"{file_name_preffix}/EODSTATUS.json"
-    file_system_client = adls_service_client.get_file_system_client(file_system)
-    file_client = file_system_client.get_file_client(file_name)
-    file_client.create_file()
-    file_client.append_data(
-        data=success_file_contents, offset=0, length=len(success_file_contents)
+    file_name = f"{file_name_preffix}/{status_file_name}.json"
+    if eod_ingestor_datastore_name is not None:
+        file_system_client = get_file_system_client(
+            eod_ingestor_datastore_name, file_system
+        )
+    else:
+        file_system_client = adls_service_client.get_file_system_client(file_system)
+    upload_file(file_system_client, file_name, success_file_contents)
+
+
+@contextlib.contextmanager
+def keep_message_visible(msg, visibility_timeout=None):
+    """Keep renewing a message's visibility timeout while it is being processed
+
+    The message's pop receipt is updated in place so it can still be deleted
+    once processing is done.
+    """
+    from azure.core.exceptions import AzureError
+
+    visibility_timeout = visibility_timeout or VISIBILITY_TIMEOUT
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(visibility_timeout / 2):
+            try:
+                updated = queue_service_client.update_message(
+                    msg, visibility_timeout=visibility_timeout
+                )
+                msg.pop_receipt = updated.pop_receipt
+                msg.next_visible_on = updated.next_visible_on
+            except AzureError as e:
+                logger.warning(f"Error renewing visibility of message {msg.id}: {e}")
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield msg
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def get_message_tickers(message):
+    """Get a message's tickers, reading them from the datastore if they were spilled"""
+    if "tickers_path" not in message:
+        return message["tickers"]
+    logger.info("Reading tickers from %s", message["tickers_path"])
+    file_system_client = get_file_system_client(
+        message["eod_datastore_name"], message["eod_datastore_container"]
+    )
+    file_client = file_system_client.get_file_client(message["tickers_path"])
+    return file_client.download_file().readall().decode()
+
+
+def partition_eod_by_date(message, eod_data):
+    """Group EOD rows by the date/mic or mic/date partition they belong to"""
+    partitions = {}
+    prefixes = {}
+    for eod in eod_data:
+        date = eod.date[:10]
+        if date not in prefixes:
+            prefixes[date] = get_file_name_preffix({**message, "date": date})
+        partitions.setdefault(prefixes[date], []).append(eod)
+    return partitions
+
+
+def get_eod_ingestor_worker_status(
+    file_name_preffix,
+    file_system,
+    eod_ingestor_datastore_name,
+    status_file_name="EODSTATUS",
+):
+    """Get the EOD Ingestor Worker status left by an earlier run, if any"""
+    from azure.core.exceptions import ResourceNotFoundError
+
+    file_system_client = get_file_system_client(
+        eod_ingestor_datastore_name, file_system
+    )
+    file_client = file_system_client.get_file_client(
+        f"{file_name_preffix}/{status_file_name}.json"
+    )
+    try:
+        return serialization.loads(file_client.download_file().readall())
+    except ResourceNotFoundError:
+        return None
+
+
+def get_pending_tickers(tickers, file_name_preffix, output_format, status):
+    """Get the tickers an earlier, partially failed run did not save yet
+
+    Only the per-symbol layout can be resumed; consolidated files are written
+    again in full.
+    """
+    if status is None or output_format not in PER_SYMBOL_FORMATS:
+        return tickers
+    saved = {file["file_name"] for file in status.get("files", [])}
+    return [
+        ticker
+        for ticker in tickers
+        if get_symbol_file_name(file_name_preffix, ticker) not in saved
+    ]
+
+
+def is_ingested(status):
+    """Tell whether a status file reports its partition as ingested"""
+    return status is not None and status.get("status") == "success"
+
+
+def get_resume_plan(tickers, file_name_preffix, output_format, status):
+    """Get the tickers a message still has to fetch and the files already saved
+
+    Without an earlier ``status`` every ticker is fetched. A resumed run keeps
+    the files an earlier run saved when they are per-symbol files.
+    """
+    pending = get_pending_tickers(tickers, file_name_preffix, output_format, status)
+    if status is None:
+        return pending, []
+    logger.info("Resuming %s with %s tickers", file_name_preffix, len(pending))
+    if output_format not in PER_SYMBOL_FORMATS:
+        return pending, []
+    return pending, status.get("files", [])
+
+
+def finish_summary(summary, requests, spool, started, tickers=None):
+    """Add a message's pages, spool stats, tickers and total time to its summary"""
+    if spool is not None:
+        summary.update(spool.stats)
+    summary["pages"] = sum(requests.values())
+    if tickers is not None:
+        summary["tickers"] = len(tickers)
+    summary["total_seconds"] = time.perf_counter() - started
+
+
+def get_status_files(
+    message, output_format, partition_uploads, requests, summary, previous_files=()
+):
+    """Get the EODSTATUS contents of every partition a message wrote to
+
+    ``partition_uploads`` maps each partition's file name prefix to its
+    uploads. ``previous_files`` only apply to a single, resumed partition.
+    """
+    return {
+        file_name_preffix: get_status_file_contents(
+            message,
+            file_name_preffix,
+            output_format,
+            get_saved_files(uploads, previous_files),
+            uploads["failed"],
+            requests,
+            summary,
+        )
+        for file_name_preffix, uploads in partition_uploads.items()
+    }
+
+
+def should_delete_message(partition_uploads):
+    """Tell whether a message is done with, counting it as failed if it is not
+
+    A message with failed uploads is left on the queue to be retried.
+    """
+    failed_files = sum(len(uploads["failed"]) for uploads in partition_uploads.values())
+    if failed_files:
+        logger.warning("%s uploads failed, leaving message on the queue", failed_files)
+        metrics.increment("messages_processed_total", status="failed")
+        return False
+    return True
+
+
+def get_status_file_contents(
+    message,
+    file_name_preffix,
+    output_format,
+    files,
+    failed_files,
+    requests=None,
+    summary=None,
+):
+    """Get the EODSTATUS contents for the files a message wrote to a partition
+
+    ``requests`` counts the Marketstack requests the message made per endpoint
+    and ``summary`` holds the message's pages, rows, bytes and stage durations.
+    """
+    return json.dumps(
+        {
+            "status": "failed" if failed_files else "success",
+            "message": (
+                "EOD data ingested with failed uploads"
+                if failed_files
+                else "EOD data ingested successfully"
+            ),
+            "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "file_name_preffix": file_name_preffix,
+            "output_format": output_format,
+            "shard": message.get("shard", 0),
+            "shard_count": message.get("shard_count", 1),
+            "file_count": len(files),
+            "bytes": sum(file["bytes"] for file in files),
+            "files": files,
+            "failed_files": failed_files,
+            "requests": dict(requests or {}),
+            "summary": {
+                name: round(value, 3) if isinstance(value, float) else value
+                for name, value in (summary or {}).items()
+            },
+        },
+        indent=4,
     )
-    file_client.flush_data(len(success_file_contents))
+
+
+def count_rows(eod_chunks, summary):
+    """Yield EOD chunks, counting their rows in summary"""
+    for eod_chunk in eod_chunks:
+        summary["rows"] += len(eod_chunk)
+        metrics.increment("rows_fetched_total", len(eod_chunk))
+        yield eod_chunk
+
+
+def delete_message(msg, status="success"):
+    """Delete a message from the queue once it has been dealt with"""
+    with metrics.timer("queue_delete"):
+        queue_service_client.delete_message(msg)
+    metrics.increment("messages_processed_total", status=status)
+
+
+def process_backfill_message(msg, message):
+    """Ingest the EOD data for a date range, writing one partition per date
+
+    Every partition is written again and gets its own status file, as daily
+    runs do. The summary in each status file covers the whole message.
+    """
+    started = time.perf_counter()
+    file_system = message["eod_datastore_container"]
+    status_file_name = get_shard_file_name("EODSTATUS", message)
+    output_format = message.get("output_format", DEFAULT_OUTPUT_FORMAT)
+    requests = Counter()
+    summary = Counter()
+    with keep_message_visible(msg), open_spool(msg.id) as spool:
+        eod_chunks = prefetch(
+            metrics.timed_iter(
+                "fetch",
+                iter_ext_eod_exchange_range(
+                    get_message_tickers(message),
+                    message["exchange_mic"],
+                    message["date_from"],
+                    message["date_to"],
+                    stats=requests,
+                    spool=spool,
+                ),
+                summary,
+            )
+        )
+        partitions = partition_eod_by_date(
+            message, itertools.chain.from_iterable(count_rows(eod_chunks, summary))
+        )
+        logger.info("Saving %s partitions", len(partitions))
+        partition_uploads = {}
+        for file_name_preffix, eod_data in partitions.items():
+            partition_uploads[file_name_preffix] = save_eod(
+                file_name_preffix,
+                eod_data,
+                file_system,
+                message["eod_datastore_name"],
+                output_format,
+                get_shard_file_name(EOD_FILE_NAME, message),
+                summary,
+                spool,
+                get_shard_file_name(HASHES_FILE_NAME, message),
+            )
+        finish_summary(summary, requests, spool, started)
+        status_files = get_status_files(
+            message, output_format, partition_uploads, requests, summary
+        )
+        for file_name_preffix, status_file_contents in status_files.items():
+            log_eod_ingestor_worker_status(
+                status_file_contents,
+                file_name_preffix,
+                file_system,
+                message["eod_datastore_name"],
+                status_file_name,
+            )
+    if should_delete_message(partition_uploads):
+        delete_message(msg)
+        remove_spool(msg.id)
+
+
+def process_message(msg):
+    """Ingest the EOD data requested by a queue message and delete it when done
+
+    Exchange-dates whose EODSTATUS already reports success are skipped, and a
+    run that failed part way only fetches the symbols it did not save.
+    """
+    started = time.perf_counter()
+    message = decode_message(msg.content)
+    if message.get("type") == "EOD_BACKFILL":
+        return process_backfill_message(msg, message)
+    file_system = message["eod_datastore_container"]
+    file_name_preffix = get_file_name_preffix(message)
+    status_file_name = get_shard_file_name("EODSTATUS", message)
+    output_format = message.get("output_format", DEFAULT_OUTPUT_FORMAT)
+    status = None
+    if not message.get("force"):
+        status = get_eod_ingestor_worker_status(
+            file_name_preffix,
+            file_system,
+            message["eod_datastore_name"],
+            status_file_name,
+        )
+    if is_ingested(status):
+        logger.info("%s was already ingested, skipping", file_name_preffix)
+        delete_message(msg, status="skipped")
+        return
+
+    with keep_message_visible(msg), open_spool(msg.id) as spool:
+        tickers, previous_files = get_resume_plan(
+            get_message_tickers(message).split(","),
+            file_name_preffix,
+            output_format,
+            status,
+        )
+        requests = Counter()
+        summary = Counter()
+        eod_chunks = prefetch(
+            metrics.timed_iter(
+                "fetch",
+                iter_ext_eod_exchange(
+                    ",".join(tickers),
+                    message["exchange_mic"],
+                    message["date"],
+                    stats=requests,
+                    spool=spool,
+                ),
+                summary,
+            )
+            if tickers
+            else []
+        )
+        eod_data = itertools.chain.from_iterable(count_rows(eod_chunks, summary))
+        partition_uploads = {
+            file_name_preffix: save_eod(
+                file_name_preffix,
+                eod_data,
+                file_system,
+                message["eod_datastore_name"],
+                output_format,
+                get_shard_file_name(EOD_FILE_NAME, message),
+                summary,
+                spool,
+                get_shard_file_name(HASHES_FILE_NAME, message),
+                previous_files,
+            )
+        }
+        finish_summary(summary, requests, spool, started, tickers)
+        status_files = get_status_files(
+            message, output_format, partition_uploads, requests, summary, previous_files
+        )
+        log_eod_ingestor_worker_status(
+            status_files[file_name_preffix],
+            file_name_preffix,
+            file_system,
+            message["eod_datastore_name"],
+            status_file_name,
+        )
+    if should_delete_message(partition_uploads):
+        delete_message(msg)
+        remove_spool(msg.id)
+
+
+def process_message_safely(msg):
+    """Process a message, leaving it on the queue if anything goes wrong"""
+    try:
+        process_message(msg)
+    except Exception as e:
+        logger.exception(f"Error processing message {msg.id}: {e}")
+        metrics.increment("messages_processed_total", status="error")
+    finally:
+        metrics.write_textfile()
+
+
+def receive_messages(max_messages):
+    """Receive up to max_messages messages from the queue"""
+    with metrics.timer("queue_receive"):
+        return list(
+            queue_service_client.receive_messages(
+                messages_per_page=max_messages,
+                max_messages=max_messages,
+                visibility_timeout=VISIBILITY_TIMEOUT,
+            )
+        )
 
 
 def process_messages():
@@ -161,53 +873,82 @@ def process_messages():
     properties = queue_service_client.get_queue_properties()
     if properties.approximate_message_count > 0:
         messages = queue_service_client.receive_messages(
-            messages_per_page=1, visibility_timeout=5 * 60
+            messages_per_page=1, visibility_timeout=VISIBILITY_TIMEOUT
         )
-        for msg_batch in messages.by_page():
+        for msg_batch in metrics.timed_iter("queue_receive", messages.by_page()):
             for msg in msg_batch:
-                # try:
-                message = json.loads(base64.b64decode(msg.content).decode("utf-8"))
-                file_system = message["eod_datastore_container"]
-                eod_data = get_ext_eod_exchange(
-                    message["tickers"], message["exchange_mic"], message["date"]
-                )
-                if strtobool(message["partition_by_date"]):
-                    logger.info("Partitioning by date")
-                    file_name_preffix = f'{message["date"]}/{message["exchange_mic"]}'
-                else:
-                    file_name_preffix = f'{message["exchange_mic"]}/{message["date"]}'
-
-                save_eod(
-                    file_name_preffix,
-                    eod_data,
-                    file_system,
-                    message["eod_datastore_name"],
-                )
-                success_file_contents = json.dumps(
-                    {
-                        "status": "success",
-                        "message": "EOD data ingested successfully",
-                        "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "file_name_preffix": file_name_preffix,
-                    },
-                    indent=4,
-                )
-                log_eod_ingestor_worker_status(
-                    success_file_contents, file_name_preffix, file_system
+                process_message(msg)
+                metrics.write_textfile()
+
+
+def handle_shutdown_signal(signum, frame):
+    """Stop receiving new messages once the in-flight ones are done"""
+    logger.info("Received signal %s, shutting down", signum)
+    shutdown.set()
+
+
+def run_daemon():
+    """Keep receiving and processing messages until asked to shut down
+
+    Up to MESSAGE_CONCURRENCY messages are processed at once. When the queue is
+    empty, polling backs off exponentially up to IDLE_BACKOFF_MAX seconds.
+    """
+    from azure.core.exceptions import AzureError
+
+    logger.info("Running EOD Ingestor as a daemon")
+    idle_delay = 0
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=MESSAGE_CONCURRENCY) as executor:
+        while not shutdown.is_set():
+            in_flight = {future for future in in_flight if not future.done()}
+            free_slots = MESSAGE_CONCURRENCY - len(in_flight)
+            if free_slots == 0:
+                wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                continue
+            try:
+                messages = receive_messages(min(free_slots, RECEIVE_BATCH_SIZE))
+            except AzureError as e:
+                logger.warning(f"Error receiving messages: {e}")
+                messages = []
+            if not messages:
+                idle_delay = min(
+                    max(IDLE_BACKOFF_MIN, idle_delay * 2), IDLE_BACKOFF_MAX
                 )
-                queue_service_client.delete_message(msg)
-                # except Exception as e:
-                #   logger.warning(f"Error processing message: {e}")
+                shutdown.wait(idle_delay)
+                continue
+            idle_delay = 0
+            for msg in messages:
+                in_flight.add(executor.submit(process_message_safely, msg))
+        logger.info("Waiting for %s messages in flight", len(in_flight))
+        wait(in_flight)
 
 
 def main():
     """Main function"""
     logger.info("Starting EOD Ingestor")
-    configure_eod_ingestor_worker_auth(
-        os.getenv("EOD_INGESTOR_STROAGE_NAME"), os.getenv("EOD_INGESTOR_STROAGE_QUEUE")
-    )
-    process_messages()
+    if metrics.METRICS_PORT:
+        metrics.start_http_server()
+    prune_spools()
+    storage_name = os.getenv("EOD_INGESTOR_STROAGE_NAME")
+    queue_name = os.getenv("EOD_INGESTOR_STROAGE_QUEUE")
+    configure_eod_ingestor_worker_auth(storage_name, queue_name)
+    daemon = parse_bool(os.getenv("EOD_INGESTOR_DAEMON", "false"))
+    if daemon:
+        signal.signal(signal.SIGTERM, handle_shutdown_signal)
+        signal.signal(signal.SIGINT, handle_shutdown_signal)
+    if parse_bool(os.getenv("EOD_INGESTOR_ASYNC", "false")):
+        import asyncio
+        from . import async_worker
+
+        asyncio.run(async_worker.run(daemon, storage_name, queue_name, shutdown))
+    elif daemon:
+        run_daemon()
+    else:
+        process_messages()
 
+    log_client_cache_stats()
+    marketstack.log_request_stats()
+    metrics.write_textfile()
     logger.info("EOD Ingestor finished")
 
 
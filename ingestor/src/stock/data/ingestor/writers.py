@@ -0,0 +1,161 @@
+import datetime
+import gzip
+import io
+import logging
+import os
+from .records import EOD_PRICE_FIELDS, EOD_STRING_FIELDS, as_eod_records
+from .serialization import get_default_serializer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_FORMAT = os.getenv("EOD_OUTPUT_FORMAT", "json")
+EOD_FILE_NAME = "eod"
+PARQUET_ROW_GROUP_SIZE = int(os.getenv("EOD_PARQUET_ROW_GROUP_SIZE", "10000"))
+
+
+def get_symbol_file_name(file_name_preffix, symbol):
+    """Get the name of a symbol's file in the per-symbol layout"""
+    return f"{file_name_preffix}/{symbol}.json"
+
+
+class JsonWriter:
+    """Write one JSON file per symbol, the original output layout"""
+
+    def __init__(self, file_name_preffix, file_name=EOD_FILE_NAME):
+        self.file_name_preffix = file_name_preffix
+        self._dumps_record = get_default_serializer().dumps_record
+
+    def write(self, eod_data):
+        for eod in eod_data:
+            file_name = get_symbol_file_name(self.file_name_preffix, eod.symbol)
+            yield file_name, self._dumps_record(eod)
+
+    def close(self):
+        return []
+
+
+class NdjsonWriter:
+    """Write a single gzipped newline delimited JSON file for all symbols"""
+
+    def __init__(self, file_name_preffix, file_name=EOD_FILE_NAME):
+        self.file_name = f"{file_name_preffix}/{file_name}.ndjson.gz"
+        self._dumps_record = get_default_serializer().dumps_record
+        self._buffer = io.BytesIO()
+        self._gzip_file = gzip.GzipFile(fileobj=self._buffer, mode="wb")
+
+    def write(self, eod_data):
+        for eod in eod_data:
+            self._gzip_file.write(self._dumps_record(eod))
+            self._gzip_file.write(b"\n")
+        return []
+
+    def close(self):
+        self._gzip_file.close()
+        return [(self.file_name, self._buffer.getvalue())]
+
+
+def parse_eod_date(value):
+    """Parse a Marketstack EOD date such as 2020-01-01T00:00:00+0000"""
+    if value is None:
+        return None
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+
+
+class ParquetWriter:
+    """Write a single Parquet file with typed columns for all symbols
+
+    Rows are written in row groups of PARQUET_ROW_GROUP_SIZE so only one group
+    is held as Python objects at a time.
+    """
+
+    def __init__(self, file_name_preffix, file_name=EOD_FILE_NAME):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError(
+                "The parquet output format requires pyarrow, from the parquet extra"
+            ) from e
+
+        self.file_name = f"{file_name_preffix}/{file_name}.parquet"
+        self._pa = pa
+        self._schema = pa.schema(
+            [
+                ("date", pa.timestamp("s", tz="UTC")),
+                *[(field, pa.string()) for field in EOD_STRING_FIELDS],
+                *[(field, pa.float64()) for field in EOD_PRICE_FIELDS],
+            ]
+        )
+        self._buffer = io.BytesIO()
+        self._parquet_writer = pq.ParquetWriter(
+            self._buffer, self._schema, compression="snappy"
+        )
+        self._columns = self._get_empty_columns()
+
+    def _get_empty_columns(self):
+        return {field: [] for field in self._schema.names}
+
+    def _write_row_group(self):
+        self._parquet_writer.write_table(
+            self._pa.Table.from_pydict(self._columns, schema=self._schema)
+        )
+        self._columns = self._get_empty_columns()
+
+    def write(self, eod_data):
+        for eod in eod_data:
+            self._columns["date"].append(parse_eod_date(eod.date))
+            for field in EOD_STRING_FIELDS + EOD_PRICE_FIELDS:
+                self._columns[field].append(getattr(eod, field))
+            if len(self._columns["date"]) >= PARQUET_ROW_GROUP_SIZE:
+                self._write_row_group()
+        return []
+
+    def close(self):
+        if self._columns["date"]:
+            self._write_row_group()
+        self._parquet_writer.close()
+        return [(self.file_name, self._buffer.getvalue())]
+
+
+OUTPUT_FORMATS = {
+    "json": JsonWriter,
+    "ndjson": NdjsonWriter,
+    "parquet": ParquetWriter,
+}
+# Formats that write one file per symbol rather than one file per message
+PER_SYMBOL_FORMATS = {"json"}
+
+
+def get_output_writer(file_name_preffix, output_format=None, file_name=EOD_FILE_NAME):
+    """Get the writer of a message's EOD data in an output format
+
+    A writer's ``write`` takes EodRecords and returns the (file name, content)
+    pairs that are complete, lazily for the per-symbol layout; ``close``
+    returns the rest. ``file_name`` names consolidated files and is ignored by
+    the per-symbol layout.
+    """
+    output_format = output_format or DEFAULT_OUTPUT_FORMAT
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    logger.info("Writing EOD data as %s", output_format)
+    return OUTPUT_FORMATS[output_format](file_name_preffix, file_name)
+
+
+def iter_output_files(writer, eod_data):
+    """Write EodRecords with a writer, yielding its files as they are complete"""
+    yield from writer.write(eod_data)
+    yield from writer.close()
+
+
+def get_output_files(
+    file_name_preffix, eod_data, output_format=None, file_name=EOD_FILE_NAME
+):
+    """Get the (file name, content) pairs to upload for a message's EOD data
+
+    ``eod_data`` holds EodRecords, or Marketstack dicts that are parsed on the
+    way. It is consumed lazily; per-symbol files are yielded as their rows
+    arrive, consolidated files once every row has been written.
+    """
+    writer = get_output_writer(file_name_preffix, output_format, file_name)
+    return iter_output_files(writer, as_eod_records(eod_data))
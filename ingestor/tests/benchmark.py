@@ -0,0 +1,266 @@
+"""Benchmark the controller and worker against the offline fakes
+
+Run from the ingestor directory, for example::
+
+    python -m tests.benchmark --tickers 100 1000 10000 --latency 0.02
+
+Each exchange size runs in its own process so peak RSS is measured per run.
+``create_job_messages`` is only timed when stock.data.model is installed;
+otherwise the job messages are built directly. ``--rows`` instead compares the
+memory, decode and encode time of raw EOD dicts and of EodRecords with each
+JSON backend. ``--async`` runs the asyncio worker instead of the threaded one.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import time
+import timeit
+import tracemalloc
+from collections import deque
+from unittest.mock import patch
+from src.stock.data.ingestor import async_worker, marketstack, ratelimit, worker
+from src.stock.data.ingestor.messages import encode_message
+from src.stock.data.ingestor.records import parse_eod_records
+from src.stock.data.ingestor.serialization import SERIALIZERS, get_serializer
+from tests.fakes import FakeMarketstack, get_eod_row, install_fake_clients
+
+STORAGE_NAME = "storage"
+QUEUE_NAME = "queue"
+DATASTORE_NAME = "datastore"
+FILE_SYSTEM = "eod"
+
+
+def get_tickers(count):
+    return [f"T{i:05d}" for i in range(count)]
+
+
+def create_messages_with_controller(queue_client, tickers):
+    """Time create_job_messages against a SQLite database of one exchange"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from stock.data.model import models
+    from stock.data.model.database import Base
+    from src.stock.data.ingestor import controller
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add(models.TimezoneModel(id=1, name="America/New_York", abbr="EST", dst="EDT"))
+    db.add(models.CountryModel(id=1, name="USA", code="US"))
+    db.add(models.CityModel(id=1, name="New York", country_id=1))
+    db.add(
+        models.ExchangeModel(
+            id=1,
+            name="XNAS",
+            acronym="XNAS",
+            mic="XNAS",
+            country_id=1,
+            city_id=1,
+            timezone_id=1,
+        )
+    )
+    db.add(
+        models.EodIngestorDataStoreModel(
+            id=1,
+            name=DATASTORE_NAME,
+            url="",
+            container=FILE_SYSTEM,
+            subscription_id="",
+        )
+    )
+    db.add_all(
+        models.TickerModel(ticker=ticker, name=ticker, exchange_id=1)
+        for ticker in tickers
+    )
+    db.commit()
+    controller.configure_eod_ingestor_controller_auth(STORAGE_NAME, QUEUE_NAME)
+    exchanges = db.query(models.ExchangeModel).all()
+    started = time.perf_counter()
+    with patch.dict(os.environ, {"EOD_DATASTORE_ID": "1"}), patch.object(
+        controller, "MANIFEST_PATH", None
+    ):
+        controller.create_job_messages(db, exchanges)
+    return time.perf_counter() - started
+
+
+def create_messages_directly(queue_client, tickers, shard_size=500):
+    """Enqueue job messages the way the controller shards them"""
+    started = time.perf_counter()
+    shards = [tickers[i : i + shard_size] for i in range(0, len(tickers), shard_size)]
+    for shard, shard_tickers in enumerate(shards):
+        queue_client.send_message(
+            encode_message(
+                {
+                    "exchange": "XNAS",
+                    "exchange_mic": "XNAS",
+                    "date": time.strftime("%Y-%m-%d"),
+                    "type": "EOD",
+                    "eod_datastore_name": DATASTORE_NAME,
+                    "eod_datastore_container": FILE_SYSTEM,
+                    "partition_by_date": "true",
+                    "output_format": os.getenv("EOD_OUTPUT_FORMAT", "json"),
+                    "shard": shard,
+                    "shard_count": len(shards),
+                    "tickers": ",".join(shard_tickers),
+                }
+            )
+        )
+    return time.perf_counter() - started
+
+
+def run_benchmark(ticker_count, options):
+    """Enqueue and process the jobs of one synthetic exchange"""
+    tickers = get_tickers(ticker_count)
+    with FakeMarketstack(
+        latency=options["latency"],
+        error_rate=options["error_rate"],
+        throttle_rate=options["throttle_rate"],
+    ) as server, patch.object(marketstack, "MARKETSTACK_API", server.url), patch.object(
+        ratelimit, "_limiter", ratelimit.TokenBucket(rate=options["rate_limit"])
+    ):
+        queue_client, service_client = install_fake_clients(
+            STORAGE_NAME,
+            QUEUE_NAME,
+            DATASTORE_NAME,
+            FILE_SYSTEM,
+            options["upload_error_rate"],
+        )
+        try:
+            controller_time = create_messages_with_controller(queue_client, tickers)
+            controller = "create_job_messages"
+        except ImportError:
+            controller_time = create_messages_directly(queue_client, tickers)
+            controller = "direct"
+
+        worker.configure_eod_ingestor_worker_auth(STORAGE_NAME, QUEUE_NAME)
+        started = time.perf_counter()
+        if options["async"]:
+            asyncio.run(async_worker.run(False, STORAGE_NAME, QUEUE_NAME))
+        else:
+            worker.process_messages()
+        worker_time = time.perf_counter() - started
+
+    file_system_stats = service_client.get_file_system_client(FILE_SYSTEM).stats
+    return {
+        "tickers": ticker_count,
+        "messages": queue_client.stats["sent"],
+        "controller": controller,
+        "worker": "async" if options["async"] else "threaded",
+        "controller_seconds": round(controller_time, 3),
+        "worker_seconds": round(worker_time, 3),
+        "rows": server.stats["rows"],
+        "rows_per_second": round(server.stats["rows"] / worker_time, 1),
+        "requests": server.stats["requests"],
+        "throttled": server.stats["status_429"],
+        "errors": server.stats["status_500"],
+        "uploads": file_system_stats["uploads"],
+        "upload_bytes": file_system_stats["bytes"],
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+def get_rows_cases():
+    """Get how each representation and JSON backend decodes and encodes rows"""
+    cases = [("dict", "json", json.loads, lambda rows: rows, json.dumps)]
+    for backend in SERIALIZERS:
+        try:
+            serializer = get_serializer(backend)
+        except RuntimeError:
+            continue
+        cases.append(
+            (
+                "record",
+                backend,
+                serializer.loads,
+                parse_eod_records,
+                serializer.dumps_record,
+            )
+        )
+    return cases
+
+
+def run_rows_benchmark(row_count):
+    """Compare memory, decode and encode time per EOD row"""
+    content = json.dumps(
+        [get_eod_row(symbol, "XNAS", "2020-01-02") for symbol in get_tickers(row_count)]
+    ).encode()
+    results = []
+    for representation, backend, load, parse, serialize in get_rows_cases():
+        tracemalloc.start()
+        eod_data = parse(load(content))
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        rows = load(content)
+        decode_time = min(timeit.repeat(lambda: load(content), number=1, repeat=3))
+        parse_time = min(timeit.repeat(lambda: parse(rows), number=1, repeat=3))
+        # Lines are written out one at a time, as the writers stream them
+        encode_time = min(
+            timeit.repeat(
+                lambda: deque(map(serialize, eod_data), maxlen=0), number=1, repeat=3
+            )
+        )
+        results.append(
+            {
+                "rows": row_count,
+                "representation": representation,
+                "backend": backend,
+                "bytes_per_row": round(memory / row_count),
+                "decode_us_per_row": round(decode_time / row_count * 1e6, 2),
+                "parse_us_per_row": round(parse_time / row_count * 1e6, 2),
+                "encode_us_per_row": round(encode_time / row_count * 1e6, 2),
+            }
+        )
+    return results
+
+
+def run_in_process(ticker_count, options):
+    """Run one benchmark in a fresh process so its peak RSS is its own"""
+    context = multiprocessing.get_context("fork")
+    with context.Pool(1) as pool:
+        return pool.apply(run_benchmark, (ticker_count, options))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--upload-error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--async", action="store_true", dest="use_async")
+    parser.add_argument("--rows", type=int, help="Benchmark EOD rows instead")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+    options = {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "throttle_rate": args.throttle_rate,
+        "upload_error_rate": args.upload_error_rate,
+        "rate_limit": args.rate_limit,
+        "async": args.use_async,
+    }
+
+    if args.rows:
+        results = run_rows_benchmark(args.rows)
+    else:
+        results = [
+            run_in_process(ticker_count, options) for ticker_count in args.tickers
+        ]
+    columns = list(results[0])
+    print("  ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print("  ".join(f"{result[column]!s:>18}" for column in columns))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"options": options, "results": results}, output_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
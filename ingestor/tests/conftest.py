@@ -0,0 +1,20 @@
+from unittest.mock import patch
+import pytest
+from src.stock.data.ingestor import clients, marketstack, ratelimit, worker
+from tests.fakes import FakeMarketstack, install_fake_clients
+
+
+@pytest.fixture
+def fake_services():
+    with FakeMarketstack(throttle_rate=0.1, error_rate=0.05) as server, patch.object(
+        marketstack, "MARKETSTACK_API", server.url
+    ), patch.object(marketstack, "BACKOFF_FACTOR", 0), patch.object(
+        ratelimit, "_limiter", ratelimit.TokenBucket(rate=0)
+    ), patch.dict(
+        clients._clients
+    ):
+        queue_client, service_client = install_fake_clients(
+            "storage", "queue", "datastore", "eod"
+        )
+        worker.configure_eod_ingestor_worker_auth("storage", "queue")
+        yield server, queue_client, service_client.get_file_system_client("eod")
@@ -0,0 +1,442 @@
+"""Offline stand-ins for the Marketstack API and the Azure storage clients"""
+
+import datetime
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+from azure.core.exceptions import (
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+    ServiceRequestError,
+)
+from src.stock.data.ingestor import clients
+from src.stock.data.ingestor.messages import encode_message
+
+
+def get_trading_days(date_from, date_to):
+    """Get the weekdays of an inclusive date range"""
+    day = datetime.date.fromisoformat(date_from)
+    end = datetime.date.fromisoformat(date_to)
+    days = []
+    while day <= end:
+        if day.weekday() < 5:
+            days.append(day.isoformat())
+        day += datetime.timedelta(days=1)
+    return days
+
+
+def get_eod_row(symbol, exchange_mic, date):
+    """Get a synthetic Marketstack EOD row"""
+    price = float(sum(map(ord, symbol)) % 500 + 1)
+    return {
+        "open": price,
+        "high": price * 1.01,
+        "low": price * 0.99,
+        "close": price,
+        "volume": 1000.0,
+        "adj_high": price * 1.01,
+        "adj_low": price * 0.99,
+        "adj_close": price,
+        "adj_open": price,
+        "adj_volume": 1000.0,
+        "split_factor": 1.0,
+        "dividend": 0.0,
+        "symbol": symbol,
+        "exchange": exchange_mic,
+        "date": f"{date}T00:00:00+0000",
+    }
+
+
+class FakeMarketstack:
+    """A local Marketstack HTTP server serving synthetic exchange EOD data
+
+    Serves ``exchanges/{mic}/eod/{date}`` and ``exchanges/{mic}/eod`` with
+    ``symbols``, ``date_from``/``date_to``, ``offset`` and ``limit``. Each
+    request waits ``latency`` seconds and fails with a 500 or a 429 at the
+    given rates.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self._server.server_address)
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def get_status(self):
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.error_rate:
+            return 500
+        if roll < self.error_rate + self.throttle_rate:
+            return 429
+        return 200
+
+    def get_page(self, path, query):
+        parts = path.strip("/").split("/")
+        if len(parts) < 3 or parts[0] != "exchanges" or parts[2] != "eod":
+            return None
+        exchange_mic = parts[1]
+        if len(parts) > 3:
+            dates = [parts[3]]
+        else:
+            dates = get_trading_days(query["date_from"], query["date_to"])
+        symbols = query.get("symbols", "").split(",")
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 100))
+        total = len(symbols) * len(dates)
+        rows = [
+            get_eod_row(symbol, exchange_mic, date)
+            for symbol, date in itertools.islice(
+                itertools.product(symbols, dates), offset, offset + limit
+            )
+        ]
+        return {
+            "pagination": {
+                "limit": limit,
+                "offset": offset,
+                "count": len(rows),
+                "total": total,
+            },
+            "data": {"name": exchange_mic, "mic": exchange_mic, "eod": rows},
+        }
+
+    def handle(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(request.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        status = self.get_status()
+        body = {"error": {"code": status}}
+        if status == 200:
+            body = self.get_page(url.path, query)
+            if body is None:
+                status, body = 404, {"error": {"code": "not_found"}}
+        content = json.dumps(body).encode()
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats[f"status_{status}"] += 1
+            if status == 200:
+                self.stats["rows"] += len(body["data"]["eod"])
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(content)))
+        if status == 429:
+            request.send_header("Retry-After", "0")
+        request.end_headers()
+        request.wfile.write(content)
+
+
+class FakeMessagePager:
+    """Pages of received messages, like the queue client's ItemPaged"""
+
+    def __init__(self, queue_client, messages_per_page, max_messages, timeout):
+        self._queue_client = queue_client
+        self._messages_per_page = messages_per_page or 1
+        self._max_messages = max_messages
+        self._timeout = timeout
+
+    def by_page(self):
+        received = 0
+        while self._max_messages is None or received < self._max_messages:
+            count = self._messages_per_page
+            if self._max_messages is not None:
+                count = min(count, self._max_messages - received)
+            page = self._queue_client.take_visible(count, self._timeout)
+            if not page:
+                return
+            received += len(page)
+            yield iter(page)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.by_page())
+
+
+class FakeQueueClient:
+    """An in-memory queue with visibility timeouts and pop receipts"""
+
+    def __init__(self):
+        self.messages = {}
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def send_message(self, content, **kwargs):
+        message = SimpleNamespace(
+            id=str(uuid.uuid4()),
+            content=content,
+            pop_receipt=None,
+            next_visible_on=0.0,
+            dequeue_count=0,
+        )
+        with self._lock:
+            self.messages[message.id] = message
+            self.stats["sent"] += 1
+        return message
+
+    def get_queue_properties(self, **kwargs):
+        with self._lock:
+            return SimpleNamespace(approximate_message_count=len(self.messages))
+
+    def take_visible(self, count, timeout):
+        now = time.time()
+        page = []
+        with self._lock:
+            for message in self.messages.values():
+                if len(page) == count:
+                    break
+                if message.next_visible_on <= now:
+                    message.pop_receipt = str(uuid.uuid4())
+                    message.next_visible_on = now + timeout
+                    message.dequeue_count += 1
+                    page.append(
+                        SimpleNamespace(
+                            id=message.id,
+                            content=message.content,
+                            pop_receipt=message.pop_receipt,
+                            next_visible_on=message.next_visible_on,
+                            dequeue_count=message.dequeue_count,
+                        )
+                    )
+            self.stats["received"] += len(page)
+        return page
+
+    def receive_messages(
+        self, messages_per_page=None, max_messages=None, visibility_timeout=30, **kw
+    ):
+        return FakeMessagePager(
+            self, messages_per_page, max_messages, visibility_timeout
+        )
+
+    def get_message(self, msg):
+        message = self.messages.get(msg.id)
+        if message is None or message.pop_receipt != msg.pop_receipt:
+            raise ResourceNotFoundError("Message not found or pop receipt mismatch")
+        return message
+
+    def update_message(self, msg, visibility_timeout=30, **kwargs):
+        with self._lock:
+            message = self.get_message(msg)
+            message.pop_receipt = str(uuid.uuid4())
+            message.next_visible_on = time.time() + visibility_timeout
+            self.stats["updated"] += 1
+            return SimpleNamespace(
+                pop_receipt=message.pop_receipt,
+                next_visible_on=message.next_visible_on,
+            )
+
+    def delete_message(self, msg, **kwargs):
+        with self._lock:
+            self.get_message(msg)
+            del self.messages[msg.id]
+            self.stats["deleted"] += 1
+
+
+class FakeFileClient:
+    """A file in a FakeFileSystemClient"""
+
+    def __init__(self, file_system_client, path):
+        self._file_system_client = file_system_client
+        self.path = path
+
+    def upload_data(self, data, overwrite=False, etag=None, **kwargs):
+        self._file_system_client.upload(self.path, data, overwrite, etag)
+
+    def download_file(self, **kwargs):
+        content, etag = self._file_system_client.download(self.path)
+        return SimpleNamespace(
+            readall=lambda: content, properties=SimpleNamespace(etag=etag)
+        )
+
+
+class FakeFileSystemClient:
+    """An in-memory Data Lake file system that fails uploads at error_rate"""
+
+    def __init__(self, error_rate=0.0, seed=0):
+        self.files = {}
+        self.etags = {}
+        self.stats = Counter()
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def get_file_client(self, path):
+        return FakeFileClient(self, path)
+
+    def upload(self, path, data, overwrite, etag=None):
+        if isinstance(data, str):
+            data = data.encode()
+        with self._lock:
+            if self._random.random() < self.error_rate:
+                self.stats["upload_errors"] += 1
+                raise ServiceRequestError(f"Injected upload failure for {path}")
+            if path in self.files and not overwrite:
+                raise ResourceExistsError(f"{path} already exists")
+            if etag is not None and self.etags.get(path) != etag:
+                raise ResourceModifiedError(f"{path} was modified")
+            self.files[path] = bytes(data)
+            self.etags[path] = str(uuid.uuid4())
+            self.stats["uploads"] += 1
+            self.stats["bytes"] += len(data)
+
+    def download(self, path):
+        with self._lock:
+            if path not in self.files:
+                raise ResourceNotFoundError(f"{path} not found")
+            self.stats["downloads"] += 1
+            return self.files[path], self.etags.get(path)
+
+    def get_paths(self, path=None, recursive=True, **kwargs):
+        prefix = f"{path.rstrip('/')}/" if path else ""
+        with self._lock:
+            names = sorted(name for name in self.files if name.startswith(prefix))
+        if prefix and not names:
+            raise ResourceNotFoundError(f"{path} not found")
+        if not recursive:
+            names = [name for name in names if "/" not in name[len(prefix) :]]
+        return [SimpleNamespace(name=name, is_directory=False) for name in names]
+
+
+class FakeAsyncFileClient:
+    """The async client of a file in a FakeFileSystemClient"""
+
+    def __init__(self, file_client):
+        self._file_client = file_client
+
+    async def upload_data(self, data, **kwargs):
+        self._file_client.upload_data(data, **kwargs)
+
+    async def download_file(self, **kwargs):
+        download = self._file_client.download_file(**kwargs)
+        content = download.readall()
+
+        async def readall():
+            return content
+
+        return SimpleNamespace(readall=readall, properties=download.properties)
+
+
+class FakeAsyncFileSystemClient:
+    """The async client of a FakeFileSystemClient, sharing its files"""
+
+    def __init__(self, file_system_client):
+        self.file_system_client = file_system_client
+
+    def get_file_client(self, path):
+        return FakeAsyncFileClient(self.file_system_client.get_file_client(path))
+
+    async def close(self):
+        pass
+
+
+class FakeAsyncQueueClient:
+    """The async client of a FakeQueueClient, sharing its messages"""
+
+    def __init__(self, queue_client):
+        self.queue_client = queue_client
+
+    async def receive_messages(self, **kwargs):
+        for message in self.queue_client.receive_messages(**kwargs):
+            yield message
+
+    async def update_message(self, msg, **kwargs):
+        return self.queue_client.update_message(msg, **kwargs)
+
+    async def delete_message(self, msg, **kwargs):
+        self.queue_client.delete_message(msg, **kwargs)
+
+    async def close(self):
+        pass
+
+
+class FakeDataLakeServiceClient:
+    """An in-memory Data Lake account"""
+
+    def __init__(self, error_rate=0.0):
+        self.file_systems = {}
+        self.error_rate = error_rate
+
+    def get_file_system_client(self, file_system):
+        if file_system not in self.file_systems:
+            self.file_systems[file_system] = FakeFileSystemClient(self.error_rate)
+        return self.file_systems[file_system]
+
+
+def install_fake_clients(
+    storage_name, queue_name, datastore_name, file_system, error_rate=0.0
+):
+    """Put fake queue and Data Lake clients in the process wide client cache
+
+    The async clients share the messages and files of the sync ones. The
+    async worker drops them from the cache when it finishes.
+    """
+    queue_client = FakeQueueClient()
+    service_client = FakeDataLakeServiceClient(error_rate)
+    file_system_client = service_client.get_file_system_client(file_system)
+    clients._clients[("queue", storage_name, queue_name)] = queue_client
+    clients._clients[("dfs", datastore_name, None)] = service_client
+    clients._clients[("dfs", datastore_name, file_system)] = file_system_client
+    async_clients = {
+        ("async-queue", storage_name, queue_name): FakeAsyncQueueClient(queue_client),
+        ("async-dfs", datastore_name, file_system): FakeAsyncFileSystemClient(
+            file_system_client
+        ),
+    }
+    clients._clients.update(async_clients)
+    return queue_client, service_client
+
+
+def send_job(queue_client, tickers, **fields):
+    """Enqueue an EOD job for the fake datastore, as the controller would"""
+    queue_client.send_message(
+        encode_message(
+            {
+                "exchange_mic": "XNAS",
+                "date": "2020-01-02",
+                "type": "EOD",
+                "eod_datastore_name": "datastore",
+                "eod_datastore_container": "eod",
+                "partition_by_date": "true",
+                "tickers": ",".join(tickers),
+                **fields,
+            }
+        )
+    )
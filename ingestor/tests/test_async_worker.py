@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import runpy
+import signal
+import threading
+import time
+from collections import Counter
+from unittest.mock import patch
+import pytest
+from src.stock.data.ingestor import async_worker, marketstack, worker
+from src.stock.data.ingestor.records import parse_eod_records
+from src.stock.data.ingestor.writers import get_output_files
+from tests.fakes import (
+    FakeAsyncFileSystemClient,
+    FakeFileSystemClient,
+    get_eod_row,
+    send_job,
+)
+
+
+def get_fake_get_async(in_flight):
+    """Get a stand-in for marketstack.get_async that counts requests in flight"""
+
+    async def get_async(endpoint, params):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        symbols = params["symbols"].split(",")
+        # Every chunk comes back as two pages of alternate symbols
+        return {
+            "pagination": {"total": 2000},
+            "data": {
+                "eod": [
+                    get_eod_row(symbol, "XNAS", "2020-01-01")
+                    for symbol in symbols[params["offset"] // 1000 :: 2]
+                ]
+            },
+        }
+
+    return get_async
+
+
+def test_put_eod_chunks_bounds_requests_in_flight():
+    in_flight = Counter()
+
+    async def put_eod_chunks(tickers):
+        stages = async_worker.Stages(asyncio.Semaphore(3), asyncio.Semaphore(1))
+        chunks = asyncio.Queue()
+        jobs = worker.get_exchange_jobs(tickers, "XNAS", "2020-01-01")
+        await async_worker.put_eod_chunks(stages, chunks, jobs, stats, None, summary)
+        eod_chunks = []
+        while (eod_chunk := chunks.get_nowait()) is not None:
+            eod_chunks.append(eod_chunk)
+        return eod_chunks
+
+    stats = Counter()
+    summary = Counter()
+    tickers = [f"T{i:04d}" for i in range(1000)]
+    with patch.object(marketstack, "get_async", get_fake_get_async(in_flight)):
+        eod_chunks = asyncio.run(put_eod_chunks(tickers))
+
+    assert len(eod_chunks) == 10
+    # Chunks arrive in job order, with each chunk's pages in page order
+    assert [sorted(eod.symbol for eod in chunk) for chunk in eod_chunks] == [
+        tickers[i : i + 100] for i in range(0, 1000, 100)
+    ]
+    assert stats == {"exchanges/XNAS/eod/2020-01-01": 20}
+    assert summary["rows"] == 1000
+    assert in_flight["max"] == 3
+
+
+def test_save_eod_uploads_while_chunks_are_fetched():
+    in_flight = Counter()
+    file_system_client = FakeFileSystemClient()
+    uploaded_while_fetching = []
+
+    async def save(tickers):
+        stages = async_worker.Stages(asyncio.Semaphore(2), asyncio.Semaphore(2))
+        chunks = asyncio.Queue(1)
+        jobs = worker.get_exchange_jobs(tickers, "XNAS", "2020-01-01")
+        async with asyncio.TaskGroup() as group:
+            fetch = group.create_task(async_worker.put_eod_chunks(stages, chunks, jobs))
+            fetch.add_done_callback(
+                lambda _: uploaded_while_fetching.append(
+                    file_system_client.stats["uploads"]
+                )
+            )
+            return await async_worker.save_eod(
+                stages, "2020-01-01/XNAS", chunks, "eod", "datastore", "json"
+            )
+
+    tickers = [f"T{i:04d}" for i in range(500)]
+    with patch.object(
+        marketstack, "get_async", get_fake_get_async(in_flight)
+    ), patch.object(async_worker, "CHUNK_QUEUE_SIZE", 1), patch(
+        "src.stock.data.ingestor.clients.get_async_file_system_client",
+        return_value=FakeAsyncFileSystemClient(file_system_client),
+    ):
+        uploads = asyncio.run(save(tickers))
+
+    assert len(uploads["succeeded"]) == 500
+    assert uploads["failed"] == []
+    # The first chunks were uploaded before the last ones were fetched
+    assert 0 < uploaded_while_fetching[0] < 500
+    assert sorted(file_system_client.files) == [
+        f"2020-01-01/XNAS/{ticker}.json" for ticker in tickers
+    ]
+
+
+def test_save_eod_streams_consolidated_file():
+    file_system_client = FakeFileSystemClient()
+    eod_chunks = [
+        parse_eod_records([get_eod_row(symbol, "XNAS", "2020-01-01")])
+        for symbol in ["AAPL", "MSFT", "GOOG"]
+    ]
+
+    async def save():
+        chunks = asyncio.Queue()
+        for eod_chunk in eod_chunks + [None]:
+            await chunks.put(eod_chunk)
+        return await async_worker.save_eod(
+            async_worker.get_stages(),
+            "2020-01-01/XNAS",
+            chunks,
+            "eod",
+            "datastore",
+            "ndjson",
+        )
+
+    with patch(
+        "src.stock.data.ingestor.clients.get_async_file_system_client",
+        return_value=FakeAsyncFileSystemClient(file_system_client),
+    ):
+        uploads = asyncio.run(save())
+
+    [(file_name, content)] = get_output_files(
+        "2020-01-01/XNAS", [eod for chunk in eod_chunks for eod in chunk], "ndjson"
+    )
+    assert [upload["file_name"] for upload in uploads["succeeded"]] == [file_name]
+    assert file_system_client.files[file_name] == content
+
+
+def test_upload_files_retries_failures():
+    file_system_client = FakeFileSystemClient(error_rate=0.3, seed=1)
+    files = [(f"2020-01-01/XNAS/T{i:04d}.json", b"{}") for i in range(50)]
+
+    async def upload():
+        return await async_worker.upload_files(
+            async_worker.get_stages(),
+            FakeAsyncFileSystemClient(file_system_client),
+            async_worker.iter_files(files),
+        )
+
+    with patch.object(worker, "UPLOAD_RETRY_DELAY", 0):
+        uploads = asyncio.run(upload())
+
+    assert file_system_client.stats["upload_errors"] > 0
+    assert uploads["failed"] == []
+    assert sorted(upload["file_name"] for upload in uploads["succeeded"]) == [
+        file_name for file_name, _ in files
+    ]
+
+
+def test_run_processes_queue_until_empty(fake_services):
+    server, queue_client, file_system_client = fake_services
+    for mic in ["XNAS", "XNYS", "XLON"]:
+        send_job(
+            queue_client,
+            [f"T{i:04d}" for i in range(150)],
+            exchange_mic=mic,
+            output_format="ndjson",
+        )
+    asyncio.run(async_worker.run(False, "storage", "queue"))
+
+    assert queue_client.messages == {}
+    for mic in ["XNAS", "XNYS", "XLON"]:
+        status = json.loads(
+            file_system_client.files[f"2020-01-02/{mic}/EODSTATUS.json"]
+        )
+        assert status["status"] == "success"
+        assert status["summary"]["rows"] == 150
+        assert status["requests"] == {f"exchanges/{mic}/eod/2020-01-02": 2}
+
+
+def test_run_backfills_into_daily_partitions(fake_services):
+    server, queue_client, file_system_client = fake_services
+    send_job(
+        queue_client,
+        ["AAPL", "MSFT"],
+        type="EOD_BACKFILL",
+        date="2020-01-10",
+        date_from="2020-01-06",
+        date_to="2020-01-10",
+        output_format="json",
+    )
+    asyncio.run(async_worker.run(False, "storage", "queue"))
+
+    assert queue_client.messages == {}
+    for day in range(6, 11):
+        assert f"2020-01-{day:02d}/XNAS/AAPL.json" in file_system_client.files
+        status = json.loads(
+            file_system_client.files[f"2020-01-{day:02d}/XNAS/EODSTATUS-backfill.json"]
+        )
+        assert status["status"] == "success"
+        assert status["file_count"] == 2
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_main_stops_async_daemon_on_shutdown_signal(fake_services):
+    server, queue_client, file_system_client = fake_services
+    send_job(queue_client, ["AAPL", "MSFT"], output_format="json")
+    handlers = {}
+
+    def stop_when_queue_is_empty():
+        deadline = time.monotonic() + 10
+        while queue_client.messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+        handlers[signal.SIGTERM](signal.SIGTERM, None)
+
+    # The deployment runs the worker as a script, so main's module is not the
+    # worker module async_worker imports
+    main = threading.Thread(
+        target=runpy.run_module,
+        args=("src.stock.data.ingestor.worker",),
+        kwargs={"run_name": "__main__"},
+        daemon=True,
+    )
+    with patch.dict(
+        os.environ,
+        {
+            "EOD_INGESTOR_STROAGE_NAME": "storage",
+            "EOD_INGESTOR_STROAGE_QUEUE": "queue",
+            "EOD_INGESTOR_DAEMON": "true",
+            "EOD_INGESTOR_ASYNC": "true",
+        },
+    ), patch.object(worker, "IDLE_BACKOFF_MIN", 60), patch(
+        "signal.signal",
+        side_effect=lambda signum, handler: handlers.update({signum: handler}),
+    ):
+        main.start()
+        threading.Thread(target=stop_when_queue_is_empty, daemon=True).start()
+        main.join(10)
+        stopped = not main.is_alive()
+        if not stopped:
+            # Stop the loop the signal did not reach before failing
+            worker.shutdown.set()
+            main.join(10)
+            worker.shutdown.clear()
+
+    assert stopped
+    assert queue_client.messages == {}
+    assert "2020-01-02/XNAS/AAPL.json" in file_system_client.files
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+from azure.core.credentials import AccessToken
+from src.stock.data.ingestor import clients
+
+
+def test_get_file_system_client_is_cached():
+    with patch.dict(clients._clients, clear=True), patch(
+        "azure.storage.filedatalake.DataLakeServiceClient"
+    ) as mock_service_client, patch.object(clients, "get_credential"):
+        clients.client_cache_stats.clear()
+        first = clients.get_file_system_client("account", "eod")
+        second = clients.get_file_system_client("account", "eod")
+    assert first is second
+    assert mock_service_client.call_count == 1
+    assert clients.client_cache_stats["hits"] == 1
+
+
+def test_queue_and_datalake_clients_share_credential():
+    with patch.dict(clients._clients, clear=True), patch.object(
+        clients, "_credential", None
+    ), patch("azure.identity.DefaultAzureCredential") as mock_credential, patch(
+        "azure.storage.filedatalake.DataLakeServiceClient"
+    ), patch(
+        "azure.storage.queue.QueueClient"
+    ):
+        clients.get_queue_client("account", "queue")
+        clients.get_datalake_service_client("account")
+    assert mock_credential.call_count == 1
+
+
+def test_refreshing_credential_renews_tokens_ahead_of_expiry():
+    credential = MagicMock()
+    credential.get_token.side_effect = [
+        AccessToken("first", int(time.time()) + 3600),
+        AccessToken("second", int(time.time()) + 60),
+        AccessToken("third", int(time.time()) + 3600),
+    ]
+    refreshing = clients.RefreshingCredential(credential, refresh_margin=300)
+    assert refreshing.get_token("scope").token == "first"
+    assert refreshing.get_token("scope").token == "first"
+    assert refreshing.get_token("other").token == "second"
+    assert refreshing.get_token("other").token == "third"
+    assert credential.get_token.call_count == 3
+
+
+def test_async_clients_are_closed_and_dropped():
+    async def use_clients():
+        first = clients.get_async_file_system_client("account", "eod")
+        second = clients.get_async_file_system_client("account", "eod")
+        clients.get_async_queue_client("account", "queue")
+        await clients.close_async_clients()
+        return first, second
+
+    with patch.dict(clients._clients, clear=True), patch.object(
+        clients, "_async_credential", None
+    ), patch("azure.identity.aio.DefaultAzureCredential") as mock_credential, patch(
+        "azure.storage.filedatalake.aio.DataLakeServiceClient"
+    ) as mock_service_client, patch(
+        "azure.storage.queue.aio.QueueClient"
+    ) as mock_queue_client:
+        for mock in (mock_credential, mock_service_client, mock_queue_client):
+            mock.return_value.close = AsyncMock()
+        mock_service_client.return_value.get_file_system_client.return_value.close = (
+            AsyncMock()
+        )
+        first, second = asyncio.run(use_clients())
+        assert first is second
+        assert clients._clients == {}
+    assert mock_credential.call_count == 1
+    mock_service_client.return_value.close.assert_awaited_once()
+    mock_queue_client.return_value.close.assert_awaited_once()
+    mock_credential.return_value.close.assert_awaited_once()
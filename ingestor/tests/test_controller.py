@@ -0,0 +1,126 @@
+import datetime
+from unittest.mock import patch
+import pytest
+
+pytest.importorskip("stock.data.model")
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from stock.data.model import models  # noqa: E402
+from stock.data.model.database import Base  # noqa: E402
+from src.stock.data.ingestor.controller import (  # noqa: E402
+    create_cost_shard_messages,
+    create_shard_messages,
+    get_backfill_windows,
+    get_exchange_tickers,
+    load_manifest,
+    save_manifest,
+    shard_tickers,
+)
+from src.stock.data.ingestor.messages import MAX_MESSAGE_BYTES  # noqa: E402
+
+MESSAGE = {
+    "exchange_mic": "XNAS",
+    "date": "2020-01-01",
+    "eod_datastore_name": "eod",
+    "eod_datastore_container": "eod",
+}
+
+
+def test_shard_tickers_balances_shard_sizes():
+    shards = shard_tickers([f"T{i}" for i in range(1001)], shard_size=500)
+    assert [len(shard) for shard in shards] == [334, 334, 333]
+    assert sum(shards, []) == [f"T{i}" for i in range(1001)]
+    assert shard_tickers([], shard_size=500) == [[]]
+
+
+def test_create_shard_messages_spills_oversized_tickers():
+    tickers = [f"{i:08x}" for i in range(20000)]
+    with patch("src.stock.data.ingestor.controller.SHARD_SIZE", 20000), patch(
+        "src.stock.data.ingestor.controller.MAX_MESSAGE_BYTES", MAX_MESSAGE_BYTES // 8
+    ), patch(
+        "src.stock.data.ingestor.controller.get_file_system_client"
+    ) as mock_file_system_client:
+        messages = create_shard_messages(MESSAGE, tickers)
+    assert len(messages) == 1
+    assert "tickers" not in messages[0]
+    assert messages[0]["tickers_path"] == "jobs/2020-01-01/XNAS/tickers-0.txt"
+    file_client = mock_file_system_client.return_value.get_file_client.return_value
+    file_client.upload_data.assert_called_once()
+
+
+def test_create_cost_shard_messages_sends_longest_shards_first():
+    jobs = [
+        (MESSAGE, [f"A{i}" for i in range(1000)]),
+        ({**MESSAGE, "exchange_mic": "XLON"}, [f"B{i}" for i in range(1000)]),
+    ]
+    with patch("src.stock.data.ingestor.controller.SHARD_SIZE", 500), patch(
+        "src.stock.data.ingestor.controller.get_exchange_cost",
+        side_effect=lambda message, enqueued_dates: {"XNAS": 0.3, "XLON": 0.1}[
+            message["exchange_mic"]
+        ],
+    ):
+        messages = create_cost_shard_messages(jobs, {})
+    assert [message["exchange_mic"] for message in messages] == [
+        "XNAS",
+        "XLON",
+        "XNAS",
+        "XNAS",
+    ]
+    assert [message["estimated_seconds"] for message in messages] == [
+        100.2,
+        100.0,
+        99.9,
+        99.9,
+    ]
+
+
+@pytest.fixture
+def sqlite_db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add(
+        models.TimezoneModel(id=1, name="Eastern Standard Time", abbr="EST", dst="EDT")
+    )
+    db.add(models.CountryModel(id=1, name="United States", code="US"))
+    db.add(models.CityModel(id=1, name="New York", country_id=1))
+    for exchange_id, mic in [(1, "XNAS"), (2, "XNYS")]:
+        db.add(
+            models.ExchangeModel(
+                id=exchange_id,
+                name=mic,
+                acronym=mic,
+                mic=mic,
+                country_id=1,
+                city_id=1,
+                timezone_id=1,
+            )
+        )
+    for ticker in ["AAPL", "MSFT"]:
+        db.add(models.TickerModel(ticker=ticker, name=ticker, exchange_id=1))
+    db.commit()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def test_get_exchange_tickers_loads_all_exchanges_at_once(sqlite_db):
+    exchanges = sqlite_db.query(models.ExchangeModel).all()
+    assert get_exchange_tickers(sqlite_db, exchanges) == {1: ("EST", ["AAPL", "MSFT"])}
+
+
+def test_manifest_round_trips_and_prunes_old_entries(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    save_manifest({"XNAS/2000-01-01": "2000-01-01", f"XNAS/{today}": today}, path)
+    assert load_manifest(path) == {f"XNAS/{today}": today}
+
+
+def test_get_backfill_windows_covers_range_inclusively():
+    assert get_backfill_windows("2020-01-01", "2020-01-10", 4) == [
+        ("2020-01-01", "2020-01-04"),
+        ("2020-01-05", "2020-01-08"),
+        ("2020-01-09", "2020-01-10"),
+    ]
@@ -0,0 +1,96 @@
+import json
+from unittest.mock import patch
+from azure.core.exceptions import HttpResponseError
+from src.stock.data.ingestor import clients
+from src.stock.data.ingestor.costs import (
+    get_exchange_cost,
+    get_history_dates,
+    get_shard_count,
+    get_shard_counts,
+    get_status_costs,
+)
+from tests.fakes import FakeFileSystemClient, install_fake_clients
+
+MESSAGE = {
+    "exchange_mic": "XNAS",
+    "date": "2020-01-10",
+    "eod_datastore_name": "datastore",
+    "eod_datastore_container": "eod",
+    "partition_by_date": "true",
+}
+
+
+def upload_status(file_system_client, path, total_seconds, tickers):
+    file_system_client.get_file_client(path).upload_data(
+        json.dumps({"summary": {"total_seconds": total_seconds, "tickers": tickers}}),
+        overwrite=True,
+    )
+
+
+def test_get_status_costs_sums_every_shard():
+    file_system_client = FakeFileSystemClient()
+    upload_status(file_system_client, "2020-01-09/XNAS/EODSTATUS-0.json", 30.0, 100)
+    upload_status(file_system_client, "2020-01-09/XNAS/EODSTATUS-1.json", 20.0, 100)
+    upload_status(file_system_client, "2020-01-09/XNAS/eod-0.json", 99.0, 99)
+
+    assert get_status_costs(file_system_client, "2020-01-09/XNAS") == (50.0, 200)
+    assert get_status_costs(file_system_client, "2020-01-08/XNAS") == (0.0, 0)
+
+
+def test_get_status_costs_skips_summaries_without_tickers():
+    file_system_client = FakeFileSystemClient()
+    upload_status(file_system_client, "2020-01-09/XNAS/EODSTATUS-0.json", 30.0, 100)
+    file_system_client.get_file_client("2020-01-09/XNAS/EODSTATUS-1.json").upload_data(
+        json.dumps({"summary": {"total_seconds": 20.0, "rows": 5000}}),
+        overwrite=True,
+    )
+
+    assert get_status_costs(file_system_client, "2020-01-09/XNAS") == (30.0, 100)
+
+
+def test_get_history_dates_prefers_enqueued_dates():
+    assert get_history_dates(
+        MESSAGE, ["2020-01-06", "2020-01-10", "2020-01-08"], lookback_days=3
+    ) == ["2020-01-08", "2020-01-06"]
+    assert get_history_dates(MESSAGE, lookback_days=2) == ["2020-01-09", "2020-01-08"]
+
+
+def test_get_exchange_cost_uses_newest_run_with_history():
+    with patch.dict(clients._clients):
+        _, service_client = install_fake_clients("storage", "queue", "datastore", "eod")
+        file_system_client = service_client.get_file_system_client("eod")
+        upload_status(file_system_client, "2020-01-07/XNAS/EODSTATUS.json", 10.0, 10)
+        upload_status(file_system_client, "2020-01-08/XNAS/EODSTATUS.json", 5.0, 10)
+
+        assert get_exchange_cost(MESSAGE) == 0.5
+        assert get_exchange_cost(MESSAGE, ["2020-01-07"]) == 1.0
+        assert get_exchange_cost({**MESSAGE, "exchange_mic": "XLON"}) is None
+
+
+def test_get_exchange_cost_falls_back_when_history_cannot_be_read():
+    with patch.dict(clients._clients):
+        _, service_client = install_fake_clients("storage", "queue", "datastore", "eod")
+        file_system_client = service_client.get_file_system_client("eod")
+        file_system_client.get_file_client(
+            "2020-01-09/XNAS/EODSTATUS.json"
+        ).upload_data(b'{"summary": {"total_seconds": 5.0, "tick', overwrite=True)
+        assert get_exchange_cost(MESSAGE) is None
+
+        with patch.object(
+            file_system_client,
+            "get_paths",
+            side_effect=HttpResponseError(message="Forbidden"),
+        ):
+            assert get_exchange_cost({**MESSAGE, "exchange_mic": "XLON"}) is None
+
+
+def test_get_shard_count_is_clamped():
+    assert get_shard_count(1000, 0.1, 25.0) == 4
+    assert get_shard_count(3, 100.0, 1.0) == 3
+    assert get_shard_count(0, 1.0, 1.0) == 1
+
+
+def test_get_shard_counts_balances_cost():
+    # The first exchange takes twice the median per ticker, the last has no history
+    assert get_shard_counts([1000] * 4, [0.2, 0.1, 0.1, None], 500) == [4, 2, 2, 2]
+    assert get_shard_counts([1000, 10], [None, None], 500) == [2, 1]
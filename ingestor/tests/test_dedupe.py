@@ -0,0 +1,25 @@
+from collections import Counter
+from src.stock.data.ingestor.dedupe import EOD_KEY, remove_dupes, unique_records
+
+
+def test_remove_dupes_by_natural_key_keeps_first_seen_order():
+    data = [
+        {"symbol": "AAPL", "date": "2020-01-01", "exchange": "XNAS", "close": 1},
+        {"symbol": "MSFT", "date": "2020-01-01", "exchange": "XNAS", "close": 2},
+        {"symbol": "AAPL", "date": "2020-01-01", "exchange": "XNAS", "close": 3},
+        {"symbol": "AAPL", "date": "2020-01-02", "exchange": "XNAS", "close": 4},
+    ]
+    assert [row["close"] for row in remove_dupes(data, EOD_KEY)] == [1, 2, 4]
+
+
+def test_remove_dupes_falls_back_to_content_hash():
+    data = [{"a": 1, "b": {"c": 2}}, {"b": {"c": 2}, "a": 1}, {"a": 2}]
+    assert remove_dupes(data) == [{"a": 1, "b": {"c": 2}}, {"a": 2}]
+    assert remove_dupes(data, ("symbol",)) == [{"a": 1, "b": {"c": 2}}, {"a": 2}]
+
+
+def test_unique_records_reports_duplicates():
+    stats = Counter()
+    rows = ({"symbol": symbol} for symbol in ["A", "B", "A", "A"])
+    assert len(list(unique_records(rows, ("symbol",), stats))) == 2
+    assert stats == {"rows": 4, "duplicates": 2}
@@ -0,0 +1,104 @@
+from src.stock.data.ingestor.delta import (
+    get_changed_output_files,
+    load_hashes,
+    save_hashes,
+)
+from src.stock.data.ingestor.records import EodRecord
+from tests.fakes import FakeFileSystemClient, get_eod_row
+
+
+def get_records(symbols, close=1.0):
+    return [
+        EodRecord.from_dict(
+            {**get_eod_row(symbol, "XNAS", "2020-01-01"), "close": close}
+        )
+        for symbol in symbols
+    ]
+
+
+def test_hashes_round_trip():
+    file_system_client = FakeFileSystemClient()
+    assert load_hashes(file_system_client, "2020-01-01/XNAS/EODHASHES.json") is None
+    save_hashes(
+        file_system_client,
+        "2020-01-01/XNAS/EODHASHES.json",
+        "json",
+        {"AAPL": "00"},
+        [{"file_name": "2020-01-01/XNAS/AAPL.json", "bytes": 10}],
+    )
+    assert load_hashes(file_system_client, "2020-01-01/XNAS/EODHASHES.json") == {
+        "output_format": "json",
+        "symbols": {"AAPL": "00"},
+        "files": {"2020-01-01/XNAS/AAPL.json": 10},
+    }
+
+
+def test_get_changed_output_files_skips_unchanged_symbols():
+    hashes = {}
+    files = list(
+        get_changed_output_files(
+            "2020-01-01/XNAS",
+            get_records(["AAPL", "MSFT"]),
+            "json",
+            "eod",
+            None,
+            hashes,
+            [],
+        )
+    )
+    previous = {
+        "output_format": "json",
+        "symbols": hashes,
+        "files": {name: len(content) for name, content in files},
+    }
+
+    skipped = []
+    records = get_records(["AAPL"]) + get_records(["MSFT"], close=2.0)
+    changed = list(
+        get_changed_output_files(
+            "2020-01-01/XNAS", records, "json", "eod", previous, {}, skipped
+        )
+    )
+    assert [name for name, _ in changed] == ["2020-01-01/XNAS/MSFT.json"]
+    assert skipped == [
+        {"file_name": "2020-01-01/XNAS/AAPL.json", "bytes": len(files[0][1])}
+    ]
+
+
+def test_get_changed_output_files_rewrites_changed_consolidated_file():
+    hashes = {}
+    list(
+        get_changed_output_files(
+            "2020-01-01/XNAS",
+            get_records(["AAPL", "MSFT"]),
+            "ndjson",
+            "eod",
+            None,
+            hashes,
+            [],
+        )
+    )
+    previous = {
+        "output_format": "ndjson",
+        "symbols": hashes,
+        "files": {"2020-01-01/XNAS/eod.ndjson.gz": 100},
+    }
+
+    skipped = []
+    unchanged = get_changed_output_files(
+        "2020-01-01/XNAS",
+        get_records(["AAPL", "MSFT"]),
+        "ndjson",
+        "eod",
+        previous,
+        {},
+        skipped,
+    )
+    assert list(unchanged) == []
+    assert skipped == [{"file_name": "2020-01-01/XNAS/eod.ndjson.gz", "bytes": 100}]
+
+    for records in (get_records(["AAPL"]), get_records(["AAPL", "MSFT"], close=2.0)):
+        changed = get_changed_output_files(
+            "2020-01-01/XNAS", records, "ndjson", "eod", previous, {}, []
+        )
+        assert [name for name, _ in changed] == ["2020-01-01/XNAS/eod.ndjson.gz"]
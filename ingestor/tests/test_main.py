@@ -1,3 +1,4 @@
+import json
 import os
 import pytest
 from unittest.mock import patch
@@ -142,37 +143,46 @@ def add_eod_data_store(db: SessionLocal):
 
 
 def test_get_requests_with_offset():
-    with patch("src.stock.data.ingestor.worker.requests") as mock_requests:
-        mock_requests.get.return_value.json.return_value = {
-            "data": [{"a": 1}, {"a": 2}],
-            "pagination": {"count": 2, "total": 1}
-        }
+    with patch("src.stock.data.ingestor.marketstack.get_session") as mock_session:
+        mock_session.return_value.get.return_value.status_code = 200
+        mock_session.return_value.get.return_value.content = json.dumps(
+            {
+                "data": {"eod": [{"a": 1}, {"a": 2}]},
+                "pagination": {"count": 2, "total": 1},
+            }
+        ).encode()
         result = get_requests_with_offset(
             endpoint="eod/XNAS/2020-01-01",
             initial_offset=0,
             extra_params={"symbols": "AAPL,GOOG", "limit": 1000},
         )
-        assert result == {"data": [{"a": 1}, {"a": 2}]}
+        assert result == [{"a": 1}, {"a": 2}]
 
 
 def test_get_ext_eod_exchange():
-    with patch("src.stock.data.ingestor.worker.requests") as mock_requests:
-        mock_requests.get.return_value.json.return_value = {
-            "data": [{"a": 1}, {"a": 2}],
-            "pagination": {"count": 2},
-        }
+    with patch("src.stock.data.ingestor.marketstack.get_session") as mock_session:
+        mock_session.return_value.get.return_value.status_code = 200
+        mock_session.return_value.get.return_value.content = json.dumps(
+            {
+                "data": {"eod": [{"a": 1}, {"a": 2}]},
+                "pagination": {"count": 2},
+            }
+        ).encode()
         result = get_ext_eod_exchange("AAPL,GOOG", "XNAS")
-        assert result == {"data": [{"a": 1}, {"a": 2}]}
+        assert result == [{"a": 1}, {"a": 2}]
 
 
 def test_get_ext_eod_exchange_with_date():
-    with patch("src.stock.data.ingestor.worker.requests") as mock_requests:
-        mock_requests.get.return_value.json.return_value = {
-            "data": [{"a": 1}, {"a": 2}],
-            "pagination": {"count": 2},
-        }
+    with patch("src.stock.data.ingestor.marketstack.get_session") as mock_session:
+        mock_session.return_value.get.return_value.status_code = 200
+        mock_session.return_value.get.return_value.content = json.dumps(
+            {
+                "data": {"eod": [{"a": 1}, {"a": 2}]},
+                "pagination": {"count": 2},
+            }
+        ).encode()
         result = get_ext_eod_exchange("AAPL,GOOG", "XNAS", "2020-01-01")
-        assert result == {"data": [{"a": 1}, {"a": 2}]}
+        assert result == [{"a": 1}, {"a": 2}]
 
 
 def test_create_job_messages(db: SessionLocal):
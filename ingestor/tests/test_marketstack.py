@@ -0,0 +1,144 @@
+import asyncio
+import json as jsonlib
+from unittest.mock import MagicMock, patch
+import aiohttp
+import pytest
+import requests
+from src.stock.data.ingestor import marketstack, ratelimit
+from tests.fakes import FakeMarketstack
+
+
+def fake_response(status_code, json={}, headers={}):
+    response = MagicMock(status_code=status_code, headers=headers)
+    response.content = jsonlib.dumps(json).encode()
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.HTTPError(str(status_code))
+    return response
+
+
+def test_get_retries_server_errors():
+    with patch(
+        "src.stock.data.ingestor.marketstack.get_session"
+    ) as mock_session, patch(
+        "src.stock.data.ingestor.marketstack.time.sleep"
+    ) as mock_sleep:
+        mock_session.return_value.get.side_effect = [
+            fake_response(502),
+            requests.ConnectionError("reset"),
+            fake_response(200, {"data": []}),
+        ]
+        assert marketstack.get("tickers", {"offset": 0}) == {"data": []}
+    assert mock_session.return_value.get.call_count == 3
+    assert mock_sleep.call_count == 2
+
+
+def test_get_honours_retry_after():
+    with patch(
+        "src.stock.data.ingestor.marketstack.get_session"
+    ) as mock_session, patch(
+        "src.stock.data.ingestor.marketstack.time.sleep"
+    ) as mock_sleep:
+        mock_session.return_value.get.side_effect = [
+            fake_response(429, headers={"Retry-After": "7"}),
+            fake_response(200, {"data": []}),
+        ]
+        marketstack.get("tickers")
+    mock_sleep.assert_called_once_with(7.0)
+
+
+def test_get_gives_up_after_max_retries():
+    with patch("src.stock.data.ingestor.marketstack.MAX_RETRIES", 2), patch(
+        "src.stock.data.ingestor.marketstack.get_session"
+    ) as mock_session, patch("src.stock.data.ingestor.marketstack.time.sleep"):
+        mock_session.return_value.get.return_value = fake_response(503)
+        with pytest.raises(requests.HTTPError):
+            marketstack.get("tickers")
+    assert mock_session.return_value.get.call_count == 3
+
+
+def test_get_does_not_retry_client_errors():
+    with patch("src.stock.data.ingestor.marketstack.get_session") as mock_session:
+        mock_session.return_value.get.return_value = fake_response(401)
+        with pytest.raises(requests.HTTPError):
+            marketstack.get("tickers")
+    assert mock_session.return_value.get.call_count == 1
+
+
+def get_async(server, endpoint, params={}):
+    async def get():
+        try:
+            return await marketstack.get_async(endpoint, params)
+        finally:
+            await marketstack.close_async_session()
+
+    with patch.object(marketstack, "MARKETSTACK_API", server.url), patch.object(
+        marketstack, "BACKOFF_FACTOR", 0
+    ), patch.object(ratelimit, "_limiter", ratelimit.TokenBucket(rate=0)):
+        return asyncio.run(get())
+
+
+def test_get_async_retries_throttled_and_failed_requests():
+    with FakeMarketstack(throttle_rate=0.4, error_rate=0.4, seed=1) as server:
+        page = get_async(
+            server, "exchanges/XNAS/eod/2020-01-02", {"symbols": "AAPL,MSFT"}
+        )
+    assert [eod["symbol"] for eod in page["data"]["eod"]] == ["AAPL", "MSFT"]
+    assert server.stats["status_200"] == 1
+    assert server.stats["requests"] > 1
+
+
+def test_get_async_does_not_retry_client_errors():
+    with FakeMarketstack() as server:
+        with pytest.raises(aiohttp.ClientResponseError):
+            get_async(server, "tickers")
+    assert server.stats["requests"] == 1
+
+
+def test_get_session_is_shared():
+    assert marketstack.get_session() is marketstack.get_session()
+
+
+def test_get_cached_reuses_responses_until_refreshed():
+    with patch.dict(marketstack._cache, clear=True), patch(
+        "src.stock.data.ingestor.marketstack.get", side_effect=[{"n": 1}, {"n": 2}]
+    ) as mock_get:
+        assert marketstack.get_cached("exchanges", {"offset": 0}) == {"n": 1}
+        assert marketstack.get_cached("exchanges", {"offset": 0}) == {"n": 1}
+        assert marketstack.get_cached("exchanges", {"offset": 0}, refresh=True) == {
+            "n": 2
+        }
+    assert mock_get.call_count == 2
+
+
+def test_get_cached_expires_entries():
+    with patch.dict(marketstack._cache, clear=True), patch(
+        "src.stock.data.ingestor.marketstack.get", side_effect=[{"n": 1}, {"n": 2}]
+    ):
+        assert marketstack.get_cached("exchanges", ttl=0) == {"n": 1}
+        assert marketstack.get_cached("exchanges", ttl=0) == {"n": 2}
+
+
+def test_get_cached_reads_disk_cache(tmp_path):
+    with patch.object(marketstack, "CACHE_DIR", str(tmp_path)), patch(
+        "src.stock.data.ingestor.marketstack.get", return_value={"n": 1}
+    ) as mock_get:
+        with patch.dict(marketstack._cache, clear=True):
+            marketstack.get_cached("tickers", {"offset": 1000})
+        with patch.dict(marketstack._cache, clear=True):
+            assert marketstack.get_cached("tickers", {"offset": 1000}) == {"n": 1}
+    assert mock_get.call_count == 1
+    assert len(list(tmp_path.glob("*.json"))) == 1
+
+
+def test_clear_cache_refetches_once(tmp_path):
+    with patch.object(marketstack, "CACHE_DIR", str(tmp_path)), patch.dict(
+        marketstack._cache, clear=True
+    ), patch(
+        "src.stock.data.ingestor.marketstack.get", side_effect=[{"n": 1}, {"n": 2}]
+    ) as mock_get:
+        marketstack.get_cached("exchanges", {"offset": 0})
+        marketstack.clear_cache()
+        assert list(tmp_path.glob("*.json")) == []
+        assert marketstack.get_cached("exchanges", {"offset": 0}) == {"n": 2}
+        assert marketstack.get_cached("exchanges", {"offset": 0}) == {"n": 2}
+    assert mock_get.call_count == 2
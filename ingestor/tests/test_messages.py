@@ -0,0 +1,43 @@
+import base64
+import json
+import pytest
+from src.stock.data.ingestor.messages import (
+    decode_message,
+    encode_message,
+    get_shard_file_name,
+    parse_bool,
+)
+
+MESSAGE = {"exchange_mic": "XNAS", "date": "2020-01-01", "tickers": "AAPL,MSFT"}
+
+
+def test_encode_message_round_trips_and_compresses():
+    message = {**MESSAGE, "tickers": ",".join(f"T{i}" for i in range(5000))}
+    content = encode_message(message)
+    assert decode_message(content) == message
+    assert len(content) < len(json.dumps(message)) / 2
+
+
+def test_decode_message_accepts_legacy_base64_payloads():
+    content = base64.b64encode(json.dumps(MESSAGE).encode())
+    assert decode_message(content) == MESSAGE
+
+
+def test_get_shard_file_name():
+    assert get_shard_file_name("eod", MESSAGE) == "eod"
+    assert get_shard_file_name("eod", {"shard": 0, "shard_count": 1}) == "eod"
+    assert get_shard_file_name("eod", {"shard": 2, "shard_count": 3}) == "eod-2"
+    backfill = {"type": "EOD_BACKFILL", "shard": 2, "shard_count": 3}
+    assert get_shard_file_name("eod", backfill) == "eod-backfill-2"
+    assert get_shard_file_name("EODSTATUS", {"type": "EOD_BACKFILL"}) == (
+        "EODSTATUS-backfill"
+    )
+
+
+def test_parse_bool_accepts_strtobool_values():
+    assert [parse_bool(value) for value in ["true", "True", "1", "yes", "on"]] == [
+        True
+    ] * 5
+    assert [parse_bool(value) for value in ["false", "0", "no", "off"]] == [False] * 4
+    with pytest.raises(ValueError):
+        parse_bool("maybe")
@@ -0,0 +1,61 @@
+import urllib.request
+from collections import Counter
+from unittest.mock import patch
+import pytest
+from src.stock.data.ingestor import metrics
+
+
+@pytest.fixture(autouse=True)
+def empty_metrics():
+    with patch.object(metrics, "_counters", Counter()), patch.object(
+        metrics, "_timers", {}
+    ):
+        yield
+
+
+def test_timer_records_duration_and_summary():
+    summary = Counter()
+    with metrics.timer("save_eod", summary, exchange="XNAS"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer("save_eod", summary, exchange="XNAS"):
+            raise ValueError()
+    total, count = metrics._timers[("save_eod", (("exchange", "XNAS"),))]
+    assert count == 2
+    assert summary["save_eod_seconds"] == pytest.approx(total)
+
+
+def test_timed_iter_times_each_item():
+    assert list(metrics.timed_iter("fetch", [1, 2])) == [1, 2]
+    assert metrics._timers[("fetch", ())][1] == 3
+
+
+def test_render_prometheus_formats_counters_and_timers():
+    metrics.increment("messages_processed_total", status="success")
+    metrics.increment("messages_processed_total", 2, status='fa"iled')
+    metrics.observe("queue_delete", 0.5)
+    assert metrics.render_prometheus().splitlines() == [
+        "# TYPE eod_ingestor_messages_processed_total counter",
+        'eod_ingestor_messages_processed_total{status="fa\\"iled"} 2',
+        'eod_ingestor_messages_processed_total{status="success"} 1',
+        "# TYPE eod_ingestor_queue_delete_seconds summary",
+        "eod_ingestor_queue_delete_seconds_sum 0.5",
+        "eod_ingestor_queue_delete_seconds_count 1",
+    ]
+
+
+def test_metrics_are_exported_to_textfile_and_http(tmp_path):
+    metrics.increment("rows_fetched_total", 10)
+    path = tmp_path / "ingestor.prom"
+    metrics.write_textfile(str(path))
+    assert "eod_ingestor_rows_fetched_total 10" in path.read_text()
+
+    server = metrics.start_http_server(0)
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        assert (
+            b"eod_ingestor_rows_fetched_total 10" in urllib.request.urlopen(url).read()
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
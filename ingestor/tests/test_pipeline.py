@@ -0,0 +1,161 @@
+import json
+import os
+from unittest.mock import patch
+import pytest
+from src.stock.data.ingestor import spool, worker
+from tests.fakes import send_job
+
+
+def test_process_messages_ingests_exchange_end_to_end(fake_services):
+    server, queue_client, file_system_client = fake_services
+    tickers = [f"T{i:04d}" for i in range(250)]
+    send_job(queue_client, tickers, output_format="ndjson")
+    worker.process_messages()
+
+    assert queue_client.messages == {}
+    status = json.loads(file_system_client.files["2020-01-02/XNAS/EODSTATUS.json"])
+    assert status["status"] == "success"
+    assert status["requests"] == {"exchanges/XNAS/eod/2020-01-02": 3}
+    assert "2020-01-02/XNAS/eod.ndjson.gz" in file_system_client.files
+    assert status["summary"]["pages"] == 3
+    assert status["summary"]["rows"] == 250
+    assert status["summary"]["files"] == 1
+    assert status["summary"]["total_seconds"] >= status["summary"]["save_eod_seconds"]
+    assert server.stats["rows"] == 250
+
+
+def test_process_messages_skips_unchanged_files_on_rerun(fake_services):
+    server, queue_client, file_system_client = fake_services
+    tickers = [f"T{i:04d}" for i in range(10)]
+    send_job(queue_client, tickers, output_format="json")
+    worker.process_messages()
+    uploads = file_system_client.stats["uploads"]
+
+    send_job(queue_client, tickers, output_format="json", force=True)
+    worker.process_messages()
+
+    # Only the hash manifest and the status file are uploaded again
+    assert file_system_client.stats["uploads"] == uploads + 2
+    status = json.loads(file_system_client.files["2020-01-02/XNAS/EODSTATUS.json"])
+    assert status["status"] == "success"
+    assert status["file_count"] == 10
+    assert status["summary"]["skipped_files"] == 10
+    assert status["summary"]["skipped_bytes"] == status["bytes"]
+
+
+def test_process_messages_backfills_into_daily_partitions(fake_services):
+    server, queue_client, file_system_client = fake_services
+    send_job(
+        queue_client,
+        ["AAPL", "MSFT"],
+        type="EOD_BACKFILL",
+        date="2020-01-10",
+        date_from="2020-01-06",
+        date_to="2020-01-10",
+        output_format="json",
+    )
+    worker.process_messages()
+
+    for day in range(6, 11):
+        assert f"2020-01-{day:02d}/XNAS/AAPL.json" in file_system_client.files
+        assert (
+            f"2020-01-{day:02d}/XNAS/EODSTATUS-backfill.json"
+            in file_system_client.files
+        )
+    assert queue_client.messages == {}
+
+
+def test_backfill_shards_do_not_replace_daily_shards(fake_services):
+    server, queue_client, file_system_client = fake_services
+    tickers = ["AAPL", "MSFT", "GOOG"]
+    for shard in range(2):
+        send_job(
+            queue_client,
+            tickers[shard::2],
+            date="2020-01-06",
+            output_format="ndjson",
+            shard=shard,
+            shard_count=2,
+        )
+    send_job(
+        queue_client,
+        tickers,
+        type="EOD_BACKFILL",
+        date="2020-01-06",
+        date_from="2020-01-06",
+        date_to="2020-01-06",
+        output_format="ndjson",
+    )
+    worker.process_messages()
+
+    assert sorted(
+        name for name in file_system_client.files if name.startswith("2020-01-06/")
+    ) == [
+        "2020-01-06/XNAS/EODHASHES-0.json",
+        "2020-01-06/XNAS/EODHASHES-1.json",
+        "2020-01-06/XNAS/EODHASHES-backfill.json",
+        "2020-01-06/XNAS/EODSTATUS-0.json",
+        "2020-01-06/XNAS/EODSTATUS-1.json",
+        "2020-01-06/XNAS/EODSTATUS-backfill.json",
+        "2020-01-06/XNAS/eod-0.ndjson.gz",
+        "2020-01-06/XNAS/eod-1.ndjson.gz",
+        "2020-01-06/XNAS/eod-backfill.ndjson.gz",
+    ]
+
+
+def test_process_messages_resumes_from_spool(fake_services, tmp_path):
+    server, queue_client, file_system_client = fake_services
+    send_job(queue_client, [f"T{i:04d}" for i in range(250)], output_format="ndjson")
+    with patch.object(spool, "SPOOL_DIR", str(tmp_path)):
+        # The worker is stopped after uploading, before writing its status
+        with patch.object(
+            worker, "log_eod_ingestor_worker_status", side_effect=SystemExit
+        ), pytest.raises(SystemExit):
+            worker.process_messages()
+        assert len(os.listdir(tmp_path)) == 1
+        requests = server.stats["requests"]
+        uploads = file_system_client.stats["uploads"]
+
+        for message in queue_client.messages.values():
+            message.next_visible_on = 0
+        worker.process_messages()
+
+    assert server.stats["requests"] == requests
+    # Only the hash manifest and the status file are uploaded again
+    assert file_system_client.stats["uploads"] == uploads + 2
+    assert queue_client.messages == {}
+    assert os.listdir(tmp_path) == []
+    status = json.loads(file_system_client.files["2020-01-02/XNAS/EODSTATUS.json"])
+    assert status["requests"] == {}
+    assert [file["file_name"] for file in status["files"]] == [
+        "2020-01-02/XNAS/eod.ndjson.gz"
+    ]
+    assert status["summary"]["pages_replayed"] == 3
+    # The upload was recorded in the partition's hash manifest too
+    assert status["summary"]["skipped_files"] == 1
+    assert status["summary"]["rows"] == 250
+
+
+def test_resumed_run_keeps_hashes_of_symbols_saved_before(fake_services):
+    server, queue_client, file_system_client = fake_services
+    tickers = [f"T{i:04d}" for i in range(4)]
+    send_job(queue_client, tickers, output_format="json")
+    worker.process_messages()
+    # An earlier run saved the first two symbols before failing
+    status_file_name = "2020-01-02/XNAS/EODSTATUS.json"
+    status = json.loads(file_system_client.files[status_file_name])
+    status["status"] = "failed"
+    status["files"] = status["files"][:2]
+    file_system_client.files[status_file_name] = json.dumps(status).encode()
+
+    send_job(queue_client, tickers, output_format="json")
+    worker.process_messages()
+
+    hashes = json.loads(file_system_client.files["2020-01-02/XNAS/EODHASHES.json"])
+    assert sorted(hashes["symbols"]) == tickers
+    assert sorted(hashes["files"]) == [
+        f"2020-01-02/XNAS/{ticker}.json" for ticker in tickers
+    ]
+    status = json.loads(file_system_client.files[status_file_name])
+    assert status["status"] == "success"
+    assert status["summary"]["tickers"] == 2
@@ -0,0 +1,110 @@
+import asyncio
+from unittest.mock import patch
+import pytest
+from src.stock.data.ingestor import marketstack, ratelimit
+from src.stock.data.ingestor.ratelimit import (
+    DatastoreTokenBucket,
+    QuotaExceededError,
+    SqliteTokenBucket,
+    TokenBucket,
+)
+from tests.fakes import FakeAsyncFileSystemClient, FakeFileSystemClient
+
+
+def test_token_bucket_spaces_requests_after_burst():
+    with patch("src.stock.data.ingestor.ratelimit.time.time", return_value=1000.0):
+        bucket = TokenBucket(rate=2, burst=2)
+        delays = [bucket.reserve() for _ in range(4)]
+    assert delays == [0.0, 0.0, 0.5, 1.0]
+
+
+def test_token_bucket_enforces_monthly_quota():
+    bucket = TokenBucket(rate=0, burst=1, quota=2)
+    bucket.reserve()
+    bucket.reserve()
+    with pytest.raises(QuotaExceededError):
+        bucket.reserve()
+    assert bucket.get_used() == 2
+
+
+def test_sqlite_token_bucket_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "ratelimit.db")
+    with patch("src.stock.data.ingestor.ratelimit.time.time", return_value=1000.0):
+        first = SqliteTokenBucket(path, rate=1, burst=1, quota=3)
+        second = SqliteTokenBucket(path, rate=1, burst=1, quota=3)
+        assert first.reserve() == 0.0
+        assert second.reserve() == 1.0
+        assert first.reserve() == 2.0
+        with pytest.raises(QuotaExceededError):
+            second.reserve()
+        assert first.get_used() == 3
+
+
+def test_datastore_token_bucket_leases_quota_in_blocks():
+    file_system_client = FakeFileSystemClient()
+    first = DatastoreTokenBucket(file_system_client, rate=0, quota=5, block_size=2)
+    second = DatastoreTokenBucket(file_system_client, rate=0, quota=5, block_size=2)
+    first.reserve()
+    second.reserve()
+    first.reserve()
+    # A new process starts from the count in the datastore, not from zero
+    third = DatastoreTokenBucket(file_system_client, rate=0, quota=5, block_size=2)
+    third.reserve()
+    assert third.get_used() == 5
+    second.reserve()
+    with pytest.raises(QuotaExceededError):
+        second.reserve()
+    assert file_system_client.stats["uploads"] == 3
+
+
+def test_datastore_token_bucket_retries_concurrent_leases():
+    file_system_client = FakeFileSystemClient()
+    bucket = DatastoreTokenBucket(file_system_client, rate=0, quota=10, block_size=4)
+    other = DatastoreTokenBucket(file_system_client, rate=0, quota=10, block_size=4)
+    read_used = bucket._read_used
+
+    def read_used_then_race(file_client):
+        used = read_used(file_client)
+        if not file_system_client.files:
+            other.reserve()
+        return used
+
+    with patch.object(bucket, "_read_used", side_effect=read_used_then_race):
+        bucket.reserve()
+    assert bucket.get_used() == 8
+
+
+def test_get_waits_for_rate_limiter_and_counts_requests():
+    with patch.object(ratelimit, "acquire") as mock_acquire, patch(
+        "src.stock.data.ingestor.marketstack.get_session"
+    ) as mock_session:
+        mock_session.return_value.get.return_value.status_code = 200
+        mock_session.return_value.get.return_value.content = b"{}"
+        before = marketstack.request_stats["exchanges"]
+        marketstack.get("exchanges")
+    mock_acquire.assert_called_once_with()
+    assert marketstack.request_stats["exchanges"] == before + 1
+
+
+def test_datastore_token_bucket_leases_from_coroutines():
+    file_system_client = FakeFileSystemClient()
+    bucket = DatastoreTokenBucket(
+        file_system_client,
+        rate=0,
+        quota=5,
+        block_size=2,
+        get_async_file_system_client=lambda: FakeAsyncFileSystemClient(
+            file_system_client
+        ),
+    )
+
+    async def reserve(count):
+        await asyncio.gather(*(bucket.reserve_async() for _ in range(count)))
+
+    asyncio.run(reserve(3))
+    # Coroutines waiting on the same lease share its block
+    assert bucket.get_used() == 4
+    assert file_system_client.stats["uploads"] == 2
+    asyncio.run(reserve(2))
+    with pytest.raises(QuotaExceededError):
+        asyncio.run(reserve(1))
@@ -0,0 +1,56 @@
+import json
+import pytest
+from src.stock.data.ingestor.dedupe import EOD_KEY, remove_dupes
+from src.stock.data.ingestor.records import (
+    EodRecord,
+    InvalidEodRecordError,
+    parse_eod_records,
+)
+from tests.fakes import get_eod_row
+
+
+def test_eod_record_round_trips_marketstack_rows():
+    row = get_eod_row("AAPL", "XNAS", "2020-01-02")
+    record = EodRecord.from_dict(row)
+    assert record.to_dict() == row
+    assert json.loads(record.to_json()) == row
+    assert record.to_json() == json.dumps(row, separators=(",", ":"))
+
+
+def test_eod_record_json_matches_compact_json_for_awkward_values():
+    row = {
+        **get_eod_row('Bé"R', "XNAS", "2020-01-02"),
+        "volume": None,
+        "dividend": 1,
+        "close": "12.5",
+    }
+    record = EodRecord.from_dict(row)
+    assert record.close == 12.5
+    assert record.to_json() == json.dumps(
+        record.to_dict(), separators=(",", ":"), ensure_ascii=False
+    )
+
+
+@pytest.mark.parametrize(
+    "field, value",
+    [
+        ("symbol", None),
+        ("date", "2020-01-02"),
+        ("close", "n/a"),
+        ("close", float("nan")),
+        ("volume", True),
+    ],
+)
+def test_eod_record_rejects_invalid_fields(field, value):
+    with pytest.raises(InvalidEodRecordError):
+        EodRecord.from_dict({**get_eod_row("AAPL", "XNAS", "2020-01-02"), field: value})
+
+
+def test_parse_eod_records_drops_invalid_rows_and_dedupes():
+    rows = [
+        get_eod_row("AAPL", "XNAS", "2020-01-02"),
+        {"symbol": "MSFT"},
+        get_eod_row("AAPL", "XNAS", "2020-01-02"),
+    ]
+    records = remove_dupes(parse_eod_records(rows), EOD_KEY)
+    assert [record.symbol for record in records] == ["AAPL"]
@@ -0,0 +1,161 @@
+from collections import Counter
+from unittest.mock import MagicMock, patch
+import pytest
+
+pytest.importorskip("stock.data.model")
+
+from sqlalchemy import Column, DateTime, Integer, String  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import declarative_base, sessionmaker  # noqa: E402
+from stock.data.model import models  # noqa: E402
+from stock.data.model.database import Base  # noqa: E402
+from src.stock.data.ingestor import main  # noqa: E402
+
+SoftDeleteBase = declarative_base()
+
+
+class SoftDeletedCurrencyModel(SoftDeleteBase):
+    __tablename__ = "soft_deleted_currency"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    code = Column(String)
+    deleted_at = Column(DateTime)
+
+
+@pytest.fixture
+def sqlite_db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)
+    db = session()
+    db.add(models.TimezoneModel(id=1, name="America/New_York", abbr="EST", dst="EDT"))
+    db.add(models.CountryModel(id=1, name="USA", code="US"))
+    db.add(models.CityModel(id=1, name="New York", country_id=1))
+    db.commit()
+    with patch.object(main, "SessionLocal", session):
+        yield db
+    db.close()
+
+
+def test_seed_exchanges_reports_failed_rows_in_bulk(sqlite_db):
+    exchanges = {
+        "data": [
+            {
+                "name": "NASDAQ Stock Exchange",
+                "acronym": "NASDAQ",
+                "mic": "XNAS",
+                "country": "USA",
+                "city": "New York",
+                "timezone": {"timezone": "America/New_York"},
+            },
+            {
+                "name": "London Stock Exchange",
+                "acronym": "LSE",
+                "mic": "XLON",
+                "country": "United Kingdom",
+                "city": "London",
+                "timezone": {"timezone": "Europe/London"},
+            },
+        ]
+    }
+    with patch.object(main, "get_ext_exchanges_list", return_value=exchanges):
+        failed = main.seed_exchanges(batch_size=1)
+    assert failed == [("London Stock Exchange", "unknown country")]
+    assert [exchange.mic for exchange in sqlite_db.query(models.ExchangeModel)] == [
+        "XNAS"
+    ]
+
+
+def test_seed_tickers_looks_up_exchanges_once(sqlite_db):
+    sqlite_db.add(
+        models.ExchangeModel(
+            id=1,
+            name="NASDAQ Stock Exchange",
+            acronym="NASDAQ",
+            mic="XNAS",
+            country_id=1,
+            city_id=1,
+            timezone_id=1,
+        )
+    )
+    sqlite_db.commit()
+    tickers = {
+        "data": [
+            {
+                "name": f"Ticker {i}",
+                "symbol": f"T{i}",
+                "stock_exchange": {"name": "NASDAQ Stock Exchange"},
+            }
+            for i in range(5)
+        ]
+        + [{"name": "Orphan", "symbol": "ORPH", "stock_exchange": None}]
+    }
+    with patch.object(main, "get_ext_tickers_list", return_value=tickers):
+        failed = main.seed_tickers(batch_size=2)
+    assert failed == [("ORPH", "unknown exchange")]
+    assert sqlite_db.query(models.TickerModel).count() == 5
+
+
+def test_sync_rows_only_touches_changed_rows(sqlite_db):
+    rows = [
+        {"name": "US Dollar", "code": "USD"},
+        {"name": "Euro", "code": "EUR"},
+    ]
+    main.sync_rows(sqlite_db, models.CurrencyModel, rows, ("code",))
+    counts = main.sync_rows(
+        sqlite_db,
+        models.CurrencyModel,
+        [
+            {"name": "US Dollar", "code": "USD"},
+            {"name": "Euro (EMU)", "code": "EUR"},
+            {"name": "Pound Sterling", "code": "GBP"},
+        ],
+        ("code",),
+    )
+    assert counts == {"inserted": 1, "updated": 1, "unchanged": 1}
+    names = {c.code: c.name for c in sqlite_db.query(models.CurrencyModel)}
+    assert names == {"USD": "US Dollar", "EUR": "Euro (EMU)", "GBP": "Pound Sterling"}
+
+
+def test_sync_rows_restores_soft_deleted_rows():
+    engine = create_engine("sqlite://")
+    SoftDeleteBase.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    rows = [
+        {"name": "US Dollar", "code": "USD"},
+        {"name": "Euro", "code": "EUR"},
+    ]
+    model = SoftDeletedCurrencyModel
+    main.sync_rows(db, model, rows, ("code",))
+    counts = main.sync_rows(db, model, rows[:1], ("code",), delete_missing=True)
+    assert counts == Counter(unchanged=1, deleted=1)
+    counts = main.sync_rows(db, model, rows, ("code",), delete_missing=True)
+    assert counts == Counter(unchanged=1, updated=1)
+    assert db.query(model).filter(model.deleted_at.isnot(None)).count() == 0
+
+
+def test_sync_rows_keeps_failed_rows_and_rows_of_empty_fetches():
+    engine = create_engine("sqlite://")
+    SoftDeleteBase.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    rows = [
+        {"name": "US Dollar", "code": "USD"},
+        {"name": "Euro", "code": "EUR"},
+    ]
+    model = SoftDeletedCurrencyModel
+    main.sync_rows(db, model, rows, ("code",))
+    counts = main.sync_rows(
+        db, model, rows[:1], ("code",), delete_missing=True, failed_keys=[("EUR",)]
+    )
+    assert counts == Counter(unchanged=1)
+    counts = main.sync_rows(db, model, [], ("code",), delete_missing=True)
+    assert counts == Counter()
+    assert db.query(model).filter(model.deleted_at.isnot(None)).count() == 0
+
+
+def test_insert_rows_counts_rows_postgres_inserted():
+    db = MagicMock()
+    db.get_bind.return_value.dialect.name = "postgresql"
+    db.execute.return_value.rowcount = 1
+    rows = [{"name": "Euro", "code": "EUR"}] * 3
+    assert main.insert_rows(db, models.CurrencyModel, rows, batch_size=2) == 2
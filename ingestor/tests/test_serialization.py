@@ -0,0 +1,36 @@
+import sys
+from unittest.mock import patch
+import pytest
+from src.stock.data.ingestor.records import EodRecord
+from src.stock.data.ingestor.serialization import get_serializer
+from tests.fakes import get_eod_row
+
+
+def test_backends_encode_records_identically():
+    pytest.importorskip("orjson")
+    record = EodRecord.from_dict(
+        {**get_eod_row('Bé"R', "XNAS", "2020-01-02"), "volume": None}
+    )
+    assert get_serializer("json").dumps_record(record) == get_serializer(
+        "orjson"
+    ).dumps_record(record)
+
+
+@pytest.mark.parametrize("name", ["json", "orjson"])
+def test_backends_round_trip_bytes(name):
+    if name == "orjson":
+        pytest.importorskip("orjson")
+    serializer = get_serializer(name)
+    message = {"tickers": "AAPL,MSFT", "shard": 1, "price": 1.5}
+    content = serializer.dumps(message)
+    assert isinstance(content, bytes)
+    assert serializer.loads(content) == message
+
+
+def test_get_serializer_falls_back_to_stdlib_without_orjson():
+    with patch.dict(sys.modules, {"orjson": None}):
+        assert get_serializer().name == "json"
+        with pytest.raises(RuntimeError):
+            get_serializer("orjson")
+    with pytest.raises(ValueError):
+        get_serializer("yaml")
@@ -0,0 +1,83 @@
+import os
+import time
+from collections import Counter
+from unittest.mock import MagicMock, patch
+from src.stock.data.ingestor import worker
+from src.stock.data.ingestor.spool import (
+    AppendLog,
+    Spool,
+    open_spool,
+    prune_spools,
+    remove_spool,
+)
+
+
+def test_append_log_reopens_and_drops_torn_entry(tmp_path):
+    path = str(tmp_path / "pages.ndjson")
+    log = AppendLog(path)
+    log.add("a", {"rows": [1, 2]})
+    log.add("b", [3])
+    log.close()
+    with open(path, "ab") as log_file:
+        log_file.write(b'{"key":"c","val')
+
+    log = AppendLog(path)
+    assert log.get("a") == {"rows": [1, 2]}
+    assert log.get("b") == [3]
+    assert "c" not in log
+    log.add("c", None)
+    log.close()
+    assert AppendLog(path).index.keys() == {"a", "b", "c"}
+
+
+def test_get_requests_with_offsets_replays_spooled_pages(tmp_path):
+    page = {"pagination": {"total": 1}, "data": {"eod": [{"symbol": "AAPL"}]}}
+    spool = Spool(str(tmp_path / "message"))
+    spool.add_page("exchanges/XNAS/eod/2020-01-01", 0, {"symbols": "AAPL"}, page)
+    stats = Counter()
+    with patch.object(worker, "get_page") as get_page:
+        data = worker.get_requests_with_offsets(
+            [("exchanges/XNAS/eod/2020-01-01", 0, {"symbols": "AAPL"})],
+            stats=stats,
+            spool=spool,
+        )
+    assert data == [[{"symbol": "AAPL"}]]
+    get_page.assert_not_called()
+    assert stats == {}
+    assert spool.stats["pages_replayed"] == 1
+
+
+def test_upload_files_skips_checkpointed_uploads(tmp_path):
+    spool = Spool(str(tmp_path / "message"))
+    spool.add_upload({"file_name": "a.json", "bytes": 2})
+    file_system_client = MagicMock()
+    uploads = worker.upload_files(
+        file_system_client, [("a.json", b"{}"), ("b.json", b"[]")], spool=spool
+    )
+    assert uploads["succeeded"] == [
+        {"file_name": "a.json", "bytes": 2},
+        {"file_name": "b.json", "bytes": 2},
+    ]
+    file_system_client.get_file_client.assert_called_once_with("b.json")
+    assert "b.json" in spool.uploads
+
+
+def test_open_spool_is_disabled_without_a_directory(tmp_path):
+    with open_spool("message", spool_dir="") as spool:
+        assert spool is None
+    with open_spool("message", spool_dir=str(tmp_path)) as spool:
+        spool.add_upload({"file_name": "a.json", "bytes": 2})
+    assert os.path.exists(tmp_path / "message" / "uploads.ndjson")
+    remove_spool("message", spool_dir=str(tmp_path))
+    assert not os.path.exists(tmp_path / "message")
+
+
+def test_prune_spools_removes_stale_spools(tmp_path):
+    Spool(str(tmp_path / "stale")).close()
+    Spool(str(tmp_path / "fresh")).close()
+    stale = time.time() - 3 * 3600
+    for name in os.listdir(tmp_path / "stale"):
+        os.utime(tmp_path / "stale" / name, (stale, stale))
+    os.utime(tmp_path / "stale", (stale, stale))
+    prune_spools(str(tmp_path), retention_hours=2)
+    assert sorted(os.listdir(tmp_path)) == ["fresh"]
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+import pytest
+
+INGESTOR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that are only imported on the code paths that use them
+LAZY_MODULES = [
+    "asyncio",
+    "azure.core",
+    "azure.identity",
+    "azure.storage.filedatalake",
+    "azure.storage.queue",
+    "distutils",
+]
+
+
+def get_import_times(module):
+    """Get the cumulative microseconds of each import made by a module
+
+    The module is imported in a fresh interpreter with ``python -X importtime``.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=INGESTOR_DIR,
+        env={**os.environ, "PYTHONPATH": os.path.join(INGESTOR_DIR, "src")},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+@pytest.mark.parametrize(
+    "module",
+    ["stock.data.ingestor.worker", "stock.data.ingestor.controller"],
+)
+def test_entry_point_defers_heavy_imports(module, record_property):
+    if module.endswith("controller"):
+        pytest.importorskip("stock.data.model")
+    import_times = get_import_times(module)
+    record_property("import_time_ms", import_times[module] / 1000)
+    assert [name for name in LAZY_MODULES if name in import_times] == []
@@ -0,0 +1,361 @@
+import json
+import threading
+import pytest
+from unittest.mock import MagicMock, patch
+from azure.core.exceptions import ServiceRequestError
+from src.stock.data.ingestor import worker
+from src.stock.data.ingestor.messages import encode_message
+from src.stock.data.ingestor.worker import (
+    get_backfill_jobs,
+    get_ext_eod_exchange,
+    get_requests_with_offsets,
+    get_resume_plan,
+    iter_ext_eod_exchange,
+    keep_message_visible,
+    prefetch,
+    save_eod,
+    should_delete_message,
+    split_date_range,
+    upload_files,
+)
+from tests.fakes import get_eod_row
+
+
+def fake_page(endpoint, offset, extra_params={}):
+    symbols = extra_params["symbols"].split(",")
+    rows = [
+        {"symbol": symbol, "date": "2020-01-01", "offset": offset} for symbol in symbols
+    ]
+    return {
+        "data": {"eod": rows},
+        "pagination": {"offset": offset, "limit": 1000, "total": 2500},
+    }
+
+
+def test_get_requests_with_offsets_fans_out_pages_in_order():
+    with patch(
+        "src.stock.data.ingestor.worker.get_page", side_effect=fake_page
+    ) as mock_get_page:
+        result = get_requests_with_offsets(
+            [
+                ("exchanges/XNAS/eod/latest", 0, {"symbols": "AAPL"}),
+                ("exchanges/XNAS/eod/latest", 0, {"symbols": "MSFT"}),
+            ],
+            max_workers=4,
+        )
+    assert mock_get_page.call_count == 6
+    assert [row["offset"] for row in result[0]] == [0, 1000, 2000]
+    assert [row["symbol"] for row in result[1]] == ["MSFT", "MSFT", "MSFT"]
+
+
+def test_get_requests_with_offsets_caps_pages():
+    with patch("src.stock.data.ingestor.worker.MAX_PAGES", 2), patch(
+        "src.stock.data.ingestor.worker.get_page", side_effect=fake_page
+    ) as mock_get_page:
+        result = get_requests_with_offsets(
+            [("exchanges/XNAS/eod/latest", 0, {"symbols": "AAPL"})]
+        )
+    assert mock_get_page.call_count == 2
+    assert [row["offset"] for row in result[0]] == [0, 1000]
+
+
+def test_get_ext_eod_exchange_chunks_symbols():
+    tickers = ",".join(f"T{i}" for i in range(250))
+    with patch(
+        "src.stock.data.ingestor.worker.get_page",
+        side_effect=lambda endpoint, offset, extra_params: {
+            "data": {
+                "eod": [{"symbol": s} for s in extra_params["symbols"].split(",")]
+            },
+            "pagination": {"total": 100},
+        },
+    ) as mock_get_page:
+        result = get_ext_eod_exchange(tickers, "XNAS", "2020-01-01")
+    assert mock_get_page.call_count == 3
+    assert mock_get_page.call_args_list[0].args[0] == "exchanges/XNAS/eod/2020-01-01"
+    assert [row["symbol"] for row in result] == tickers.split(",")
+
+
+def test_save_eod_uploads_consolidated_file():
+    with patch(
+        "src.stock.data.ingestor.worker.configure_eod_ingestor_datastore_auth"
+    ), patch(
+        "src.stock.data.ingestor.worker.get_file_system_client"
+    ) as mock_get_file_system_client:
+        uploads = save_eod(
+            "2020-01-01/XNAS",
+            [get_eod_row(symbol, "XNAS", "2020-01-01") for symbol in ["AAPL", "MSFT"]],
+            "eod",
+            "datastore",
+            "ndjson",
+        )
+    assert [file["file_name"] for file in uploads["succeeded"]] == [
+        "2020-01-01/XNAS/eod.ndjson.gz"
+    ]
+    assert uploads["failed"] == []
+    file_system_client = mock_get_file_system_client.return_value
+    file_system_client.get_file_client.return_value.upload_data.assert_called_once()
+
+
+def test_upload_files_retries_failures_without_aborting_batch():
+    file_system_client = MagicMock()
+    attempts = {}
+
+    def upload_data(file_name, file_content, overwrite):
+        attempts[file_name] = attempts.get(file_name, 0) + 1
+        if file_name == "flaky.json" and attempts[file_name] == 1:
+            raise ServiceRequestError("connection reset")
+        if file_name == "broken.json":
+            raise ServiceRequestError("connection reset")
+
+    file_system_client.get_file_client.side_effect = lambda file_name: MagicMock(
+        upload_data=lambda data, overwrite: upload_data(file_name, data, overwrite)
+    )
+    with patch("src.stock.data.ingestor.worker.time.sleep"):
+        uploads = upload_files(
+            file_system_client,
+            [("ok.json", b"12"), ("flaky.json", b"123"), ("broken.json", b"1234")],
+        )
+    assert sorted(file["file_name"] for file in uploads["succeeded"]) == [
+        "flaky.json",
+        "ok.json",
+    ]
+    assert uploads["failed"] == [
+        {"file_name": "broken.json", "bytes": 4, "error": "connection reset"}
+    ]
+    assert attempts == {"ok.json": 1, "flaky.json": 2, "broken.json": 4}
+
+
+def test_iter_ext_eod_exchange_fetches_a_pool_of_chunks_at_a_time():
+    tickers = ",".join(f"T{i}" for i in range(500))
+    fetched = []
+
+    def get_page(endpoint, offset, extra_params):
+        fetched.append(extra_params["symbols"])
+        return {"data": {"eod": [{"symbol": extra_params["symbols"]}]}}
+
+    with patch("src.stock.data.ingestor.worker.get_page", side_effect=get_page):
+        chunks = iter_ext_eod_exchange(tickers, "XNAS", max_workers=2)
+        next(chunks)
+        assert len(fetched) == 2
+        assert len(list(chunks)) == 4
+    assert len(fetched) == 5
+
+
+def test_prefetch_keeps_order_and_bounds_buffer():
+    produced = []
+
+    def produce():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    items = prefetch(produce(), depth=2)
+    assert next(items) == 0
+    assert list(items) == list(range(1, 10))
+    assert produced == list(range(10))
+
+
+def test_prefetch_reraises_producer_errors():
+    def produce():
+        yield 1
+        raise ValueError("boom")
+
+    items = prefetch(produce(), depth=2)
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_keep_message_visible_renews_pop_receipt():
+    msg = MagicMock(id="1", pop_receipt="first")
+    renewed = threading.Event()
+
+    def update_message(message, visibility_timeout):
+        renewed.set()
+        return MagicMock(pop_receipt="second")
+
+    with patch.object(worker, "queue_service_client", create=True) as mock_queue_client:
+        mock_queue_client.update_message.side_effect = update_message
+        with keep_message_visible(msg, visibility_timeout=0.02):
+            assert renewed.wait(1)
+    assert msg.pop_receipt == "second"
+
+
+def test_run_daemon_processes_messages_until_shutdown():
+    batches = [[MagicMock(id="1"), MagicMock(id="2")], [], [MagicMock(id="3")]]
+    processed = []
+
+    def receive_messages(max_messages):
+        if not batches:
+            worker.shutdown.set()
+            return []
+        return batches.pop(0)
+
+    with patch.object(worker, "MESSAGE_CONCURRENCY", 2), patch.object(
+        worker, "IDLE_BACKOFF_MIN", 0.01
+    ), patch.object(
+        worker, "receive_messages", side_effect=receive_messages
+    ), patch.object(
+        worker, "process_message", side_effect=lambda msg: processed.append(msg.id)
+    ):
+        worker.shutdown.clear()
+        worker.run_daemon()
+        worker.shutdown.clear()
+    assert sorted(processed) == ["1", "2", "3"]
+
+
+def make_message(**fields):
+    message = {
+        "exchange_mic": "XNAS",
+        "date": "2020-01-01",
+        "eod_datastore_name": "datastore",
+        "eod_datastore_container": "eod",
+        "partition_by_date": "true",
+        "output_format": "json",
+        "tickers": "AAPL,MSFT,GOOG",
+        **fields,
+    }
+    return MagicMock(id="1", content=encode_message(message))
+
+
+def test_process_message_skips_ingested_exchange_dates():
+    with patch.object(
+        worker, "queue_service_client", create=True
+    ) as mock_queue, patch.object(
+        worker,
+        "get_eod_ingestor_worker_status",
+        return_value={"status": "success"},
+    ), patch.object(
+        worker, "save_eod"
+    ) as mock_save_eod:
+        msg = make_message()
+        worker.process_message(msg)
+    mock_save_eod.assert_not_called()
+    mock_queue.delete_message.assert_called_once_with(msg)
+
+
+def test_process_message_resumes_missing_symbols():
+    status = {
+        "status": "failed",
+        "files": [{"file_name": "2020-01-01/XNAS/AAPL.json", "bytes": 10}],
+    }
+    saved = {}
+
+    def save_eod(file_name_preffix, eod_data, *args):
+        saved["rows"] = list(eod_data)
+        return {
+            "succeeded": [{"file_name": "2020-01-01/XNAS/MSFT.json", "bytes": 5}],
+            "failed": [],
+            "skipped": [],
+        }
+
+    with patch.object(worker, "queue_service_client", create=True), patch.object(
+        worker, "get_eod_ingestor_worker_status", return_value=status
+    ), patch.object(worker, "save_eod", side_effect=save_eod), patch.object(
+        worker, "log_eod_ingestor_worker_status"
+    ) as mock_log_status, patch.object(
+        worker,
+        "get_page",
+        side_effect=lambda endpoint, offset, extra_params: {
+            "data": {
+                "eod": [
+                    get_eod_row(symbol, "XNAS", "2020-01-01")
+                    for symbol in extra_params["symbols"].split(",")
+                ]
+            }
+        },
+    ):
+        worker.process_message(make_message())
+    assert [eod.symbol for eod in saved["rows"]] == ["MSFT", "GOOG"]
+    written_status = json.loads(mock_log_status.call_args.args[0])
+    assert written_status["status"] == "success"
+    assert written_status["file_count"] == 2
+    assert written_status["requests"] == {"exchanges/XNAS/eod/2020-01-01": 1}
+
+
+def test_get_resume_plan_keeps_per_symbol_files_saved_before():
+    tickers = ["AAPL", "MSFT"]
+    files = [{"file_name": "2020-01-01/XNAS/AAPL.json", "bytes": 10}]
+    status = {"status": "failed", "files": files}
+
+    assert get_resume_plan(tickers, "2020-01-01/XNAS", "json", None) == (tickers, [])
+    assert get_resume_plan(tickers, "2020-01-01/XNAS", "json", status) == (
+        ["MSFT"],
+        files,
+    )
+    assert get_resume_plan(tickers, "2020-01-01/XNAS", "ndjson", status) == (
+        tickers,
+        [],
+    )
+
+
+def test_should_delete_message_leaves_failed_uploads_on_the_queue():
+    uploads = {"succeeded": [], "skipped": [], "failed": []}
+    failed = {**uploads, "failed": [{"file_name": "AAPL.json", "bytes": 1}]}
+
+    assert should_delete_message({"2020-01-01/XNAS": uploads})
+    assert not should_delete_message(
+        {"2020-01-01/XNAS": uploads, "2020-01-02/XNAS": failed}
+    )
+
+
+def test_split_date_range_counts_trading_days():
+    assert split_date_range("2020-01-01", "2020-01-14", 5) == [
+        ("2020-01-01", "2020-01-07"),
+        ("2020-01-08", "2020-01-14"),
+    ]
+    assert split_date_range("2020-01-01", "2020-12-31", 1000) == [
+        ("2020-01-01", "2020-12-31")
+    ]
+
+
+def test_get_backfill_jobs_keeps_jobs_under_page_cap():
+    tickers = [str(i) for i in range(150)]
+    with patch.object(worker, "MAX_PAGES", 2):
+        jobs = get_backfill_jobs(tickers, "XNAS", "2020-01-01", "2020-03-31")
+    assert {job[0] for job in jobs} == {"exchanges/XNAS/eod"}
+    # 2000 rows per job: 20 trading days for 100 symbols, 40 for the last 50
+    assert len([job for job in jobs if job[2]["symbols"].startswith("0,")]) == 4
+    assert len([job for job in jobs if job[2]["symbols"].startswith("100,")]) == 2
+
+
+def test_process_message_splits_backfill_into_daily_partitions():
+    saved = {}
+
+    def save_eod(file_name_preffix, eod_data, *args):
+        saved[file_name_preffix] = eod_data
+        return {"succeeded": [], "failed": [], "skipped": []}
+
+    def get_page(endpoint, offset, extra_params):
+        return {
+            "data": {
+                "eod": [
+                    get_eod_row(symbol, "XNAS", date)
+                    for symbol in extra_params["symbols"].split(",")
+                    for date in ("2020-01-02", "2020-01-03")
+                ]
+            }
+        }
+
+    msg = make_message(
+        type="EOD_BACKFILL", date_from="2020-01-01", date_to="2020-01-03"
+    )
+    with patch.object(
+        worker, "queue_service_client", create=True
+    ) as mock_queue, patch.object(
+        worker, "save_eod", side_effect=save_eod
+    ), patch.object(
+        worker, "log_eod_ingestor_worker_status"
+    ) as mock_log_status, patch.object(
+        worker, "get_page", side_effect=get_page
+    ):
+        worker.process_message(msg)
+    assert sorted(saved) == ["2020-01-02/XNAS", "2020-01-03/XNAS"]
+    assert [eod.symbol for eod in saved["2020-01-03/XNAS"]] == [
+        "AAPL",
+        "MSFT",
+        "GOOG",
+    ]
+    assert mock_log_status.call_count == 2
+    mock_queue.delete_message.assert_called_once_with(msg)
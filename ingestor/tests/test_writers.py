@@ -0,0 +1,70 @@
+import gzip
+import io
+import json
+import pytest
+from unittest.mock import patch
+from src.stock.data.ingestor.records import EOD_FIELDS
+from src.stock.data.ingestor.writers import get_output_files
+
+EOD_DATA = [
+    {
+        "symbol": "AAPL",
+        "exchange": "XNAS",
+        "date": "2020-01-02T00:00:00+0000",
+        "open": 74.06,
+        "close": 75.09,
+        "volume": 135480400.0,
+    },
+    {
+        "symbol": "MSFT",
+        "exchange": "XNAS",
+        "date": "2020-01-02T00:00:00+0000",
+        "open": 158.78,
+        "close": 160.62,
+        "volume": None,
+    },
+]
+
+
+def test_get_output_files_json_writes_one_file_per_symbol():
+    files = list(get_output_files("2020-01-02/XNAS", EOD_DATA, "json"))
+    assert [file_name for file_name, _ in files] == [
+        "2020-01-02/XNAS/AAPL.json",
+        "2020-01-02/XNAS/MSFT.json",
+    ]
+    assert json.loads(files[0][1]) == {**dict.fromkeys(EOD_FIELDS), **EOD_DATA[0]}
+
+
+def test_get_output_files_ndjson_writes_a_single_gzip_file():
+    files = list(get_output_files("XNAS/2020-01-02", EOD_DATA, "ndjson"))
+    assert len(files) == 1
+    assert files[0][0] == "XNAS/2020-01-02/eod.ndjson.gz"
+    lines = gzip.decompress(files[0][1]).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {**dict.fromkeys(EOD_FIELDS), **eod} for eod in EOD_DATA
+    ]
+
+
+def test_get_output_files_parquet_writes_typed_columns():
+    pq = pytest.importorskip("pyarrow.parquet")
+    files = list(get_output_files("2020-01-02/XNAS", EOD_DATA, "parquet"))
+    assert files[0][0] == "2020-01-02/XNAS/eod.parquet"
+    table = pq.read_table(io.BytesIO(files[0][1]))
+    assert table.column("symbol").to_pylist() == ["AAPL", "MSFT"]
+    assert table.column("close").to_pylist() == [75.09, 160.62]
+    assert table.column("volume").to_pylist() == [135480400.0, None]
+    assert table.schema.field("date").type.tz == "UTC"
+
+
+def test_get_output_files_rejects_unknown_format():
+    with pytest.raises(ValueError):
+        get_output_files("2020-01-02/XNAS", EOD_DATA, "csv")
+
+
+def test_get_output_files_parquet_writes_row_groups():
+    pq = pytest.importorskip("pyarrow.parquet")
+    with patch("src.stock.data.ingestor.writers.PARQUET_ROW_GROUP_SIZE", 1):
+        files = list(get_output_files("2020-01-02/XNAS", iter(EOD_DATA), "parquet"))
+    parquet_file = pq.ParquetFile(io.BytesIO(files[0][1]))
+    assert parquet_file.metadata.num_row_groups == 2
+    assert parquet_file.metadata.num_rows == 2